@@ -2,6 +2,7 @@ package com.chunaudis.image_toolkit.config;
 
 import org.springframework.amqp.core.Binding;
 import org.springframework.amqp.core.BindingBuilder;
+import org.springframework.amqp.core.FanoutExchange;
 import org.springframework.amqp.core.Queue;
 import org.springframework.amqp.core.QueueBuilder;
 import org.springframework.amqp.core.TopicExchange;
@@ -19,6 +20,9 @@ public class RabbitMQConfig {
     @Value("${app.rabbitmq.exchange-name}")
     private String imageProcessingExchangeName;
 
+    @Value("${app.rabbitmq.cancel-exchange-name}")
+    private String jobCancellationExchangeName;
+
     @Value("${app.rabbitmq.queues.bg-removal.name}")
     private String bgRemovalQueueName;
 
@@ -50,6 +54,11 @@ public class RabbitMQConfig {
         return new TopicExchange(imageProcessingExchangeName);
     }
 
+    @Bean
+    FanoutExchange jobCancellationExchange() {
+        return new FanoutExchange(jobCancellationExchangeName);
+    }
+
     @Bean
     Queue backgroundRemovalQueue() {
         return QueueBuilder.durable(bgRemovalQueueName).build();
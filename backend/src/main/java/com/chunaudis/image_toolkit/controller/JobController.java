@@ -74,6 +74,31 @@ public class JobController {
         }
     }
     
+    // Endpoint for frontend to cancel a job that hasn't finished
+    @PostMapping("/{jobId}/cancel")
+    public ResponseEntity<?> cancelJob(@PathVariable UUID jobId, HttpServletRequest request) {
+        try {
+            UUID userId = (UUID) request.getAttribute("userId");
+            if (userId == null) {
+                return ResponseEntity.status(HttpStatus.UNAUTHORIZED).build();
+            }
+
+            Job job = jobService.getJobStatus(jobId);
+
+            if (!job.getUser().getUserId().equals(userId)) {
+                return ResponseEntity.status(HttpStatus.FORBIDDEN).body("You don't have access to this job");
+            }
+
+            job = jobService.cancelJob(jobId, "cancelled by user");
+            return ResponseEntity.ok(mapJobToJobResponseDTO(job, userId));
+        } catch (jakarta.persistence.EntityNotFoundException e) {
+            return ResponseEntity.notFound().build();
+        } catch (Exception e) {
+            log.error("Error cancelling job {}: ", jobId, e);
+            return ResponseEntity.internalServerError().body("Error cancelling job: " + e.getMessage());
+        }
+    }
+
     @PostMapping("/{jobId}/unlock-premium")
     public ResponseEntity<?> unlockPremiumQuality(@PathVariable UUID jobId, HttpServletRequest request) {
         try {
@@ -18,4 +18,6 @@ public class JobMessageDTO {
     private String imageStoragePath; // Path to original image (local or cloud)
     private JobTypeEnum jobType;
     private Map<String, Object> jobConfig; // Specific config for the job
+    private Long enqueuedAt; // Epoch millis when the job was published
+    private Long deadline; // Epoch millis after which workers drop the job (null = no deadline)
 }
\ No newline at end of file
@@ -74,6 +74,8 @@ public class CloudinaryCleanupService {
                         cloudinaryStorageService.deleteImage(publicId);
                     }
                 }
+                // Stored alpha masks are tagged with the job that computed them
+                cloudinaryStorageService.deleteRawFilesByTag("job_" + image.getJob().getJobId());
                 
                 // Delete from database
                 processedImageRepository.delete(image);
@@ -110,6 +112,8 @@ public class CloudinaryCleanupService {
                         cloudinaryStorageService.deleteImage(publicId);
                     }
                 }
+                // Stored alpha masks are tagged with the job that computed them
+                cloudinaryStorageService.deleteRawFilesByTag("job_" + image.getJob().getJobId());
                 
                 // Delete from database
                 processedImageRepository.delete(image);
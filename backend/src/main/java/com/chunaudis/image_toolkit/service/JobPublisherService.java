@@ -1,5 +1,8 @@
 package com.chunaudis.image_toolkit.service;
 
+import java.util.Map;
+import java.util.UUID;
+
 import org.slf4j.Logger;
 import org.slf4j.LoggerFactory;
 import org.springframework.amqp.rabbit.core.RabbitTemplate;
@@ -20,6 +23,9 @@ public class JobPublisherService {
     @Value("${app.rabbitmq.exchange-name}")
     private String imageProcessingExchangeName;
 
+    @Value("${app.rabbitmq.cancel-exchange-name}")
+    private String jobCancellationExchangeName;
+
     @Value("${app.rabbitmq.queues.bg-removal.routing-key}")
     private String bgRemovalRoutingKey;
 
@@ -76,6 +82,15 @@ private String objectRemovalRoutingKey;
         rabbitTemplate.convertAndSend(imageProcessingExchangeName, routingKey, jobMessage);
     }
 
+    /**
+     * Broadcast a cancelled job id to every worker: queued messages are skipped
+     * and running jobs stop at their next stage boundary.
+     */
+    public void publishCancellation(UUID jobId, String reason) {
+        log.info("Publishing cancellation of job {} to exchange {}", jobId, jobCancellationExchangeName);
+        rabbitTemplate.convertAndSend(jobCancellationExchangeName, "", Map.of("jobId", jobId.toString(), "reason", reason));
+    }
+
     @Recover
     public void recover(RuntimeException e, JobMessageDTO failedMessage) {
         log.error("❌ Failed to send job {} after 3 attempts. Error: {}", failedMessage.getJobId(), e.getMessage());
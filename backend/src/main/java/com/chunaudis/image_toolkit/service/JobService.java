@@ -6,6 +6,7 @@ import java.util.UUID;
 
 import org.slf4j.Logger;
 import org.slf4j.LoggerFactory;
+import org.springframework.beans.factory.annotation.Value;
 import org.springframework.stereotype.Service;
 import org.springframework.transaction.annotation.Transactional;
 //Retrys
@@ -43,6 +44,9 @@ public class JobService {
     private final CloudinaryStorageService cloudinaryStorageService;
     private final CloudinaryCleanupService cloudinaryCleanupService;
 
+    @Value("${app.jobs.deadline-seconds:600}")
+    private long jobDeadlineSeconds;
+
     public JobService(JobRepository jobRepository,
                       JobPublisherService jobPublisherService,
                       ProcessedImageRepository processedImageRepository,
@@ -81,13 +85,17 @@ public Job createAndDispatchJob(Image image, JobTypeEnum jobType, String imageSt
     Job savedJob = jobRepository.save(job);
     log.info("Created job {} with status QUEUED", savedJob.getJobId());
 
-    // Preparar mensaje RabbitMQ
+    // Preparar mensaje RabbitMQ (los workers descartan el job si vence el deadline)
+    long enqueuedAt = System.currentTimeMillis();
+    Long deadline = jobDeadlineSeconds > 0 ? enqueuedAt + jobDeadlineSeconds * 1000 : null;
     JobMessageDTO message = new JobMessageDTO(
             savedJob.getJobId(),
             image.getImageId(),
             imageStoragePath,
             jobType,
-            jobConfig
+            jobConfig,
+            enqueuedAt,
+            deadline
     );
 
     // Publicar mensaje con manejo de errores
@@ -109,6 +117,12 @@ public Job createAndDispatchJob(Image image, JobTypeEnum jobType, String imageSt
         Job job = jobRepository.findById(jobId)
                 .orElseThrow(() -> new EntityNotFoundException("Job not found with ID: " + jobId));
 
+        if (job.getStatus() == JobStatusEnum.CANCELLED) {
+            // A worker may report on a job it was already running when the cancellation arrived
+            log.info("Ignoring status {} for cancelled job {}", updateRequest.getStatus(), jobId);
+            return job;
+        }
+
         job.setStatus(updateRequest.getStatus());
         job.setErrorMessage(updateRequest.getErrorMessage()); // Can be null
 
@@ -163,6 +177,32 @@ public Job createAndDispatchJob(Image image, JobTypeEnum jobType, String imageSt
         return jobRepository.save(job);
     }
 
+    /**
+     * Cancel a job that hasn't finished and tell the workers to drop it
+     */
+    @Transactional
+    public Job cancelJob(UUID jobId, String reason) {
+        Job job = getJobStatus(jobId);
+        if (job.getStatus() == JobStatusEnum.COMPLETED
+                || job.getStatus() == JobStatusEnum.FAILED
+                || job.getStatus() == JobStatusEnum.CANCELLED) {
+            log.info("Job {} is already {}, not cancelling it", jobId, job.getStatus());
+            return job;
+        }
+
+        job.setStatus(JobStatusEnum.CANCELLED);
+        job.setCompletedAt(OffsetDateTime.now());
+        Job savedJob = jobRepository.save(job);
+
+        try {
+            jobPublisherService.publishCancellation(jobId, reason);
+        } catch (Exception e) {
+            // The job stays CANCELLED; a worker that still runs it has its status update ignored
+            log.error("Failed to broadcast cancellation of job {}: {}", jobId, e.getMessage(), e);
+        }
+        return savedJob;
+    }
+
     public Job getJobStatus(UUID jobId) {
         return jobRepository.findById(jobId)
                 .orElseThrow(() -> new EntityNotFoundException("Job not found with ID: " + jobId));
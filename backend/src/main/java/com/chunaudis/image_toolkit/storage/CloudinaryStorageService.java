@@ -122,6 +122,18 @@ public class CloudinaryStorageService {
         }
     }
 
+    /**
+     * Delete raw files by tag (alpha masks kept by the background removal service)
+     */
+    public void deleteRawFilesByTag(String tag) {
+        try {
+            Map result = cloudinary.api().deleteResourcesByTag(tag, ObjectUtils.asMap("resource_type", "raw"));
+            log.info("Deleted raw files with tag '{}': {}", tag, result);
+        } catch (Exception e) {
+            log.error("Failed to delete raw files by tag: {}", tag, e);
+        }
+    }
+
     /**
      * Get image info from Cloudinary
      */
@@ -0,0 +1,280 @@
+"""
+Micro-batching de la segmentación rembg.
+u2net (y u2netp, isnet) corren a una resolución de entrada fija, así que las
+imágenes de jobs distintos se pueden apilar en un solo tensor: cada job
+normaliza su imagen en su propio thread y la encola; un thread por modelo
+junta lo que llega en REMBG_BATCH_WINDOW_MS (hasta REMBG_MAX_BATCH
+imágenes), corre un único `session.run` con una sesión que usa todos los
+threads de la CPU y devuelve a cada job su predicción, que el job convierte
+en máscara a su tamaño.
+
+Los jobs pasan `BatchedSession` a `rembg.remove` en lugar de una sesión: el
+recorte, el alpha matting y el resto del postproceso de rembg no cambian.
+Si el modelo exportado tiene el batch fijo en 1, cada imagen corre por
+separado. `python -m app.batching` mide throughput contra latencia agregada.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.quantization import ModelVariant, model_version
+
+logger = logging.getLogger(__name__)
+
+# Crea la sesión de lotes de un modelo: (modelo, variante cuantizada o None) -> sesión rembg
+BatchSessionFactory = Callable[[str, Optional[ModelVariant]], Any]
+
+# (media, desvío, tamaño) de entrada por modelo, como los arma cada sesión rembg
+Normalization = Tuple[Tuple[float, ...], Tuple[float, ...], Tuple[int, int]]
+
+
+@dataclass
+class _Request:
+    feed: np.ndarray
+    enqueued: float = field(default_factory=time.perf_counter)
+    done: threading.Event = field(default_factory=threading.Event)
+    prediction: Optional[np.ndarray] = None
+    error: Optional[BaseException] = None
+
+
+@dataclass
+class _ModelBatcher:
+    session: Any
+    input_name: str
+    batchable: bool
+    requests: "queue.Queue[_Request]" = field(default_factory=queue.Queue)
+    worker: Optional[threading.Thread] = None
+    batches: int = 0
+    images: int = 0
+    run_seconds: float = 0.0
+    queue_seconds: float = 0.0
+    sizes: Counter = field(default_factory=Counter)
+
+
+class BatchedSession:
+    """Lo que `rembg.remove` usa de una sesión: `predict` con la máscara calculada en lote."""
+
+    def __init__(self, batcher: "SegmentationBatcher", model_name: str, variant: Optional[ModelVariant] = None):
+        self._batcher = batcher
+        self._model_name = model_name
+        self._variant = variant
+
+    def predict(self, img: Image.Image, *args, **kwargs) -> List[Image.Image]:
+        return [self._batcher.predict(self._model_name, self._variant, img)]
+
+
+class MaskSession:
+    """Sesión de `rembg.remove` con la máscara ya calculada (p. ej. en un lote del sidecar)."""
+
+    def __init__(self, mask: Image.Image):
+        self._mask = mask
+
+    def predict(self, img: Image.Image, *args, **kwargs) -> List[Image.Image]:
+        return [self._mask]
+
+
+class SegmentationBatcher:
+    """Junta las segmentaciones concurrentes de cada modelo en un solo `session.run`."""
+
+    def __init__(self, factory: BatchSessionFactory, normalization: Dict[str, Normalization], max_batch: int, window_ms: float):
+        self._factory = factory
+        self._normalization = normalization
+        self.max_batch = max(1, max_batch)
+        self.window_seconds = window_ms / 1000
+        self._models: Dict[str, _ModelBatcher] = {}
+        self._lock = threading.Lock()
+
+    def supports(self, model_name: str) -> bool:
+        """True si los jobs de este modelo se segmentan en lotes."""
+        return self.max_batch > 1 and model_name in self._normalization
+
+    def _model(self, model_name: str, variant: Optional[ModelVariant]) -> _ModelBatcher:
+        version = model_version(model_name, variant)
+        with self._lock:
+            batcher = self._models.get(version)
+            if batcher is None:
+                started = time.perf_counter()
+                session = self._factory(model_name, variant)
+                model_input = session.inner_session.get_inputs()[0]
+                # Un export con el batch fijo en 1 no acepta tensores apilados
+                batchable = not (isinstance(model_input.shape[0], int) and model_input.shape[0] == 1)
+                batcher = self._models[version] = _ModelBatcher(session, model_input.name, batchable)
+                logger.info(
+                    f"🔧 Sesión de lotes de {version} creada en {time.perf_counter() - started:.2f}s "
+                    f"({'batch dinámico' if batchable else 'batch fijo, una imagen por run'})"
+                )
+            return batcher
+
+    def preload(self, model_name: str, variant: Optional[ModelVariant] = None) -> None:
+        self._model(model_name, variant)
+
+    def is_loaded(self, model_name: str, variant: Optional[ModelVariant] = None) -> bool:
+        with self._lock:
+            return model_version(model_name, variant) in self._models
+
+    def _prepare(self, batcher: _ModelBatcher, model_name: str, image: Image.Image) -> np.ndarray:
+        """El input (1, 3, H, W) de la imagen, normalizado por la propia sesión rembg."""
+        mean, std, size = self._normalization[model_name]
+        return batcher.session.normalize(image, mean, std, size)[batcher.input_name]
+
+    def _infer(self, batcher: _ModelBatcher, feeds: List[np.ndarray]) -> np.ndarray:
+        """Predicciones (N, H, W) de un lote, en un solo run si el modelo lo permite."""
+        started = time.perf_counter()
+        if batcher.batchable:
+            predictions = batcher.session.inner_session.run(None, {batcher.input_name: np.concatenate(feeds)})[0][:, 0]
+        else:
+            predictions = np.concatenate([
+                batcher.session.inner_session.run(None, {batcher.input_name: feed})[0][:, 0] for feed in feeds
+            ])
+        with self._lock:
+            batcher.batches += 1
+            batcher.images += len(feeds)
+            batcher.run_seconds += time.perf_counter() - started
+            batcher.sizes[len(feeds)] += 1
+        return predictions
+
+    @staticmethod
+    def _mask(prediction: np.ndarray, size: Tuple[int, int]) -> Image.Image:
+        """Máscara L al tamaño de la imagen, con el mismo min-max por imagen que `predict` de rembg."""
+        low, high = float(prediction.min()), float(prediction.max())
+        prediction = (prediction - low) / max(high - low, 1e-6)
+        mask = Image.fromarray((prediction * 255).astype(np.uint8), mode="L")
+        return mask.resize(size, Image.Resampling.LANCZOS)
+
+    def run(self, model_name: str, variant: Optional[ModelVariant], images: List[Image.Image]) -> List[Image.Image]:
+        """Máscaras de un lote ya armado (p. ej. el del sidecar de inferencia), sin pasar por la cola."""
+        batcher = self._model(model_name, variant)
+        predictions = []
+        for start in range(0, len(images), self.max_batch):
+            chunk = images[start:start + self.max_batch]
+            predictions.extend(self._infer(batcher, [self._prepare(batcher, model_name, image) for image in chunk]))
+        return [self._mask(prediction, image.size) for prediction, image in zip(predictions, images)]
+
+    def predict(self, model_name: str, variant: Optional[ModelVariant], image: Image.Image) -> Image.Image:
+        """Máscara de una imagen, segmentada junto con las de los jobs que llegan en la misma ventana."""
+        batcher = self._model(model_name, variant)
+        request = _Request(self._prepare(batcher, model_name, image))
+        with self._lock:
+            if batcher.worker is None:
+                batcher.worker = threading.Thread(
+                    target=self._serve, args=(batcher,), name=f"rembg-batch-{model_version(model_name, variant)}", daemon=True
+                )
+                batcher.worker.start()
+        batcher.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return self._mask(request.prediction, image.size)
+
+    def _serve(self, batcher: _ModelBatcher) -> None:
+        while True:
+            batch = [batcher.requests.get()]
+            deadline = time.perf_counter() + self.window_seconds
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(batcher.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            started = time.perf_counter()
+            with self._lock:
+                batcher.queue_seconds += sum(started - request.enqueued for request in batch)
+            try:
+                predictions = self._infer(batcher, [request.feed for request in batch])
+                for request, prediction in zip(batch, predictions):
+                    request.prediction = prediction
+            except Exception as e:
+                logger.error(f"❌ Falló un lote de {len(batch)} segmentaciones: {e}")
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "max_batch": self.max_batch,
+                "window_ms": round(self.window_seconds * 1000, 2),
+                "models": {
+                    version: {
+                        "batchable": batcher.batchable,
+                        "batches": batcher.batches,
+                        "images": batcher.images,
+                        "mean_batch_size": round(batcher.images / max(1, batcher.batches), 2),
+                        "batch_sizes": dict(sorted(batcher.sizes.items())),
+                        "mean_run_ms": round(1000 * batcher.run_seconds / max(1, batcher.batches), 2),
+                        "mean_queue_ms": round(1000 * batcher.queue_seconds / max(1, batcher.images), 2),
+                        "pending": batcher.requests.qsize(),
+                    }
+                    for version, batcher in self._models.items()
+                },
+            }
+
+
+def benchmark(model_name: str, batch_sizes: List[int], window_ms: float, jobs: int, size: int = 1024) -> List[Dict[str, Any]]:
+    """
+    Throughput y latencia por job de `jobs` segmentaciones concurrentes para
+    cada tamaño de lote (1 = sin batching), con tantos jobs en vuelo como el lote.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from app.processing import REMBG_INPUT_NORMALIZATION, create_rembg_batch_session
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 255, (size, size, 3), dtype=np.uint8)) for _ in range(4)]
+    results = []
+    for max_batch in batch_sizes:
+        batcher = SegmentationBatcher(create_rembg_batch_session, REMBG_INPUT_NORMALIZATION, max_batch, window_ms)
+        batcher.run(model_name, None, images[:1])  # Carga y calentamiento
+
+        def job(index: int) -> float:
+            started = time.perf_counter()
+            if max_batch > 1:
+                batcher.predict(model_name, None, images[index % len(images)])
+            else:
+                batcher.run(model_name, None, [images[index % len(images)]])
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_batch) as executor:
+            latencies = sorted(executor.map(job, range(jobs)))
+        elapsed = time.perf_counter() - started
+        stats = batcher.snapshot()["models"].get(model_name, {})
+        results.append({
+            "max_batch": max_batch,
+            "window_ms": window_ms,
+            "images_per_second": round(jobs / elapsed, 3),
+            "p50_latency_ms": round(1000 * latencies[len(latencies) // 2], 1),
+            "p95_latency_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+            "mean_batch_size": stats.get("mean_batch_size"),
+            "mean_queue_ms": stats.get("mean_queue_ms"),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app.threads import thread_budget
+
+    parser = argparse.ArgumentParser(description="Throughput vs latencia de la segmentación en lotes")
+    parser.add_argument("--model", default="u2net")
+    parser.add_argument("--batch-sizes", default="1,2,4,8")
+    parser.add_argument("--window-ms", type=float, default=5.0)
+    parser.add_argument("--jobs", type=int, default=32)
+    args = parser.parse_args()
+
+    thread_budget.configure_libraries()
+    sizes = [int(size) for size in args.batch_sizes.split(",") if size.strip()]
+    print(json.dumps(benchmark(args.model, sizes, args.window_ms, args.jobs), indent=2))
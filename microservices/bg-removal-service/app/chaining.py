@@ -0,0 +1,233 @@
+"""
+Job chaining module.
+A chained job lists a sequence of operations in jobConfig["chain"] (e.g.
+background removal, then upscaling, then conversion to WebP). The service
+that receives it downloads and decodes the image once, runs every
+consecutive step it hosts on the decoded image in memory and uploads only
+the final result and its thumbnail. When the next step runs on another
+service, it uploads a single lossless intermediate and forwards the rest of
+the chain straight to that service's queue, without a round trip through
+the backend.
+
+IMAGE_CONVERSION is only an output encoding, so it runs as the last step of
+whichever service finishes the chain instead of costing another hop.
+"""
+
+import json
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import aio_pika
+from aio_pika.abc import AbstractExchange
+from PIL import Image
+
+from app.cloudinary_service import CloudinaryService
+from app.cancellation import cancellation_registry
+from app.config import CHAIN_ROUTING_KEYS
+from app.decoding import decode_image
+from app.encoding import encode_image, select_preset
+from app.admission import get_job_tier
+from app.thumbnails import publish_result
+
+logger = logging.getLogger(__name__)
+
+CHAIN_CONFIG_KEY = "chain"
+CONVERSION_STEP = "IMAGE_CONVERSION"
+
+# Steps some service can run in memory, plus the output conversion every service runs
+CHAINABLE_STEPS = ("BG_REMOVAL", "UPSCALE", CONVERSION_STEP)
+
+# Reason a job with a malformed or misrouted chain is failed with, without retrying it
+CHAIN_REASON = "INVALID_CHAIN"
+
+# Output formats of the final encode, by the names the conversion service accepts
+OUTPUT_FORMATS = {"PNG": "PNG", "JPEG": "JPEG", "JPG": "JPEG", "WEBP": "WEBP"}
+
+# Runs one step on a decoded image: (job_id, image, step config) -> (image, step info)
+ChainStepFn = Callable[[str, Image.Image, Dict[str, Any]], Tuple[Image.Image, Dict[str, Any]]]
+
+
+class ChainError(ValueError):
+    """Malformed or misrouted chain; not worth retrying."""
+
+
+@dataclass
+class ChainStep:
+    type: str
+    config: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class JobChain:
+    """The steps of a chained job, how far it got and what each finished step reported."""
+
+    steps: List[ChainStep]
+    position: int = 0
+    keep_intermediates: bool = False
+    results: List[Dict[str, Any]] = field(default_factory=list)
+
+    @classmethod
+    def from_config(cls, job_config: Optional[Dict[str, Any]]) -> Optional["JobChain"]:
+        """The chain in a job's config, or None for a regular job."""
+        raw = (job_config or {}).get(CHAIN_CONFIG_KEY)
+        if not raw:
+            return None
+        if isinstance(raw, list):
+            raw = {"steps": raw}
+        try:
+            steps = [ChainStep(str(step["type"]).upper(), dict(step.get("config") or {})) for step in raw["steps"]]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ChainError(f"Malformed chain: {e}")
+        for index, step in enumerate(steps):
+            if step.type not in CHAINABLE_STEPS:
+                raise ChainError(f"Step {step.type} can't be chained")
+            if step.type == CONVERSION_STEP and index != len(steps) - 1:
+                raise ChainError(f"{CONVERSION_STEP} must be the last step of a chain")
+        chain = cls(steps, int(raw.get("position", 0)), bool(raw.get("keepIntermediates", False)), list(raw.get("results", [])))
+        if not 0 <= chain.position < len(steps):
+            raise ChainError(f"Chain position {chain.position} out of range")
+        return chain
+
+    @property
+    def current(self) -> Optional[ChainStep]:
+        return self.steps[self.position] if self.position < len(self.steps) else None
+
+    @property
+    def finished(self) -> bool:
+        """True once only the output conversion, if any, is left."""
+        return self.current is None or self.current.type == CONVERSION_STEP
+
+    def step_config(self, job_config: Dict[str, Any]) -> Dict[str, Any]:
+        """Config of the current step: job-wide settings (tier, degraded mode) overridden by the step's own."""
+        base = {key: value for key, value in job_config.items() if key != CHAIN_CONFIG_KEY}
+        return {**base, **self.current.config}
+
+    def advance(self, info: Dict[str, Any]) -> None:
+        self.results.append({"step": self.current.type, **info})
+        self.position += 1
+
+    def to_config(self) -> Dict[str, Any]:
+        return {
+            "steps": [{"type": step.type, "config": step.config} for step in self.steps],
+            "position": self.position,
+            "keepIntermediates": self.keep_intermediates,
+            "results": self.results,
+        }
+
+
+async def perform_chained_job(
+    job_id: str,
+    image_url: str,
+    chain: JobChain,
+    steps: Dict[str, ChainStepFn],
+    config: Dict[str, Any]
+) -> Tuple[str, Dict[str, Any], JobChain]:
+    """
+    Run the chain's steps hosted here on one decoded image.
+
+    Args:
+        job_id: Unique job identifier
+        image_url: Cloudinary URL of the chain's input (the original or the previous hop's intermediate)
+        chain: The job's chain; advanced in place past the steps run here
+        steps: Step functions this service hosts, by step type
+        config: Job-wide config every step inherits
+
+    Returns:
+        Tuple of (image_url, processing_info, chain): the final result when
+        `chain.finished`, otherwise the intermediate the next service starts from
+    """
+    if chain.current.type not in steps:
+        raise ChainError(f"Chain step {chain.current.type} was routed to a service that doesn't host it")
+
+    cancellation_registry.check(job_id, "download")
+    image = decode_image(CloudinaryService.download_image_from_url(image_url))
+
+    while chain.current is not None and chain.current.type in steps:
+        step = chain.current
+        cancellation_registry.check(job_id, step.type.lower())
+        started = time.perf_counter()
+        image, info = steps[step.type](job_id, image, chain.step_config(config))
+        elapsed = time.perf_counter() - started
+        logger.info(f"🔗 Job {job_id} step {chain.position + 1}/{len(chain.steps)} ({step.type}) done in {elapsed:.2f}s")
+        chain.advance({**info, "seconds": round(elapsed, 3)})
+        if chain.keep_intermediates and not chain.finished and chain.current.type in steps:
+            url, _ = CloudinaryService.upload_processed_image(
+                encode_image(image, "PNG", "fast").data, job_id, f"chain_{chain.position}_{step.type.lower()}"
+            )
+            chain.results[-1]["intermediateUrl"] = url
+
+    cancellation_registry.check(job_id, "upload")
+
+    if not chain.finished:
+        # The next step runs elsewhere: hand it a lossless intermediate, encoded for speed
+        step_type = chain.results[-1]["step"]
+        url, public_id = CloudinaryService.upload_processed_image(
+            encode_image(image, "PNG", "fast").data, job_id, f"chain_{chain.position}_{step_type.lower()}"
+        )
+        if chain.keep_intermediates:
+            chain.results[-1]["intermediateUrl"] = url
+        logger.info(f"🔗 Job {job_id} handing off to {chain.current.type} with intermediate {public_id}")
+        return url, {"phase": "chain", "chainPosition": chain.position, "nextStep": chain.current.type}, chain
+
+    output_format = "PNG"
+    if chain.current is not None:
+        conversion = chain.step_config(config)
+        requested_format = str(conversion.get("target_format", "PNG")).upper()
+        if requested_format not in OUTPUT_FORMATS:
+            raise ChainError(f"Unsupported chain output format: {requested_format}")
+        output_format, quality = OUTPUT_FORMATS[requested_format], int(conversion.get("quality", 85))
+        # The step's quality is the lossy quality, so the preset follows the job-wide tier
+        encoded = encode_image(image, output_format, select_preset(conversion, get_job_tier(config)), quality)
+        chain.advance({"target_format": output_format, "quality": quality, "seconds": round(encoded.seconds, 3)})
+    else:
+        encoded = encode_image(image, "PNG", select_preset(config))
+    output_bytes = encoded.data
+
+    published = publish_result(job_id, output_bytes, f"chain_{output_format.lower()}", image)
+
+    processing_info = {
+        "processing_type": "chain",
+        "chain": chain.results,
+        "output_format": output_format,
+        "output_size": f"{image.width}x{image.height}",
+        "output_size_bytes": len(output_bytes),
+        "full_quality_public_id": published.public_id,
+        "thumbnail_public_id": published.thumbnail_public_id,
+        "thumbnail_url": published.thumbnail_url,
+        **encoded.to_params(),
+        **published.to_params(),
+    }
+    return published.url, processing_info, chain
+
+
+def chain_routing_key(step_type: str) -> str:
+    """Routing key of the service that hosts a step (CHAIN_ROUTING_KEYS)."""
+    if step_type not in CHAIN_ROUTING_KEYS:
+        raise ChainError(f"No routing key configured for chain step {step_type}")
+    return CHAIN_ROUTING_KEYS[step_type]
+
+
+async def forward_chain(exchange: AbstractExchange, job_message: Dict[str, Any], chain: JobChain, image_url: str) -> str:
+    """
+    Publish the rest of the chain to the next step's service, as a job of that
+    step's type starting from `image_url`. Returns the routing key used.
+    """
+    routing_key = chain_routing_key(chain.current.type)
+    message = {
+        **job_message,
+        "imageStoragePath": image_url,
+        "jobType": chain.current.type,
+        "jobConfig": {**(job_message.get("jobConfig") or {}), CHAIN_CONFIG_KEY: chain.to_config()},
+        "enqueuedAt": int(time.time() * 1000),
+    }
+    await exchange.publish(
+        aio_pika.Message(
+            body=json.dumps(message).encode("utf-8"),
+            content_type="application/json",
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+        ),
+        routing_key=routing_key
+    )
+    return routing_key
@@ -35,6 +35,198 @@ SPRING_BOOT_CALLBACK_URL_TEMPLATE = os.getenv(
 SERVICE_PORT = int(os.getenv("PORT", "8001"))
 SERVICE_HOST = os.getenv("HOST", "0.0.0.0")
 
+# Scheduling Configuration
+# Jobs with an estimated cost (input megapixels) up to SHORT_LANE_MAX_COST run in the short lane
+SHORT_LANE_WORKERS = int(os.getenv("SHORT_LANE_WORKERS", "1"))
+LONG_LANE_WORKERS = int(os.getenv("LONG_LANE_WORKERS", "1"))
+SHORT_LANE_MAX_COST = float(os.getenv("SHORT_LANE_MAX_COST", "4.0"))
+COST_PROBE_TIMEOUT = float(os.getenv("COST_PROBE_TIMEOUT", "3.0"))
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", str(SHORT_LANE_WORKERS + LONG_LANE_WORKERS + 2)))
+
+# Admission Configuration
+# Jobs queued longer than JOB_MAX_AGE_SECONDS are failed without processing (0 = only the message deadline applies)
+JOB_MAX_AGE_SECONDS = float(os.getenv("JOB_MAX_AGE_SECONDS", "0"))
+# FREE-tier jobs are shed while the queue stays at SHED_QUEUE_DEPTH or more for SHED_SUSTAIN_SECONDS (0 disables)
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "50"))
+SHED_RECOVERY_DEPTH = int(os.getenv("SHED_RECOVERY_DEPTH", str(SHED_QUEUE_DEPTH // 2)))
+SHED_SUSTAIN_SECONDS = float(os.getenv("SHED_SUSTAIN_SECONDS", "30"))
+# Cheaper processing modes start when queue depth reaches DEGRADE_ENTER_DEPTH or the estimated wait
+# (depth x mean service time / workers) reaches DEGRADE_ENTER_WAIT_SECONDS; they stop once both are below the exit values
+DEGRADE_ENTER_DEPTH = int(os.getenv("DEGRADE_ENTER_DEPTH", "20"))
+DEGRADE_EXIT_DEPTH = int(os.getenv("DEGRADE_EXIT_DEPTH", str(DEGRADE_ENTER_DEPTH // 4)))
+DEGRADE_ENTER_WAIT_SECONDS = float(os.getenv("DEGRADE_ENTER_WAIT_SECONDS", "60"))
+DEGRADE_EXIT_WAIT_SECONDS = float(os.getenv("DEGRADE_EXIT_WAIT_SECONDS", "15"))
+QUEUE_DEPTH_SAMPLE_INTERVAL = float(os.getenv("QUEUE_DEPTH_SAMPLE_INTERVAL", "5"))
+
+# Cancellation Configuration
+# Cancelled job ids are broadcast on a fanout exchange ({"jobId": ...}) and remembered for CANCELLED_JOB_TTL_SECONDS
+CANCEL_EXCHANGE_NAME = os.getenv("CANCEL_EXCHANGE_NAME", "job_cancellation_exchange")
+CANCELLED_JOB_TTL_SECONDS = float(os.getenv("CANCELLED_JOB_TTL_SECONDS", "3600"))
+
+# Memory Admission Configuration
+# Jobs wait until their estimated peak memory fits in available memory (psutil / cgroup limit) minus the headroom;
+# after MEMORY_ADMISSION_MAX_WAIT_SECONDS they run in degraded mode, or are requeued for another instance
+MEMORY_ADMISSION_ENABLED = os.getenv("MEMORY_ADMISSION_ENABLED", "true").lower() == "true"
+MEMORY_HEADROOM_MB = int(os.getenv("MEMORY_HEADROOM_MB", "512"))
+MEMORY_ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("MEMORY_ADMISSION_MAX_WAIT_SECONDS", "30"))
+MEMORY_POLL_INTERVAL_SECONDS = float(os.getenv("MEMORY_POLL_INTERVAL_SECONDS", "1.0"))
+
+# Drain Configuration
+# On shutdown (SIGTERM) or POST /admin/drain: stop consuming, give in-flight jobs DRAIN_GRACE_SECONDS to finish,
+# then flush status callbacks that couldn't be delivered (those are also retried every CALLBACK_RETRY_INTERVAL_SECONDS)
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "60"))
+CALLBACK_FLUSH_TIMEOUT_SECONDS = float(os.getenv("CALLBACK_FLUSH_TIMEOUT_SECONDS", "15"))
+CALLBACK_RETRY_INTERVAL_SECONDS = float(os.getenv("CALLBACK_RETRY_INTERVAL_SECONDS", "10"))
+CALLBACK_OUTBOX_MAX_SIZE = int(os.getenv("CALLBACK_OUTBOX_MAX_SIZE", "1000"))
+
+# Supervisor Configuration (python -m app.supervisor)
+# Loads models once and forks SUPERVISOR_WORKERS consumers sharing them copy-on-write; a worker is restarted
+# after WORKER_MAX_JOBS jobs (0 = never) or once its private (non-shared) memory exceeds WORKER_MAX_RSS_MB
+SUPERVISOR_WORKERS = int(os.getenv("SUPERVISOR_WORKERS", "4"))
+WORKER_MAX_JOBS = int(os.getenv("WORKER_MAX_JOBS", "200"))
+WORKER_MAX_RSS_MB = int(os.getenv("WORKER_MAX_RSS_MB", "2048"))
+SUPERVISOR_STATS_INTERVAL = float(os.getenv("SUPERVISOR_STATS_INTERVAL", "60"))
+
+# CPU Thread Budget Configuration
+# The usable CPUs (affinity mask capped by the cgroup quota) are split among CPU_JOB_SLOTS concurrent jobs;
+# torch, onnxruntime, OpenCV and the BLAS/OpenMP pools get CPU_THREADS_PER_SLOT threads each (0 = CPUs / slots).
+# CPU_PINNING binds every lane thread (and supervisor worker) to its own core set
+CPU_JOB_SLOTS = int(os.getenv("CPU_JOB_SLOTS", str(SHORT_LANE_WORKERS + LONG_LANE_WORKERS)))
+CPU_THREADS_PER_SLOT = int(os.getenv("CPU_THREADS_PER_SLOT", "0"))
+CPU_PINNING = os.getenv("CPU_PINNING", "false").lower() == "true"
+
+# Image Decode Configuration
+# Images whose header reports more than MAX_IMAGE_PIXELS pixels are rejected before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "64000000"))
+
+# Output Encoding Configuration
+# Results are encoded with their tier's preset (TIER=preset pairs, DEFAULT_ENCODE_PRESET otherwise): "fast" (least
+# CPU, larger files), "balanced" or "compact" (smallest files, most CPU); jobConfig["encode_preset"] overrides it.
+# PNGs of at least PARALLEL_ENCODE_MIN_PIXELS pixels are filtered and deflated in strips across the job slot's threads
+ENCODE_PRESETS = {
+    tier.strip().upper(): preset.strip().lower()
+    for tier, preset in (
+        item.split("=", 1) for item in os.getenv("ENCODE_PRESETS", "FREE=fast,PREMIUM=balanced").split(",") if "=" in item
+    )
+}
+DEFAULT_ENCODE_PRESET = os.getenv("DEFAULT_ENCODE_PRESET", "balanced").lower()
+PARALLEL_ENCODE_MIN_PIXELS = int(os.getenv("PARALLEL_ENCODE_MIN_PIXELS", "4000000"))
+
+# Thumbnail Configuration
+# THUMBNAIL_MODE "local" downscales the thumbnail from the result in memory and uploads it alongside the result;
+# "eager" uploads the result only, with Cloudinary deriving the thumbnail during that upload. Either way it fits
+# within THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT, as THUMBNAIL_FORMAT (webp keeps transparency, or jpeg)
+THUMBNAIL_MODE = os.getenv("THUMBNAIL_MODE", "local").lower()
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "400"))
+THUMBNAIL_HEIGHT = int(os.getenv("THUMBNAIL_HEIGHT", "300"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+
+# Model Routing Configuration (python -m app.routing)
+# Each tier segments with its REMBG_TIER_MODELS model (TIER=model pairs, REMBG_DEFAULT_MODEL otherwise): u2netp and
+# silueta are the light models, u2net and isnet-general-use the full ones. Signatures always use
+# REMBG_SIGNATURE_MODEL, and jobConfig["rembg_model"] (one of REMBG_MODELS) overrides both
+REMBG_TIER_MODELS = {
+    tier.strip().upper(): model.strip()
+    for tier, model in (
+        item.split("=", 1) for item in os.getenv("REMBG_TIER_MODELS", "FREE=u2netp,PREMIUM=u2net").split(",") if "=" in item
+    )
+}
+REMBG_DEFAULT_MODEL = os.getenv("REMBG_DEFAULT_MODEL", "u2net")
+REMBG_SIGNATURE_MODEL = os.getenv("REMBG_SIGNATURE_MODEL", "isnet-general-use")
+
+# rembg Session Pool Configuration (python -m app.sessions)
+# Each model keeps up to REMBG_SESSIONS_PER_MODEL sessions (one per CPU job slot by default), each used by one job
+# at a time; every model the routing can pick (Model Routing above, plus the degraded-mode model) is fully loaded
+# when a worker starts. Sessions run with the slot's thread budget, REMBG_GRAPH_OPTIMIZATION (all, extended, basic
+# or disabled) and, unless REMBG_ORT_ALLOW_SPINNING, intra-op threads that sleep instead of spinning between runs,
+# so idle sessions don't burn the cores of busy ones
+REMBG_SESSIONS_PER_MODEL = int(os.getenv("REMBG_SESSIONS_PER_MODEL", str(CPU_JOB_SLOTS)))
+REMBG_GRAPH_OPTIMIZATION = os.getenv("REMBG_GRAPH_OPTIMIZATION", "all").lower()
+REMBG_ORT_ALLOW_SPINNING = os.getenv("REMBG_ORT_ALLOW_SPINNING", "false").lower() == "true"
+
+# Segmentation Batching Configuration (python -m app.batching)
+# With REMBG_MAX_BATCH > 1, concurrent jobs of a fixed-input model (u2net, u2netp, isnet-general-use) are segmented
+# together: requests arriving within REMBG_BATCH_WINDOW_MS, up to REMBG_MAX_BATCH images, run as one batched
+# session.run on a session using every CPU. The inference sidecar batches rembg requests the same way
+REMBG_MAX_BATCH = int(os.getenv("REMBG_MAX_BATCH", "1"))
+REMBG_BATCH_WINDOW_MS = float(os.getenv("REMBG_BATCH_WINDOW_MS", "5"))
+
+# Cutout Configuration
+# The model sees a copy with its longer side at most CUTOUT_INFERENCE_MAX_SIDE; the mask is brought back to full size
+# by a guided filter (GUIDED_FILTER_RADIUS in mask pixels, GUIDED_FILTER_EPS: lower follows image edges more closely)
+# and applied to the original CUTOUT_TILE_ROWS rows at a time
+CUTOUT_INFERENCE_MAX_SIDE = int(os.getenv("CUTOUT_INFERENCE_MAX_SIDE", "1024"))
+CUTOUT_TILE_ROWS = int(os.getenv("CUTOUT_TILE_ROWS", "256"))
+GUIDED_FILTER_RADIUS = int(os.getenv("GUIDED_FILTER_RADIUS", "4"))
+GUIDED_FILTER_EPS = float(os.getenv("GUIDED_FILTER_EPS", "0.001"))
+
+# Edge Matting Configuration
+# Jobs with jobConfig["alpha_matting"] (ALPHA_MATTING_DEFAULT otherwise) refine hair/fur edges: only the
+# MATTING_TILE_SIZE tiles crossing a MATTING_BAND_PX band around the mask contour are matted, most edge first,
+# until MATTING_BUDGET_MS is spent; the rest keep the guided-filter alpha
+ALPHA_MATTING_DEFAULT = os.getenv("ALPHA_MATTING_DEFAULT", "false").lower() == "true"
+MATTING_BAND_PX = int(os.getenv("MATTING_BAND_PX", "8"))
+MATTING_TILE_SIZE = int(os.getenv("MATTING_TILE_SIZE", "256"))
+MATTING_BUDGET_MS = float(os.getenv("MATTING_BUDGET_MS", "1500"))
+
+# Mask Artifact Configuration
+# Every job's alpha is kept as an 8-bit PNG keyed by input hash, model and matting, in MASK_CACHE_DIR (least recently
+# used masks are dropped past MASK_CACHE_MAX_MB). With MASK_REMOTE_STORE, masks of edit jobs (jobConfig "composite"
+# or "keep_mask") are also uploaded to Cloudinary for other instances, tagged with the job so its cleanup deletes them.
+# Jobs with jobConfig["composite"] (color, blur or image background) reuse it and only composite
+MASK_CACHE_DIR = os.getenv("MASK_CACHE_DIR", "./cache/masks")
+MASK_CACHE_MAX_MB = int(os.getenv("MASK_CACHE_MAX_MB", "1024"))
+MASK_REMOTE_STORE = os.getenv("MASK_REMOTE_STORE", "false").lower() == "true"
+
+# Output Mode Configuration (python -m app.output)
+# jobConfig["output_mode"] (OUTPUT_MODE_DEFAULT otherwise): "png" full RGBA PNG, "webp" WebP with alpha (lossless at
+# OUTPUT_WEBP_QUALITY 100, lossy color over a lossless alpha below) or "mask" a grayscale PNG mask plus the original
+# as JPEG (OUTPUT_JPEG_QUALITY). jobConfig["output_crop"] (OUTPUT_CROP_DEFAULT) crops any of them to the pixels with
+# alpha above OUTPUT_CROP_ALPHA_THRESHOLD, plus OUTPUT_CROP_PADDING pixels
+OUTPUT_MODE_DEFAULT = os.getenv("OUTPUT_MODE_DEFAULT", "png").lower()
+OUTPUT_CROP_DEFAULT = os.getenv("OUTPUT_CROP_DEFAULT", "false").lower() == "true"
+OUTPUT_CROP_PADDING = int(os.getenv("OUTPUT_CROP_PADDING", "16"))
+OUTPUT_CROP_ALPHA_THRESHOLD = int(os.getenv("OUTPUT_CROP_ALPHA_THRESHOLD", "8"))
+OUTPUT_WEBP_QUALITY = int(os.getenv("OUTPUT_WEBP_QUALITY", "100"))
+OUTPUT_JPEG_QUALITY = int(os.getenv("OUTPUT_JPEG_QUALITY", "90"))
+
+# Signature Detection Configuration (python -m app.signature)
+# Signatures (routed to isnet-general-use) are told apart by a logistic classifier on features of the image reduced
+# to SIGNATURE_DETECT_MAX_SIDE; scores >= SIGNATURE_THRESHOLD are signatures. Weights trained on labelled images are
+# read from SIGNATURE_MODEL_PATH when it exists. With SIGNATURE_OCR_FALLBACK, scores within SIGNATURE_OCR_BAND of
+# the threshold are settled by the Tesseract heuristic (needs the tesseract binary). It stays on by default: the
+# built-in weights were only fit on synthetic images
+SIGNATURE_DETECT_MAX_SIDE = int(os.getenv("SIGNATURE_DETECT_MAX_SIDE", "512"))
+SIGNATURE_THRESHOLD = float(os.getenv("SIGNATURE_THRESHOLD", "0.5"))
+SIGNATURE_OCR_FALLBACK = os.getenv("SIGNATURE_OCR_FALLBACK", "true").lower() == "true"
+SIGNATURE_OCR_BAND = float(os.getenv("SIGNATURE_OCR_BAND", "0.15"))
+SIGNATURE_MODEL_PATH = os.getenv("SIGNATURE_MODEL_PATH", "./models/signature_classifier.json")
+
+# Model Quantization Configuration (python -m app.quantization)
+# INT8 variants and their manifest live in QUANTIZED_MODELS_DIR; jobs of the QUANTIZED_TIERS run a model's
+# enabled variant (one that passed its accuracy gate against FP32), every other job keeps the FP32 model
+QUANTIZED_MODELS_DIR = os.getenv("QUANTIZED_MODELS_DIR", "./models/quantized")
+QUANTIZED_TIERS = [tier.strip().upper() for tier in os.getenv("QUANTIZED_TIERS", "FREE").split(",") if tier.strip()]
+
+# Job Chaining Configuration
+# A job with jobConfig["chain"] runs its consecutive steps hosted here in memory; the rest of the chain is
+# forwarded to the service of the next step, found here as STEP=routing_key pairs
+CHAIN_ROUTING_KEYS = dict(
+    item.strip().split("=", 1)
+    for item in os.getenv("CHAIN_ROUTING_KEYS", "BG_REMOVAL=job.bg_removal,UPSCALE=job.upscaling").split(",")
+    if "=" in item
+)
+
+# Inference Sidecar Configuration (python -m app.inference)
+# With INFERENCE_SOCKET_PATH set, consumers send model calls to the sidecar holding the models over this Unix socket
+# (tensors go through shared memory) instead of loading them in-process; the sidecar listens on the same path.
+# Requests for a batchable model arriving within INFERENCE_BATCH_WINDOW_MS are run together, up to INFERENCE_MAX_BATCH
+INFERENCE_SOCKET_PATH = os.getenv("INFERENCE_SOCKET_PATH", "")
+INFERENCE_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "60"))
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "4"))
+INFERENCE_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "10"))
+
 # Optional: AI Model Configuration placeholder
 # AI_MODEL_PATH = os.getenv("AI_MODEL_PATH", "/app/models/bg_removal_model.onnx")
 
@@ -0,0 +1,264 @@
+"""
+Recorte a resolución completa con la máscara calculada a baja resolución.
+`rembg.remove` normaliza la imagen entera, agranda la máscara con LANCZOS y
+compone un RGBA nuevo a tamaño completo. Acá el modelo corre sobre una copia
+reducida (lado mayor CUTOUT_INFERENCE_MAX_SIDE) y la máscara vuelve a tamaño
+completo con un guided filter rápido: los coeficientes lineales (a, b) se
+calculan a baja resolución contra la luminancia de la copia, se interpolan
+y se aplican sobre la luminancia original, así los bordes siguen los de la
+imagen y no los píxeles de la máscara reducida.
+
+El alpha se escribe por franjas de CUTOUT_TILE_ROWS filas en un único buffer
+RGBA, así que los temporales en float no crecen con la imagen (50 MP
+incluidos), y el RGBA va directo al encoder, sin PNG intermedio.
+
+Opcionalmente (pelo, pelaje) el borde se refina con matting, pero solo en
+los tiles que cruza la banda alrededor del contorno de la máscara y hasta
+agotar MATTING_BUDGET_MS: el costo crece con el largo del borde y no con el
+área de la imagen.
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.config import (
+    CUTOUT_INFERENCE_MAX_SIDE,
+    CUTOUT_TILE_ROWS,
+    GUIDED_FILTER_RADIUS,
+    GUIDED_FILTER_EPS,
+    MATTING_BAND_PX,
+    MATTING_TILE_SIZE,
+    MATTING_BUDGET_MS,
+)
+from app.thumbnails import downscale
+
+logger = logging.getLogger(__name__)
+
+# Fondo y frente tienen que diferir al menos esto (distancia RGB al cuadrado, 0-3) para estimar el alpha por color
+MATTING_MIN_COLOR_DISTANCE = 0.01
+
+# Calcula la máscara L de una imagen RGB (p. ej. `lambda image: session.predict(image)[0]`)
+MaskPredictor = Callable[[Image.Image], Image.Image]
+
+
+def _box(image: np.ndarray, radius: int) -> np.ndarray:
+    return cv2.boxFilter(image, -1, (2 * radius + 1, 2 * radius + 1), borderType=cv2.BORDER_REFLECT)
+
+
+def _luminance(rgb: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY).astype(np.float32) * (1.0 / 255.0)
+
+
+def guided_coefficients(guide: np.ndarray, mask: np.ndarray, radius: int, eps: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Coeficientes (a, b) promediados del guided filter de `mask` (float 0-1)
+    guiado por `guide` (luminancia 0-1): la máscara filtrada es a * guide + b.
+    """
+    mean_guide = _box(guide, radius)
+    mean_mask = _box(mask, radius)
+    variance = _box(guide * guide, radius) - mean_guide * mean_guide
+    covariance = _box(guide * mask, radius) - mean_guide * mean_mask
+    a = covariance / (variance + eps)
+    b = mean_mask - a * mean_guide
+    return _box(a, radius), _box(b, radius)
+
+
+def _rows_map(y0: int, y1: int, width: int, scale_x: float, scale_y: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Coordenadas en baja resolución de las filas [y0, y1) a tamaño completo (centros de píxel alineados)."""
+    map_x = ((np.arange(width, dtype=np.float32) + 0.5) * scale_x - 0.5)[None, :]
+    map_y = ((np.arange(y0, y1, dtype=np.float32) + 0.5) * scale_y - 0.5)[:, None]
+    return np.repeat(map_x, y1 - y0, axis=0), np.repeat(map_y, width, axis=1)
+
+
+def apply_alpha(
+    image: Image.Image,
+    mask: Image.Image,
+    guide: Optional[np.ndarray] = None,
+    radius: int = GUIDED_FILTER_RADIUS,
+    eps: float = GUIDED_FILTER_EPS,
+    tile_rows: int = CUTOUT_TILE_ROWS
+) -> np.ndarray:
+    """
+    RGBA a tamaño completo con el alpha de `mask`.
+
+    Args:
+        image: Imagen original, a tamaño completo
+        mask: Máscara L; si es más chica que la imagen, se agranda con el guided filter
+        guide: Luminancia (0-1) de la imagen sobre la que se calculó la máscara, a su tamaño
+        radius: Radio del guided filter, en píxeles de la máscara
+        eps: Regularización: más chico sigue más de cerca los bordes de la imagen
+        tile_rows: Filas por franja
+
+    Returns:
+        Array HxWx4 uint8 (RGB sin tocar salvo donde el alpha es 0, que queda en negro)
+    """
+    width, height = image.size
+    output = np.empty((height, width, 4), np.uint8)
+    low_mask = np.asarray(mask.convert("L"), np.float32) * (1.0 / 255.0)
+    upsample = mask.size != image.size
+    if upsample:
+        a, b = guided_coefficients(guide, low_mask, radius, eps)
+        scale_x, scale_y = mask.width / width, mask.height / height
+    has_alpha = "A" in image.getbands()
+
+    for y0 in range(0, height, tile_rows):
+        y1 = min(height, y0 + tile_rows)
+        tile = image.crop((0, y0, width, y1))
+        rgb = np.asarray(tile.convert("RGB"))
+        if upsample:
+            map_x, map_y = _rows_map(y0, y1, width, scale_x, scale_y)
+            tile_a = cv2.remap(a, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            tile_b = cv2.remap(b, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+            alpha = tile_a * _luminance(rgb) + tile_b
+            alpha = np.clip(alpha * 255.0 + 0.5, 0, 255).astype(np.uint8)
+        else:
+            alpha = np.asarray(mask.crop((0, y0, width, y1)).convert("L"))
+        if has_alpha:
+            # Lo que ya era transparente en el original sigue siéndolo
+            alpha = np.minimum(alpha, np.asarray(tile.getchannel("A")))
+        output[y0:y1, :, :3] = rgb
+        output[y0:y1, :, 3] = alpha
+        # El color bajo alpha 0 no se ve: en negro comprime mejor
+        output[y0:y1, :, :3][alpha == 0] = 0
+    return output
+
+
+def edge_tiles(mask: Image.Image, size: Tuple[int, int], band: int, tile_size: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Tiles (x0, y0, x1, y1) de la imagen a tamaño `size` que cruza la banda de
+    `band` píxeles alrededor del contorno de la máscara, primero los de más borde.
+    """
+    binary = (np.asarray(mask.convert("L")) >= 128).astype(np.uint8)
+    scale_x, scale_y = size[0] / mask.width, size[1] / mask.height
+    # La banda, en píxeles de la máscara
+    reach = max(1, int(np.ceil(band / min(scale_x, scale_y))))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * reach + 1, 2 * reach + 1))
+    ys, xs = np.nonzero(cv2.dilate(binary, kernel) != cv2.erode(binary, kernel))
+    if len(xs) == 0:
+        return []
+    columns = -(-size[0] // tile_size)
+    tile_ids = (((ys + 0.5) * scale_y).astype(np.int64) // tile_size) * columns + ((xs + 0.5) * scale_x).astype(np.int64) // tile_size
+    ids, counts = np.unique(tile_ids, return_counts=True)
+    tiles = []
+    for tile_id in ids[np.argsort(-counts, kind="stable")]:
+        x0, y0 = int(tile_id % columns) * tile_size, int(tile_id // columns) * tile_size
+        tiles.append((x0, y0, min(size[0], x0 + tile_size), min(size[1], y0 + tile_size)))
+    return tiles
+
+
+def matte_tile(rgb: np.ndarray, alpha: np.ndarray, band: int) -> np.ndarray:
+    """
+    Alpha refinado de un tile: trimap con una banda desconocida de `band`
+    píxeles a cada lado del contorno; en la banda, frente y fondo son el color
+    medio de los píxeles seguros de cada lado en la vecindad, el alpha la
+    proyección del píxel sobre la recta fondo-frente, suavizado con el guided
+    filter. Donde frente y fondo no se distinguen por color queda el alpha de entrada.
+    """
+    binary = (alpha >= 128).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2 * band + 1, 2 * band + 1))
+    foreground = cv2.erode(binary, kernel).astype(np.float32)
+    background = 1.0 - cv2.dilate(binary, kernel).astype(np.float32)
+    unknown = (foreground == 0) & (background == 0)
+    if not unknown.any():
+        return alpha
+
+    image = rgb.astype(np.float32) * (1.0 / 255.0)
+    window = 2 * band
+    weight_fg = _box(foreground, window)
+    weight_bg = _box(background, window)
+    mean_fg = _box(image * foreground[..., None], window) / np.maximum(weight_fg, 1e-6)[..., None]
+    mean_bg = _box(image * background[..., None], window) / np.maximum(weight_bg, 1e-6)[..., None]
+    difference = mean_fg - mean_bg
+    distance = np.sum(difference * difference, axis=2)
+    estimate = np.clip(np.sum((image - mean_bg) * difference, axis=2) / np.maximum(distance, 1e-6), 0.0, 1.0)
+
+    refined = alpha.astype(np.float32) * (1.0 / 255.0)
+    valid = unknown & (weight_fg > 1e-3) & (weight_bg > 1e-3) & (distance > MATTING_MIN_COLOR_DISTANCE)
+    refined[valid] = estimate[valid]
+    a, b = guided_coefficients(_luminance(rgb), refined, 2, 1e-4)
+    smoothed = a * _luminance(rgb) + b
+    refined[unknown] = smoothed[unknown]
+    return np.clip(refined * 255.0 + 0.5, 0, 255).astype(np.uint8)
+
+
+def refine_edges(
+    image: Image.Image,
+    output: np.ndarray,
+    mask: Image.Image,
+    band: int = MATTING_BAND_PX,
+    tile_size: int = MATTING_TILE_SIZE,
+    budget_ms: float = MATTING_BUDGET_MS
+) -> Dict[str, Any]:
+    """
+    Matting de los tiles del borde, sobre el RGBA de `apply_alpha` (in place),
+    hasta agotar `budget_ms`; los tiles que quedan conservan el alpha del
+    guided filter. El color de cada tile sale de `image`, no de `output`.
+    """
+    started = time.perf_counter()
+    width, height = image.size
+    # Al agrandar la máscara, el borde incierto es tan ancho como el factor de escala
+    band = max(band, int(round(2 * max(width / mask.width, height / mask.height))))
+    tiles = edge_tiles(mask, image.size, band, tile_size)
+    pad = 3 * band
+    done = 0
+    for x0, y0, x1, y1 in tiles:
+        if (time.perf_counter() - started) * 1000 >= budget_ms:
+            break
+        # Con contexto alrededor para que los colores de frente y fondo salgan de la vecindad
+        px0, py0, px1, py1 = max(0, x0 - pad), max(0, y0 - pad), min(width, x1 + pad), min(height, y1 + pad)
+        rgb = np.asarray(image.crop((px0, py0, px1, py1)).convert("RGB"))
+        refined = matte_tile(rgb, output[py0:py1, px0:px1, 3], band)
+        inner = (slice(y0 - py0, y1 - py0), slice(x0 - px0, x1 - px0))
+        alpha = refined[inner]
+        output[y0:y1, x0:x1, :3] = rgb[inner]
+        output[y0:y1, x0:x1, 3] = alpha
+        output[y0:y1, x0:x1, :3][alpha == 0] = 0
+        done += 1
+    return {
+        "matting_tiles": done,
+        "matting_tiles_skipped": len(tiles) - done,
+        "matting_band_px": band,
+        "matting_seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def cut_out(
+    image: Image.Image,
+    predict_mask: MaskPredictor,
+    max_side: int = CUTOUT_INFERENCE_MAX_SIDE,
+    matting: bool = False
+) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    Quita el fondo de `image` corriendo el modelo sobre una copia reducida.
+
+    Args:
+        image: Imagen decodificada, a tamaño completo
+        predict_mask: Segmentación (sesión del pool, lote o sidecar)
+        max_side: Lado mayor de la copia que ve el modelo
+        matting: Refinar los bordes con `refine_edges`
+
+    Returns:
+        Tuple of (RGBA a tamaño completo, info del recorte para processingParams)
+    """
+    started = time.perf_counter()
+    small = downscale(image, (max_side, max_side)).convert("RGB")
+    mask = predict_mask(small)
+    if mask.size != small.size:
+        mask = mask.resize(small.size, Image.Resampling.BILINEAR)
+    segmented = time.perf_counter()
+
+    guide = _luminance(np.asarray(small)) if small.size != image.size else None
+    pixels = apply_alpha(image, mask, guide)
+    info = {
+        "inference_size": f"{small.width}x{small.height}",
+        "segmentation_seconds": round(segmented - started, 3),
+        "alpha_seconds": round(time.perf_counter() - segmented, 3),
+    }
+    if matting:
+        info.update(refine_edges(image, pixels, mask))
+    return Image.fromarray(pixels, "RGBA"), info
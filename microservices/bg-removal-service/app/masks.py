@@ -0,0 +1,245 @@
+"""
+Máscaras reutilizables y ediciones sobre el recorte.
+El alpha de cada job se guarda como PNG de 8 bits (escala de grises) con una
+clave que sale del hash de la imagen de entrada, el modelo y si hubo
+matting: en un directorio local acotado (MASK_CACHE_DIR, LRU). Con
+MASK_REMOTE_STORE, las máscaras de los jobs de edición (jobConfig["composite"]
+o ["keep_mask"]) se suben también a Cloudinary para las demás instancias, con
+el tag del job para que la limpieza del backend las borre junto al resultado.
+
+Un job que vuelve sobre la misma imagen (jobConfig["composite"]) no segmenta
+de nuevo: toma la máscara guardada y solo compone, vectorizado por franjas:
+- {"mode": "color", "color": "#ffffff"}: fondo de un color;
+- {"mode": "blur", "radius": 25}: el original desenfocado detrás del sujeto;
+- {"mode": "image", "background_url": ...}: otra imagen de fondo, recortada
+  para cubrir el cuadro.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.cloudinary_service import CloudinaryService
+from app.config import MASK_CACHE_DIR, MASK_CACHE_MAX_MB, MASK_REMOTE_STORE, CUTOUT_TILE_ROWS
+from app.decoding import decode_image
+
+logger = logging.getLogger(__name__)
+
+COMPOSITE_MODES = ("color", "blur", "image")
+
+# Motivo con el que se marca FAILED un job con una composición mal formada
+COMPOSITE_REASON = "INVALID_COMPOSITE"
+
+# El desenfoque se calcula sobre una copia con este lado menor y se vuelve a agrandar
+BLUR_WORKING_SIDE = 512
+DEFAULT_BLUR_RADIUS = 25
+
+# Las subidas a Cloudinary no demoran el job
+_upload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mask-upload")
+
+
+class CompositeError(ValueError):
+    """Operación de composición mal formada; no vale la pena reintentar."""
+
+
+def mask_key(data: bytes, model_version: str, matting: bool) -> str:
+    """Clave de la máscara de una imagen de entrada: hash del archivo, modelo y matting."""
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    return f"{digest}_{model_version.replace(':', '-')}{'_matting' if matting else ''}"
+
+
+def encode_mask(alpha: np.ndarray) -> bytes:
+    """PNG de 8 bits en escala de grises; las máscaras son casi todo 0 o 255 y comprimen mucho."""
+    buffer = io.BytesIO()
+    Image.fromarray(alpha, "L").save(buffer, format="PNG", compress_level=6)
+    return buffer.getvalue()
+
+
+class MaskStore:
+    """Máscaras por clave: directorio local con tope de tamaño y, opcionalmente, Cloudinary."""
+
+    def __init__(self, directory: str, max_mb: int, remote: bool):
+        self.directory = directory
+        self.max_bytes = max_mb * 1024 * 1024
+        self.remote = remote
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "remote_hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        self._used_bytes: Optional[int] = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key: str, remote: bool = False) -> Optional[np.ndarray]:
+        """Alpha HxW uint8 guardado bajo `key`, buscando en Cloudinary solo con `remote`."""
+        path = self._path(key)
+        data = None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # Para el LRU
+            self._count("hits")
+        except FileNotFoundError:
+            if remote and self.remote:
+                try:
+                    data = CloudinaryService.download_image_from_url(CloudinaryService.mask_url(key))
+                    self._write_local(key, data)
+                    self._count("remote_hits")
+                except Exception as e:
+                    logger.debug(f"Máscara {key} no está en Cloudinary: {e}")
+        if data is None:
+            self._count("misses")
+            return None
+        return np.asarray(decode_image(data).convert("L"))
+
+    def put(self, key: str, alpha: np.ndarray, job_id: Optional[str] = None) -> Optional[str]:
+        """
+        Guarda el alpha localmente y, con MASK_REMOTE_STORE y un `job_id`, lo sube
+        en segundo plano con el tag del job. Devuelve el public id remoto, si se sube.
+        """
+        data = encode_mask(alpha)
+        self._write_local(key, data)
+        self._count("stored")
+        if not (self.remote and job_id):
+            return None
+        _upload_executor.submit(self._upload, key, data, job_id)
+        return CloudinaryService.mask_public_id(key)
+
+    def _upload(self, key: str, data: bytes, job_id: str) -> None:
+        try:
+            CloudinaryService.upload_mask(data, key, job_id)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo subir la máscara {key}: {e}")
+
+    def _write_local(self, key: str, data: bytes) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        # Atómico: otro worker puede estar leyendo la misma clave
+        os.replace(temporary, self._path(key))
+        with self._lock:
+            if self._used_bytes is None:
+                self._used_bytes = self._scan()[1]
+            else:
+                self._used_bytes += len(data)
+            if self._used_bytes > self.max_bytes:
+                self._evict()
+
+    def _scan(self) -> Tuple[list, int]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".png"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries, sum(size for _, size, _ in entries)
+
+    def _evict(self) -> None:
+        """Borra las menos usadas hasta quedar en el 90% del tope (el directorio lo comparten los workers)."""
+        entries, used = self._scan()
+        for _, size, name in sorted(entries):
+            if used <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                used -= size
+                self._stats["evicted"] += 1
+            except FileNotFoundError:
+                continue
+        self._used_bytes = used
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "max_mb": self.max_bytes // (1024 * 1024),
+                "used_mb": round((self._used_bytes or 0) / (1024 * 1024), 1),
+                "remote": self.remote,
+                **self._stats,
+            }
+
+
+mask_store = MaskStore(MASK_CACHE_DIR, MASK_CACHE_MAX_MB, MASK_REMOTE_STORE)
+
+
+def parse_color(value: Any) -> Tuple[int, int, int]:
+    """'#rrggbb', 'rrggbb', 'r,g,b' o [r, g, b]."""
+    try:
+        if isinstance(value, (list, tuple)):
+            red, green, blue = (int(channel) for channel in value)
+        else:
+            text = str(value).strip().lstrip("#")
+            if "," in text:
+                red, green, blue = (int(channel) for channel in text.split(","))
+            else:
+                red, green, blue = int(text[0:2], 16), int(text[2:4], 16), int(text[4:6], 16)
+    except (ValueError, TypeError, IndexError):
+        raise CompositeError(f"Color inválido: {value!r}")
+    return tuple(max(0, min(255, channel)) for channel in (red, green, blue))
+
+
+def _background(image: Image.Image, operation: Dict[str, Any]) -> Any:
+    """Fondo de la composición: color RGB (se difunde por broadcasting) o array HxWx3 del tamaño de la imagen."""
+    mode = operation.get("mode")
+    if mode == "color":
+        return np.array(parse_color(operation.get("color", "#ffffff")), np.uint8)
+    if mode == "blur":
+        try:
+            radius = float(operation.get("radius", DEFAULT_BLUR_RADIUS))
+        except (ValueError, TypeError):
+            raise CompositeError(f"Radio de desenfoque inválido: {operation.get('radius')!r}")
+        # Desenfocar una copia chica y agrandarla cuesta lo mismo a 1 MP que a 50 MP
+        factor = max(1.0, min(image.size) / BLUR_WORKING_SIDE)
+        small = np.asarray(image.convert("RGB").resize(
+            (max(1, round(image.width / factor)), max(1, round(image.height / factor))), Image.Resampling.BOX
+        ))
+        blurred = cv2.GaussianBlur(small, (0, 0), max(0.5, radius / factor))
+        return cv2.resize(blurred, image.size, interpolation=cv2.INTER_LINEAR)
+    if mode == "image":
+        url = operation.get("background_url")
+        if not url:
+            raise CompositeError("composite image sin background_url")
+        background = decode_image(CloudinaryService.download_image_from_url(url), max_side=max(image.size)).convert("RGB")
+        return np.asarray(ImageOps.fit(background, image.size, Image.Resampling.LANCZOS))
+    raise CompositeError(f"Modo de composición desconocido: {mode!r} (válidos: {', '.join(COMPOSITE_MODES)})")
+
+
+def composite(image: Image.Image, alpha: np.ndarray, operation: Dict[str, Any], tile_rows: int = CUTOUT_TILE_ROWS) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    El sujeto de `image` (según `alpha`, HxW uint8) sobre el fondo de `operation`.
+
+    Returns:
+        Tuple of (imagen RGB opaca, info para processingParams)
+    """
+    started = time.perf_counter()
+    background = _background(image, operation)
+    prepared = time.perf_counter()
+    width, height = image.size
+    output = np.empty((height, width, 3), np.uint8)
+    for y0 in range(0, height, tile_rows):
+        y1 = min(height, y0 + tile_rows)
+        foreground = np.asarray(image.crop((0, y0, width, y1)).convert("RGB"), np.float32)
+        weight = alpha[y0:y1, :, None].astype(np.float32) * (1.0 / 255.0)
+        behind = background if background.ndim == 1 else background[y0:y1]
+        output[y0:y1] = np.clip(behind + (foreground - behind) * weight + 0.5, 0, 255).astype(np.uint8)
+    info = {
+        "composite_mode": operation.get("mode"),
+        "composite_background_seconds": round(prepared - started, 3),
+        "composite_seconds": round(time.perf_counter() - started, 3),
+    }
+    return Image.fromarray(output, "RGB"), info
@@ -0,0 +1,189 @@
+"""
+Modos de salida del recorte.
+Un PNG RGBA del tamaño completo paga sobre todo píxeles transparentes; según
+jobConfig["output_mode"] el resultado se entrega como:
+- "png": el RGBA completo (el comportamiento de siempre);
+- "webp": WebP con alpha, sin pérdida con OUTPUT_WEBP_QUALITY 100 o con el
+  color con pérdida sobre un alpha sin pérdida por debajo;
+- "mask": una máscara PNG en escala de grises más el original en JPEG, que
+  el frontend compone (CSS mask-image o canvas).
+Con jobConfig["output_crop"] cualquiera de ellos se recorta a la caja del
+sujeto (alpha por encima de OUTPUT_CROP_ALPHA_THRESHOLD) más un margen.
+Cada modo informa bytes y tiempo de encode; `python -m app.output` los
+compara sobre un recorte ya hecho.
+"""
+
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.encoding import EncodedImage, encode_image
+from app.config import (
+    OUTPUT_MODE_DEFAULT,
+    OUTPUT_CROP_DEFAULT,
+    OUTPUT_CROP_PADDING,
+    OUTPUT_CROP_ALPHA_THRESHOLD,
+    OUTPUT_WEBP_QUALITY,
+    OUTPUT_JPEG_QUALITY,
+)
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_MODES = ("png", "webp", "mask")
+
+# Sufijo del public id del archivo principal, por modo
+OUTPUT_SUFFIXES = {"png": "bg_removed", "webp": "bg_removed", "mask": "bg_original"}
+
+Box = Tuple[int, int, int, int]
+
+
+@dataclass
+class PackagedOutput:
+    mode: str
+    encoded: EncodedImage
+    mask: Optional[EncodedImage]
+    image: Image.Image
+    crop_box: Optional[Box]
+    full_size: Tuple[int, int]
+
+    @property
+    def suffix(self) -> str:
+        return OUTPUT_SUFFIXES[self.mode]
+
+    def to_params(self) -> Dict[str, Any]:
+        """Modo de salida, recorte y encode de la máscara para processingParams."""
+        params: Dict[str, Any] = {
+            "output_mode": self.mode,
+            "output_width": self.image.width,
+            "output_height": self.image.height,
+            "output_crop_box": list(self.crop_box) if self.crop_box else None,
+            "output_pixel_ratio": round(
+                (self.image.width * self.image.height) / max(1, self.full_size[0] * self.full_size[1]), 4
+            ),
+        }
+        if self.mask is not None:
+            params.update({
+                "mask_encode_bytes": len(self.mask.data),
+                "mask_encode_seconds": round(self.mask.seconds, 3),
+                "output_total_bytes": len(self.encoded.data) + len(self.mask.data),
+            })
+        return params
+
+
+def select_output_mode(config: Dict[str, Any]) -> str:
+    """Modo pedido por el job, OUTPUT_MODE_DEFAULT si no pidió uno válido."""
+    requested = str(config.get("output_mode") or "").lower()
+    if requested in OUTPUT_MODES:
+        return requested
+    return OUTPUT_MODE_DEFAULT if OUTPUT_MODE_DEFAULT in OUTPUT_MODES else "png"
+
+
+def crop_box(alpha: np.ndarray, padding: int = OUTPUT_CROP_PADDING, threshold: int = OUTPUT_CROP_ALPHA_THRESHOLD) -> Optional[Box]:
+    """
+    Caja (left, top, right, bottom) del sujeto con `padding` píxeles de margen,
+    o None si no queda nada visible (la salida conserva entonces el tamaño completo).
+    """
+    height, width = alpha.shape[:2]
+    visible = alpha > threshold
+    rows = np.flatnonzero(visible.any(axis=1))
+    if rows.size == 0:
+        return None
+    columns = np.flatnonzero(visible[rows[0]:rows[-1] + 1].any(axis=0))
+    return (
+        max(0, int(columns[0]) - padding),
+        max(0, int(rows[0]) - padding),
+        min(width, int(columns[-1]) + 1 + padding),
+        min(height, int(rows[-1]) + 1 + padding),
+    )
+
+
+def package_output(
+    cutout: Image.Image,
+    original: Image.Image,
+    config: Dict[str, Any],
+    preset: str,
+    mode: Optional[str] = None,
+    crop: Optional[bool] = None,
+) -> PackagedOutput:
+    """
+    Encode del recorte en el modo de salida del job.
+
+    Args:
+        cutout: Recorte RGBA del tamaño del original
+        original: Imagen de entrada, para el JPEG del modo "mask"
+        config: jobConfig del trabajo
+        preset: Preset de encode ("fast", "balanced" o "compact")
+        mode: Modo de salida; el del job por defecto
+        crop: Si recortar a la caja del sujeto; jobConfig["output_crop"] por defecto
+
+    Returns:
+        El archivo principal, la máscara (modo "mask") y la imagen para el thumbnail
+    """
+    mode = mode or select_output_mode(config)
+    crop = bool(config.get("output_crop", OUTPUT_CROP_DEFAULT)) if crop is None else crop
+    full_size = cutout.size
+
+    box = None
+    if crop:
+        started = time.perf_counter()
+        padding = int(config.get("output_crop_padding", OUTPUT_CROP_PADDING))
+        box = crop_box(np.asarray(cutout.getchannel("A")), max(0, padding))
+        if box is not None and box != (0, 0) + full_size:
+            cutout = cutout.crop(box)
+            logger.info(
+                f"✂️ Recorte a {cutout.width}x{cutout.height} de {full_size[0]}x{full_size[1]} "
+                f"en {time.perf_counter() - started:.3f}s"
+            )
+        else:
+            box = None
+
+    mask = None
+    if mode == "webp":
+        encoded = encode_image(cutout, "WEBP", preset, int(config.get("output_quality", OUTPUT_WEBP_QUALITY)))
+    elif mode == "mask":
+        # El frontend compone el JPEG con la máscara; ninguno de los dos carga píxeles transparentes
+        base = original.crop(box) if box is not None else original
+        encoded = encode_image(base, "JPEG", preset, int(config.get("output_quality", OUTPUT_JPEG_QUALITY)))
+        mask = encode_image(cutout.getchannel("A"), "PNG", preset)
+    else:
+        encoded = encode_image(cutout, "PNG", preset)
+    return PackagedOutput(mode, encoded, mask, cutout, box, full_size)
+
+
+def benchmark(cutout: Image.Image, preset: str = "balanced") -> list:
+    """Bytes y tiempo de encode de cada modo, con y sin recorte, sobre un recorte RGBA."""
+    cutout = cutout.convert("RGBA")
+    original = cutout.convert("RGB")
+    results = []
+    for crop in (False, True):
+        for mode in OUTPUT_MODES:
+            packaged = package_output(cutout, original, {}, preset, mode, crop)
+            total = len(packaged.encoded.data) + (len(packaged.mask.data) if packaged.mask else 0)
+            seconds = packaged.encoded.seconds + (packaged.mask.seconds if packaged.mask else 0.0)
+            results.append({
+                "mode": mode,
+                "crop": crop,
+                "bytes": total,
+                "encode_seconds": round(seconds, 3),
+                "size": f"{packaged.image.width}x{packaged.image.height}",
+            })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app.threads import thread_budget
+
+    parser = argparse.ArgumentParser(description="Bytes y tiempo de encode de cada modo de salida")
+    parser.add_argument("cutout", help="PNG RGBA de un recorte")
+    parser.add_argument("--preset", default="balanced")
+    args = parser.parse_args()
+
+    thread_budget.configure_libraries()
+    print(json.dumps(benchmark(Image.open(args.cutout), args.preset), indent=2))
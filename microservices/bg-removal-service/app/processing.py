@@ -1,30 +1,84 @@
 """
 Image processing module for background removal with Cloudinary integration.
 Implements full-quality and low-quality thumbnail generation.
-Uses enhanced OCR optimized for signature detection (white background with dark line).
+Detects signatures (white background with dark line) with a lightweight classifier (app.signature).
 FIXED: Job tracking and duplicate prevention system.
 """
 
 import logging
 import time
 import traceback
-from typing import Dict, Tuple, Any, Set
-import io
+from typing import Dict, Tuple, Any, Set, Optional, Iterator, List
+from contextlib import contextmanager
 import threading
-from PIL import Image, ImageFilter
+from PIL import Image
 from rembg import remove, new_session
-import pytesseract
+from rembg.sessions import sessions_class
 import numpy as np
 
 from app.cloudinary_service import CloudinaryService
+from app.scheduling import ImageProbe
+from app.cancellation import cancellation_registry, JobCancelledError
+from app.inference import ModelHandler, get_inference_client
+from app.admission import get_job_tier
+from app.quantization import QuantizationSpec, ModelVariant, model_registry, model_version
+from app.chaining import ChainStepFn
+from app.decoding import decode_image
+from app.encoding import encode_image, select_preset
+from app.thumbnails import publish_result
+from app.signature import SignatureDecision, detect_signature
+from app.sessions import SessionPool
+from app.batching import SegmentationBatcher, BatchedSession, MaskSession
+from app.cutout import cut_out, apply_alpha
+from app.masks import mask_store, mask_key, composite, CompositeError
+from app.output import package_output
+from app.routing import ModelRoute, ROUTE_CONFIG, route_model, candidate_models, routed_models
+from app.threads import thread_budget
+from app.config import (
+    REMBG_SESSIONS_PER_MODEL,
+    REMBG_GRAPH_OPTIMIZATION,
+    REMBG_ORT_ALLOW_SPINNING,
+    REMBG_MAX_BATCH,
+    REMBG_BATCH_WINDOW_MS,
+    ALPHA_MATTING_DEFAULT,
+    REMBG_SIGNATURE_MODEL,
+)
 
 logger = logging.getLogger(__name__)
 
 class ImageProcessingError(Exception):
     """Error específico para fallos en el procesamiento de la imagen."""
 
-# Diccionario para cachear sesiones por modelo y evitar crear una sesión nueva para cada imagen
-_sessions_cache: Dict[str, Any] = {}
+
+# Modo degradado bajo carga: modelo liviano, sin detección de firmas ni matting de bordes
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"rembg_model": "u2netp", "alpha_matting": False}
+
+# Memoria aproximada de cada sesión rembg (pesos + activaciones), en MB
+REMBG_MODEL_MEMORY_MB: Dict[str, int] = {"u2net": 450, "u2netp": 120, "silueta": 200, "isnet-general-use": 900}
+# Copias de la imagen que conviven durante un job (RGB decodificado, RGBA de salida, buffers del encode PNG);
+# la máscara y los temporales del alpha son de baja resolución o por franjas
+IMAGE_BYTES_PER_PIXEL = 12
+
+# Modelos de los tiers y de las firmas (ver app.routing) más el del modo degradado: se descargan antes
+# del fork y cada worker los carga en el pool (o el sidecar en sus sesiones)
+REMBG_PRELOAD_MODELS = tuple(dict.fromkeys(routed_models() + [DEGRADED_MODE_OVERRIDES["rembg_model"]]))
+# Niveles de REMBG_GRAPH_OPTIMIZATION en ort.GraphOptimizationLevel
+ORT_GRAPH_OPTIMIZATION_LEVELS = {
+    "all": "ORT_ENABLE_ALL",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "basic": "ORT_ENABLE_BASIC",
+    "disabled": "ORT_DISABLE_ALL",
+}
+# Nombre de las sesiones rembg en el sidecar de inferencia
+REMBG_SIDECAR_MODEL = "rembg"
+
+# Normalización (media, desvío, tamaño) con la que cada sesión rembg arma su input
+REMBG_INPUT_NORMALIZATION: Dict[str, Tuple[Tuple[float, ...], Tuple[float, ...], Tuple[int, int]]] = {
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
 
 # Set para trackear jobs activos y evitar duplicados
 _active_jobs: Set[str] = set()
@@ -32,12 +86,11 @@ _jobs_lock = threading.Lock()
 
 def clear_sessions_cache():
     """
-    Limpia el caché de sesiones rembg para liberar memoria.
+    Limpia el pool de sesiones rembg para liberar memoria.
     Útil al reiniciar la aplicación o cambiar configuraciones.
     """
-    global _sessions_cache
-    logger.info("🧹 Limpiando caché de sesiones rembg")
-    _sessions_cache.clear()
+    logger.info("🧹 Limpiando pool de sesiones rembg")
+    session_pool.clear()
 
 def clear_active_jobs():
     """
@@ -54,93 +107,261 @@ def get_active_jobs_count() -> int:
     with _jobs_lock:
         return len(_active_jobs)
 
-def get_session_for_model(model_name: str):
+def rembg_session_options(intra_op_threads: Optional[int] = None):
+    """SessionOptions de ONNX Runtime para una sesión rembg, por defecto con el presupuesto de threads de un slot."""
+    import onnxruntime as ort
+
+    options = thread_budget.ort_session_options(ort)
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    level = ORT_GRAPH_OPTIMIZATION_LEVELS.get(REMBG_GRAPH_OPTIMIZATION, "ORT_ENABLE_ALL")
+    options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, level)
+    if not REMBG_ORT_ALLOW_SPINNING:
+        options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    return options
+
+def create_rembg_session(model_name: str, variant: Optional[ModelVariant] = None, intra_op_threads: Optional[int] = None):
     """
-    Obtiene una sesión rembg reutilizable para el modelo dado,
-    almacenando en caché para evitar crear múltiples sesiones.
+    Crea una sesión rembg con rembg_session_options (new_session usa las
+    opciones por defecto de ORT). Con una variante cuantizada, la sesión
+    rembg conserva su pre/postproceso pero corre el modelo INT8.
     """
-    if model_name not in _sessions_cache:
-        logger.info(f"🔧 Creando nueva sesión para el modelo: {model_name}")
-        _sessions_cache[model_name] = new_session(model_name)
+    import onnxruntime as ort
+
+    session_class = next(cls for cls in sessions_class if cls.name() == model_name)
+    options = rembg_session_options(intra_op_threads)
+    session = session_class(model_name, options)
+    if variant is not None:
+        session.inner_session = ort.InferenceSession(variant.path, sess_options=options, providers=["CPUExecutionProvider"])
+    return session
+
+def create_rembg_batch_session(model_name: str, variant: Optional[ModelVariant] = None):
+    """Sesión de lotes: un lote junta los jobs de todos los slots, así que usa todas las CPUs."""
+    return create_rembg_session(model_name, variant, thread_budget.cpus)
+
+# Sesiones rembg por modelo, una por slot de CPU, de uso exclusivo durante cada inferencia
+session_pool = SessionPool(REMBG_SESSIONS_PER_MODEL, create_rembg_session)
+
+# Con REMBG_MAX_BATCH > 1, las segmentaciones concurrentes de un mismo modelo corren juntas en un solo run
+segmentation_batcher = SegmentationBatcher(
+    create_rembg_batch_session, REMBG_INPUT_NORMALIZATION, REMBG_MAX_BATCH, REMBG_BATCH_WINDOW_MS
+)
+
+@contextmanager
+def rembg_session(model_name: str, variant: Optional[ModelVariant] = None) -> Iterator[Any]:
+    """Sesión para rembg.remove: la del batcher si el modelo se segmenta en lotes, si no una libre del pool."""
+    if segmentation_batcher.supports(model_name):
+        yield BatchedSession(segmentation_batcher, model_name, variant)
+        return
+    with session_pool.acquire(model_name, variant) as session:
+        yield session
+
+def _preload_session(model_name: str) -> None:
+    if segmentation_batcher.supports(model_name):
+        segmentation_batcher.preload(model_name)
     else:
-        logger.debug(f"♻️ Reutilizando sesión existente para el modelo: {model_name}")
-    return _sessions_cache[model_name]
+        session_pool.preload(model_name)
 
+def _sessions_loaded(model_name: str, variant: Optional[ModelVariant] = None) -> bool:
+    """True si las sesiones que usaría un job del modelo ya están en memoria."""
+    if segmentation_batcher.supports(model_name):
+        return segmentation_batcher.is_loaded(model_name, variant)
+    return session_pool.is_full(model_name, variant)
 
-def is_probable_signature(image: Image.Image, ocr_confidence_threshold=30.0) -> bool:
+def preload_sessions():
     """
-    Detecta firmas en imágenes con fondo blanco y línea oscura usando OCR optimizado.
+    Llena el pool de los modelos de REMBG_PRELOAD_MODELS, para que el
+    primer job de cada modelo (p. ej. la primera firma) no cargue su sesión.
+    Corre en cada worker al arrancar, después del fork.
     """
-    try:
-        # Convertir a escala de grises
-        gray = image.convert("L")
-        
-        # Calcular porcentaje de píxeles claros (fondo)
-        np_gray = np.array(gray)
-        light_pixels = np_gray > 200  # Píxeles casi blancos
-        light_ratio = np.mean(light_pixels)
-        
-        # Si no hay suficiente fondo blanco, descartar como firma
-        if light_ratio < 0.85:
-            logger.debug(f"📋 Fondo insuficiente: {light_ratio:.2f} < 0.85")
-            return False
-            
-        # Preprocesamiento mejorado para firmas
-        # 1. Enfocar ligeramente para mejorar líneas finas
-        sharpened = gray.filter(ImageFilter.SHARPEN)
-        
-        # 2. Alto contraste para firmas oscuras
-        high_contrast = sharpened.point(lambda x: 0 if x < 200 else 255)
-        
-        # 3. OCR optimizado para firmas (configuración especial)
-        ocr_config = r'--psm 6 --oem 3 -c tessedit_char_whitelist=abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-        
-        ocr_data = pytesseract.image_to_data(
-            high_contrast, 
-            lang="eng", 
-            output_type=pytesseract.Output.DICT,
-            config=ocr_config
-        )
-        
-        # Calcular confianza máxima detectada - CORREGIDO ERROR DE TIPO
-        confidences = []
-        for conf in ocr_data['conf']:
-            try:
-                c = float(conf)
-                if c > 0:  # Ignorar valores negativos o cero
-                    confidences.append(c)
-            except (ValueError, TypeError):
-                continue
-        
-        max_conf = max(confidences) if confidences else 0
-        
-        if max_conf <= ocr_confidence_threshold:
-            logger.info(f"✍️ Firma detectada: fondo blanco ({light_ratio:.2f}), confianza OCR baja ({max_conf})")
-            return True
-            
-        logger.debug(f"📝 No es firma: confianza OCR alta ({max_conf})")
-        return False
+    if get_inference_client() is not None:
+        return  # Las sesiones viven en el sidecar
+    for model_name in REMBG_PRELOAD_MODELS:
+        _preload_session(model_name)
 
-    except Exception as e:
-        logger.warning(f"⚠️ Detección de firma fallida: {e}")
-        return False
+def preload_models():
+    """
+    Prepara los modelos antes de que el supervisor haga fork de los workers.
+    Las sesiones de onnxruntime no sobreviven a un fork (sus thread pools no
+    se heredan), así que acá solo se descargan y verifican los modelos; cada
+    worker llena su propio pool con preload_sessions.
+    """
+    if get_inference_client() is not None:
+        return
+    for model_name in REMBG_PRELOAD_MODELS:
+        logger.info(f"📦 Precargando modelo rembg: {model_name}")
+        session = new_session(model_name)
+        del session
+
+def _run_rembg_batch(requests: List[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]) -> List[Tuple[Dict[str, np.ndarray], Dict[str, Any]]]:
+    """
+    Lote del sidecar: una sola segmentación por modelo para todas sus
+    imágenes. Con params["output"] == "mask" devuelve solo la máscara (el
+    recorte lo hace el consumer a tamaño completo), si no el recorte de rembg.
+    """
+    images = [Image.fromarray(arrays["image"]) for arrays, _ in requests]
+    groups: Dict[Tuple[str, Optional[str]], List[int]] = {}
+    for index, (_, params) in enumerate(requests):
+        groups.setdefault((params["model"], params.get("variant")), []).append(index)
+
+    masks: List[Optional[Image.Image]] = [None] * len(requests)
+    for (model_name, variant_name), indices in groups.items():
+        variant = model_registry.get(model_name, variant_name) if variant_name else None
+        if segmentation_batcher.supports(model_name):
+            for index, mask in zip(indices, segmentation_batcher.run(model_name, variant, [images[index] for index in indices])):
+                masks[index] = mask
+        else:
+            with session_pool.acquire(model_name, variant) as session:
+                for index in indices:
+                    masks[index] = session.predict(images[index])[0]
+
+    results = []
+    for image, mask, (_, params) in zip(images, masks, requests):
+        if params.get("output") == "mask":
+            results.append(({"mask": np.asarray(mask)}, {}))
+        else:
+            results.append(({"image": np.asarray(remove(image, session=MaskSession(mask)))}, {}))
+    return results
+
+def _run_rembg(arrays, params, cancelled):
+    return _run_rembg_batch([(arrays, params)])[0]
+
+def inference_handlers() -> Dict[str, ModelHandler]:
+    """Modelos que sirve el sidecar de inferencia (python -m app.inference); las sesiones rembg se crean al vuelo."""
+    for model_name in REMBG_PRELOAD_MODELS:
+        _preload_session(model_name)
+    return {REMBG_SIDECAR_MODEL: ModelHandler(_run_rembg, _run_rembg_batch, REMBG_MAX_BATCH)}
+
+def predict_mask_remote(client, image: Image.Image, model_name: str, variant: Optional[ModelVariant] = None) -> Image.Image:
+    """Máscara de la sesión del sidecar; la imagen (ya reducida) viaja decodificada por memoria compartida."""
+    params = {"model": model_name, "variant": variant.variant if variant is not None else None, "output": "mask"}
+    outputs, _ = client.call(REMBG_SIDECAR_MODEL, {"image": np.asarray(image.convert("RGB"))}, params)
+    return Image.fromarray(outputs["mask"])
+
+def remove_background(
+    image: Image.Image,
+    model_name: str,
+    variant: Optional[ModelVariant] = None,
+    matting: bool = False
+) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    RGBA a tamaño completo sin fondo: el modelo (sesión del pool, lote o
+    sidecar) ve una copia reducida y app.cutout aplica el alpha al original,
+    refinando los bordes con matting si se pide.
+    """
+    inference_client = get_inference_client()
+
+    def predict_mask(small: Image.Image) -> Image.Image:
+        if inference_client is not None:
+            return predict_mask_remote(inference_client, small, model_name, variant)
+        # La sesión se toma solo para la inferencia, no durante el alpha a tamaño completo
+        with rembg_session(model_name, variant) as session:
+            return session.predict(small)[0]
 
+    return cut_out(image, predict_mask, matting=matting)
 
-def detect_signature_or_text(image_bytes: bytes, ocr_confidence_threshold: float = 30.0) -> str:
+def _rembg_quantization_spec(model_name: str) -> QuantizationSpec:
+    session_class = next(cls for cls in sessions_class if cls.name() == model_name)
+    mean, std, size = REMBG_INPUT_NORMALIZATION[model_name]
+    session = None
+
+    def prepare(image: np.ndarray):
+        nonlocal session
+        session = session or create_rembg_session(model_name)
+        return list(session.normalize(Image.fromarray(image), mean, std, size).values())
+
+    # El gate compara las máscaras del modelo INT8 contra las del FP32
+    return QuantizationSpec(model_name, lambda: str(session_class.download_models()), prepare, "mask_iou", 0.97)
+
+def quantization_specs() -> Dict[str, QuantizationSpec]:
+    """Modelos que se pueden cuantizar con python -m app.quantization."""
+    return {model_name: _rembg_quantization_spec(model_name) for model_name in REMBG_INPUT_NORMALIZATION}
+
+
+def detect_signature_or_text(
+    image: Image.Image,
+    ocr_confidence_threshold: float = 30.0,
+    default_model: str = "u2net"
+) -> Tuple[str, Optional[SignatureDecision]]:
     """
-    Detecta si la imagen es una firma (fondo blanco + línea oscura).
-    Devuelve 'isnet-general-use' para firmas, 'u2net' para imágenes normales.
+    Detecta si la imagen (ya decodificada) es una firma (fondo blanco + línea oscura).
+    Devuelve REMBG_SIGNATURE_MODEL para firmas, `default_model` para imágenes normales, con la decisión del clasificador.
     """
     try:
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-        if is_probable_signature(image, ocr_confidence_threshold):
-            return "isnet-general-use"
-        else:
-            return "u2net"
-
+        decision = detect_signature(image, ocr_confidence_threshold)
     except Exception as e:
-        logger.warning(f"⚠️ Detección OCR fallida: {e}, usando modelo general")
-        return "u2net"
+        logger.warning(f"⚠️ Detección de firma fallida: {e}, usando modelo general")
+        return default_model, None
+
+    if decision.is_signature:
+        logger.info(f"✍️ Firma detectada (score {decision.score:.2f}, {decision.method}, {decision.seconds * 1000:.1f} ms)")
+        return REMBG_SIGNATURE_MODEL, decision
+    logger.debug(f"📝 No es firma (score {decision.score:.2f}, {decision.method})")
+    return default_model, decision
+
+
+def select_model(image: Image.Image, config: Dict[str, Any]) -> Tuple[ModelRoute, Optional[SignatureDecision]]:
+    """
+    Modelo del job: el de jobConfig["rembg_model"] (sin detección de firmas),
+    el de firmas o el de su tier (ver app.routing).
+    """
+    route = route_model(config)
+    if route.reason == ROUTE_CONFIG:
+        return route, None
+    _, signature = detect_signature_or_text(image, config.get("ocr_confidence_threshold", 30.0), route.model)
+    if signature is not None and signature.is_signature:
+        route = route_model(config, is_signature=True)
+    return route, signature
+
+
+def remove_background_step(job_id: str, image: Image.Image, config: Dict[str, Any]) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    Paso BG_REMOVAL de un job encadenado: trabaja sobre la imagen ya
+    decodificada y devuelve el RGBA en memoria, sin encode PNG ni thumbnail.
+    """
+    route, signature = select_model(image, config)
+    model_to_use = route.model
+    variant = model_registry.resolve(model_to_use, get_job_tier(config))
+    logger.info(f"🤖 Modelo seleccionado para {job_id}: {model_version(model_to_use, variant)}")
+
+    matting = bool(config.get("alpha_matting", ALPHA_MATTING_DEFAULT))
+    output, cutout_info = remove_background(image, model_to_use, variant, matting)
+    info = {"model_version": model_version(model_to_use, variant), **route.to_params(), **cutout_info}
+    if signature is not None:
+        info.update(signature.to_params())
+    return output, info
+
+
+def chain_steps() -> Dict[str, ChainStepFn]:
+    """Pasos de un job encadenado que este servicio corre en memoria (ver app.chaining)."""
+    return {"BG_REMOVAL": remove_background_step}
+
+
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """
+    Estima el costo de un job en megapíxeles de entrada.
+    La segmentación corre a resolución fija, pero la decodificación, la
+    composición RGBA y el encode PNG escalan con el tamaño de la imagen.
+    """
+    return probe.megapixels
+
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """
+    Estima el pico de memoria del job en bytes.
+    La decodificación RGB, la máscara, la salida RGBA y los buffers PNG suman
+    ~IMAGE_BYTES_PER_PIXEL por píxel de entrada, más la sesión rembg. Sin un
+    modelo forzado, la detección de firmas elige después de la descarga: se asume el más pesado.
+    """
+    if probe.megapixels is None:
+        return None
+    candidates = candidate_models(config)
+    model_mb = max(REMBG_MODEL_MEMORY_MB.get(model, REMBG_MODEL_MEMORY_MB["u2net"]) for model in candidates)
+    if get_inference_client() is not None or all(
+        _sessions_loaded(model, model_registry.resolve(model, get_job_tier(config))) for model in candidates
+    ):
+        model_mb = 0  # Las sesiones viven en el sidecar o ya están todas cargadas en el pool
+    return int(probe.megapixels * 1_000_000 * IMAGE_BYTES_PER_PIXEL + model_mb * 1024 * 1024)
 
 
 async def perform_background_removal(
@@ -175,57 +396,119 @@ async def perform_background_removal(
     try:
         logger.info(f"🚀 Iniciando trabajo {job_id} con URL: {image_url}")
         
+        cancellation_registry.check(job_id, "download")
+
         logger.info(f"⬇️ Descargando imagen: {image_url}")
         input_image_bytes = CloudinaryService.download_image_from_url(image_url)
+        cancellation_registry.check(job_id, "segmentation")
 
-        model_to_use = detect_signature_or_text(input_image_bytes, ocr_confidence_threshold)
-        logger.info(f"🤖 Modelo seleccionado para {job_id}: {model_to_use}")
+        # Una sola decodificación para la detección de firmas, rembg y el thumbnail
+        input_image = decode_image(input_image_bytes)
 
-        # Usar sesión cacheada o crear nueva sólo si no existe
-        session = get_session_for_model(model_to_use)
+        # Un modelo forzado por config (p. ej. modo degradado) evita también la detección de firmas;
+        # si no, las firmas van a su modelo y el resto al modelo del tier
+        route, signature = select_model(input_image, config)
+        model_to_use = route.model
+        # Los tiers de QUANTIZED_TIERS usan la variante INT8 habilitada del modelo, si hay una
+        variant = model_registry.resolve(model_to_use, get_job_tier(config))
+        logger.info(f"🤖 Modelo seleccionado para {job_id}: {model_version(model_to_use, variant)}")
 
         start_time = time.perf_counter()
-        logger.info(f"🎨 Removiendo fondo para {job_id}")
-        output_bytes = remove(input_image_bytes, session=session)
+        matting = bool(config.get("alpha_matting", ALPHA_MATTING_DEFAULT))
+        composite_operation = config.get("composite")
+        # La máscara de esta misma imagen y modelo, si un job anterior ya la calculó (en Cloudinary solo
+        # se busca para ediciones, que casi siempre vuelven sobre una imagen ya recortada)
+        key = mask_key(input_image_bytes, model_version(model_to_use, variant), matting)
+        # jobConfig["refresh_mask"] fuerza a segmentar de nuevo (y pisa la máscara guardada)
+        alpha = None if config.get("refresh_mask") else mask_store.get(key, remote=bool(composite_operation))
+        if alpha is not None and alpha.shape[:2] == (input_image.height, input_image.width):
+            logger.info(f"♻️ Reutilizando máscara {key} para {job_id}")
+            cutout_info = {"mask_cache": "hit"}
+        else:
+            logger.info(f"🎨 Removiendo fondo para {job_id}")
+            # El modelo corre sobre una copia reducida; el alpha se aplica al original por franjas
+            output_image, cutout_info = remove_background(input_image, model_to_use, variant, matting)
+            alpha = np.asarray(output_image.getchannel("A"))
+            cutout_info["mask_cache"] = "miss"
+            try:
+                # Solo las ediciones suben la máscara: son las que tienen otra edición detrás
+                keep_remote = bool(composite_operation or config.get("keep_mask"))
+                remote_id = mask_store.put(key, alpha, job_id if keep_remote else None)
+                if remote_id:
+                    cutout_info["stored_mask_public_id"] = remote_id
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo guardar la máscara {key}: {e}")
+
+        packaged = None
+        if composite_operation:
+            if not isinstance(composite_operation, dict):
+                raise CompositeError(f"composite debe ser un objeto, no {composite_operation!r}")
+            # Fondo de color, desenfocado o de otra imagen: sin alpha, así que JPEG salvo que se pida otro formato
+            output_image, composite_info = composite(input_image, alpha, composite_operation)
+            cutout_info.update(composite_info)
+            output_format = str(composite_operation.get("format", "JPEG")).upper()
+            if output_format not in ("PNG", "JPEG", "WEBP"):
+                raise CompositeError(f"Formato de salida inválido: {output_format}")
+            suffix = f"bg_{composite_operation.get('mode')}"
+        else:
+            if cutout_info["mask_cache"] == "hit":
+                output_image = Image.fromarray(apply_alpha(input_image, Image.fromarray(alpha, "L")), "RGBA")
         elapsed = time.perf_counter() - start_time
 
-        logger.info(f"🖼️ Generando thumbnail para {job_id}")
-        output_image = Image.open(io.BytesIO(output_bytes)).convert("RGBA")
-        thumbnail = output_image.copy()
-        thumbnail.thumbnail((400, 300), Image.Resampling.LANCZOS)
-
-        thumbnail_buffer = io.BytesIO()
-        thumbnail.save(thumbnail_buffer, format="PNG", optimize=True, quality=70)
-        thumbnail_bytes = thumbnail_buffer.getvalue()
-
-        logger.info(f"☁️ Subiendo imagen procesada a Cloudinary para {job_id}")
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            output_bytes, job_id, "bg_removed"
-        )
-
-        logger.info(f"☁️ Subiendo thumbnail a Cloudinary para {job_id}")
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
-        )
+        # Encode con el preset del tier, directo desde la imagen en memoria
+        if composite_operation:
+            encoded = encode_image(output_image, output_format, select_preset(config), int(config.get("output_quality", 90)))
+        else:
+            # PNG completo, WebP o máscara + JPEG, opcionalmente recortado al sujeto (ver app.output)
+            packaged = package_output(output_image, input_image, config, select_preset(config))
+            encoded, output_image, suffix = packaged.encoded, packaged.image, packaged.suffix
+        output_bytes = encoded.data
+
+        cancellation_registry.check(job_id, "upload")
+
+        # Sube la imagen procesada con su thumbnail (WebP con transparencia, reducido desde la imagen en memoria)
+        logger.info(f"☁️ Subiendo imagen procesada y thumbnail a Cloudinary para {job_id}")
+        # Un thumbnail derivado en Cloudinary saldría del JPEG sin recortar: en modo "mask" se arma del recorte en memoria
+        thumbnail_mode = "local" if packaged is not None and packaged.mode == "mask" else None
+        published = publish_result(job_id, output_bytes, suffix, output_image, mode=thumbnail_mode)
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
+        output_info = packaged.to_params() if packaged is not None else {}
+        if packaged is not None and packaged.mask is not None:
+            # Como archivo raw con el tag del job: la limpieza del backend lo borra junto al resultado
+            output_info["mask_url"], output_info["mask_public_id"] = CloudinaryService.upload_mask(
+                packaged.mask.data, f"{job_id}_bg_mask", job_id
+            )
 
         logger.info(f"✅ Trabajo {job_id} completado con éxito")
         logger.info(f"🔗 URL calidad completa: {processed_url}")
         logger.info(f"🔗 URL thumbnail: {thumbnail_url}")
 
         processing_info = {
-            "model_version": model_to_use,
+            "model_version": model_version(model_to_use, variant),
             "mode": "cloudinary_integration",
             "processing_time_seconds": round(elapsed, 3),
+            **route.to_params(),
+            **cutout_info,
+            "mask_key": key,
             "signature_detection_threshold": ocr_confidence_threshold,
+            **(signature.to_params() if signature is not None else {}),
             "full_quality_public_id": processed_public_id,
             "thumbnail_public_id": thumbnail_public_id,
             "thumbnail_url": thumbnail_url,
             "job_id": job_id,  # Agregar job_id para tracking
-            "timestamp": time.time()  # Timestamp para debugging
+            "timestamp": time.time(),  # Timestamp para debugging
+            **encoded.to_params(),
+            **output_info,
+            **published.to_params()
         }
 
         return processed_url, processing_info
 
+    except (JobCancelledError, CompositeError):
+        # Ni la cancelación ni una composición mal formada se reintentan: se propagan sin envolver
+        raise
+
     except Exception as e:
         logger.error(f"❌ Error en trabajo {job_id}: {e}")
         logger.error(f"📋 Traceback completo: {traceback.format_exc()}")
@@ -247,8 +530,9 @@ def get_system_status() -> Dict[str, Any]:
         return {
             "active_jobs_count": len(_active_jobs),
             "active_jobs": list(_active_jobs),
-            "cached_models": list(_sessions_cache.keys()),
-            "cached_sessions_count": len(_sessions_cache),
+            "session_pool": session_pool.snapshot(),
+            "segmentation_batches": segmentation_batcher.snapshot(),
+            "mask_store": mask_store.snapshot(),
             "timestamp": time.time()
         }
 
@@ -0,0 +1,426 @@
+"""
+Quantized model variants module.
+Builds INT8 variants of the service's ONNX models (dynamic quantization, or
+static with a calibration set drawn from a directory of corpus images),
+checks them against the FP32 model with an accuracy gate and records them in
+a registry of selectable model versions. Jobs of the tiers in
+QUANTIZED_TIERS run the enabled variant of a model; every other job keeps
+the FP32 model.
+
+A variant can only be enabled once it has passed its gate:
+
+    python -m app.quantization quantize u2net --method static --calibration-dir /data/corpus --enable
+    python -m app.quantization list
+    python -m app.quantization enable u2net int8-static
+    python -m app.quantization disable u2net
+
+The models a service can quantize come from `app.processing.quantization_specs()`.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from app.config import QUANTIZED_MODELS_DIR, QUANTIZED_TIERS
+from app.threads import thread_budget
+
+logger = logging.getLogger(__name__)
+
+DYNAMIC = "dynamic"
+STATIC = "static"
+METHODS = (DYNAMIC, STATIC)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+# Share of the sampled corpus held out from calibration to run the gate on
+VALIDATION_SHARE = 0.25
+
+
+class QuantizationGateError(Exception):
+    """A variant that failed (or never ran) its accuracy gate cannot be enabled."""
+
+
+@dataclass
+class QuantizationSpec:
+    """
+    How to quantize and check one model.
+
+    `export` returns the path of the FP32 ONNX model (downloading or exporting
+    it if needed), `prepare` turns an RGB uint8 image into the model inputs in
+    order, and the gate passes when `metric` (higher is better) reaches
+    `threshold` on every held-out image.
+    """
+    name: str
+    export: Callable[[], str]
+    prepare: Callable[[np.ndarray], List[np.ndarray]]
+    metric: str
+    threshold: float
+    max_side: int = 1024
+
+
+@dataclass
+class ModelVariant:
+    model: str
+    variant: str
+    path: str
+    method: str
+    created_at: float
+    calibration_samples: int = 0
+    gate: Dict[str, Any] = field(default_factory=dict)
+    latency: Dict[str, float] = field(default_factory=dict)
+    enabled: bool = False
+
+    @property
+    def passed(self) -> bool:
+        return bool(self.gate.get("passed"))
+
+
+def model_version(model: str, variant: Optional[ModelVariant]) -> str:
+    """Version string reported with a job's result: `u2net` or `u2net:int8-static`."""
+    return f"{model}:{variant.variant}" if variant is not None else model
+
+
+# ---- accuracy metrics ---------------------------------------------------------
+
+def psnr_db(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """PSNR of the candidate output against the FP32 one, with the peak taken from the reference range."""
+    reference = reference.astype(np.float64)
+    mse = float(np.mean((reference - candidate.astype(np.float64)) ** 2))
+    peak = max(1.0, float(np.abs(reference).max()))
+    return float("inf") if mse == 0 else 10.0 * np.log10(peak ** 2 / mse)
+
+
+def mask_iou(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """IoU of the foreground masks, both thresholded halfway through the reference range."""
+    low, high = float(reference.min()), float(reference.max())
+    cut = (low + high) / 2.0
+    ref_mask = reference > cut
+    cand_mask = candidate > cut
+    union = np.logical_or(ref_mask, cand_mask).sum()
+    return 1.0 if union == 0 else float(np.logical_and(ref_mask, cand_mask).sum() / union)
+
+
+METRICS: Dict[str, Callable[[np.ndarray, np.ndarray], float]] = {
+    "psnr_db": psnr_db,
+    "mask_iou": mask_iou,
+}
+
+
+# ---- registry -----------------------------------------------------------------
+
+class ModelVariantRegistry:
+    """
+    Quantized variants recorded in `<directory>/manifest.json`.
+
+    At most one variant per model is enabled. The manifest is re-read when
+    it changes on disk, so enabling a variant with the CLI reaches running
+    workers without a restart (for sessions they create from then on).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self._variants: List[ModelVariant] = []
+        self._mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _refresh(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            self._variants, self._mtime = [], None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.manifest_path) as f:
+                data = json.load(f)
+            self._variants = [ModelVariant(**entry) for entry in data.get("variants", [])]
+            self._mtime = mtime
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f"❌ Could not read quantized model manifest {self.manifest_path}: {e}")
+
+    def _save(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"variants": [asdict(variant) for variant in self._variants]}, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        self._mtime = os.path.getmtime(self.manifest_path)
+
+    def variants(self, model: Optional[str] = None) -> List[ModelVariant]:
+        with self._lock:
+            self._refresh()
+            return [variant for variant in self._variants if model is None or variant.model == model]
+
+    def get(self, model: str, variant_name: str) -> Optional[ModelVariant]:
+        return next((v for v in self.variants(model) if v.variant == variant_name), None)
+
+    def register(self, variant: ModelVariant) -> None:
+        """Add or replace a variant; enabling it (if requested) still goes through `enable`."""
+        with self._lock:
+            self._refresh()
+            self._variants = [
+                v for v in self._variants if not (v.model == variant.model and v.variant == variant.variant)
+            ]
+            self._variants.append(variant)
+            self._save()
+
+    def enable(self, model: str, variant_name: str) -> ModelVariant:
+        with self._lock:
+            self._refresh()
+            variant = next((v for v in self._variants if v.model == model and v.variant == variant_name), None)
+            if variant is None:
+                raise KeyError(f"No variant {variant_name} registered for {model}")
+            if not variant.passed:
+                raise QuantizationGateError(f"{model}:{variant_name} did not pass its accuracy gate: {variant.gate}")
+            for other in self._variants:
+                if other.model == model:
+                    other.enabled = other is variant
+            self._save()
+            return variant
+
+    def disable(self, model: str) -> None:
+        with self._lock:
+            self._refresh()
+            for variant in self._variants:
+                if variant.model == model:
+                    variant.enabled = False
+            self._save()
+
+    def enabled_variant(self, model: str) -> Optional[ModelVariant]:
+        variant = next((v for v in self.variants(model) if v.enabled and v.passed), None)
+        if variant is not None and not os.path.exists(variant.path):
+            logger.warning(f"⚠️ Enabled variant {model_version(model, variant)} is missing at {variant.path}")
+            return None
+        return variant
+
+    def resolve(self, model: str, tier: str) -> Optional[ModelVariant]:
+        """The variant a job of `tier` should run for `model`, or None for FP32."""
+        if tier.upper() not in QUANTIZED_TIERS:
+            return None
+        return self.enabled_variant(model)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "directory": self.directory,
+            "quantized_tiers": list(QUANTIZED_TIERS),
+            "variants": [asdict(variant) for variant in self.variants()],
+        }
+
+
+model_registry = ModelVariantRegistry(QUANTIZED_MODELS_DIR)
+
+
+def create_session(path: str):
+    """ONNX Runtime CPU session for a model file, sized by the thread budget."""
+    import onnxruntime as ort
+
+    options = thread_budget.ort_session_options(ort)
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+# ---- quantization -------------------------------------------------------------
+
+def load_corpus_images(directory: str, samples: int, max_side: int, seed: int = 0) -> List[np.ndarray]:
+    """A seeded random sample of corpus images as RGB uint8 arrays, downscaled to `max_side`."""
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not paths:
+        raise ValueError(f"No images found in {directory}")
+    random.Random(seed).shuffle(paths)
+    images = []
+    for path in paths:
+        if len(images) >= samples:
+            break
+        try:
+            with Image.open(path) as image:
+                image = image.convert("RGB")
+                image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+                images.append(np.asarray(image))
+        except OSError as e:
+            logger.warning(f"⚠️ Skipping unreadable corpus image {path}: {e}")
+    return images
+
+
+def _feeds(session, spec: QuantizationSpec, images: List[np.ndarray]) -> List[Dict[str, np.ndarray]]:
+    names = [model_input.name for model_input in session.get_inputs()]
+    return [dict(zip(names, spec.prepare(image))) for image in images]
+
+
+def quantize_model(spec: QuantizationSpec, method: str, calibration: List[np.ndarray], output_path: str) -> str:
+    """Write the INT8 model: weights only (dynamic) or weights and activations (static, QDQ)."""
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_dynamic,
+        quantize_static
+    )
+
+    fp32_path = spec.export()
+    if method == DYNAMIC:
+        quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+        return fp32_path
+
+    feeds = _feeds(create_session(fp32_path), spec, calibration)
+
+    class CorpusReader(CalibrationDataReader):
+        def __init__(self):
+            self._feeds = iter(feeds)
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+    quantize_static(
+        fp32_path,
+        output_path,
+        CorpusReader(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True
+    )
+    return fp32_path
+
+
+def evaluate_variant(spec: QuantizationSpec, fp32_path: str, int8_path: str, images: List[np.ndarray]) -> Dict[str, Any]:
+    """Run both models on the held-out images: the gate result and per-image latency of each."""
+    metric = METRICS[spec.metric]
+    fp32_session = create_session(fp32_path)
+    int8_session = create_session(int8_path)
+    scores, fp32_seconds, int8_seconds = [], [], []
+    for feed in _feeds(fp32_session, spec, images):
+        started = time.perf_counter()
+        reference = fp32_session.run(None, feed)[0]
+        fp32_seconds.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        candidate = int8_session.run(None, feed)[0]
+        int8_seconds.append(time.perf_counter() - started)
+        scores.append(metric(reference, candidate))
+    fp32_ms = 1000 * float(np.median(fp32_seconds))
+    int8_ms = 1000 * float(np.median(int8_seconds))
+    return {
+        "gate": {
+            "metric": spec.metric,
+            "threshold": spec.threshold,
+            "samples": len(scores),
+            "min": round(min(scores), 4),
+            "mean": round(float(np.mean(scores)), 4),
+            "passed": bool(min(scores) >= spec.threshold),
+        },
+        "latency": {
+            "fp32_ms": round(fp32_ms, 1),
+            "int8_ms": round(int8_ms, 1),
+            "speedup": round(fp32_ms / int8_ms, 2) if int8_ms else 0.0,
+        },
+    }
+
+
+def build_variant(
+    spec: QuantizationSpec,
+    method: str,
+    calibration_dir: str,
+    samples: int = 64,
+    threshold: Optional[float] = None,
+    enable: bool = False,
+    registry: ModelVariantRegistry = model_registry
+) -> ModelVariant:
+    """Quantize, gate and register one variant; enable it only if asked and the gate passed."""
+    if method not in METHODS:
+        raise ValueError(f"Unknown quantization method: {method}")
+    if threshold is not None:
+        spec = replace(spec, threshold=threshold)
+    images = load_corpus_images(calibration_dir, samples, spec.max_side)
+    held_out = max(1, int(len(images) * VALIDATION_SHARE))
+    calibration, validation = images[held_out:] or images, images[:held_out]
+
+    variant_name = f"int8-{method}"
+    os.makedirs(registry.directory, exist_ok=True)
+    output_path = os.path.join(registry.directory, f"{spec.name}.{variant_name}.onnx")
+    logger.info(f"⚙️ Quantizing {spec.name} ({method}, {len(calibration)} calibration images)")
+    fp32_path = quantize_model(spec, method, calibration, output_path)
+
+    result = evaluate_variant(spec, fp32_path, output_path, validation)
+    variant = ModelVariant(
+        model=spec.name,
+        variant=variant_name,
+        path=output_path,
+        method=method,
+        created_at=time.time(),
+        calibration_samples=len(calibration) if method == STATIC else 0,
+        gate=result["gate"],
+        latency=result["latency"],
+    )
+    registry.register(variant)
+    status = "✅ passed" if variant.passed else "❌ failed"
+    logger.info(
+        f"{status} gate for {model_version(spec.name, variant)}: {spec.metric} min {variant.gate['min']} "
+        f"(threshold {spec.threshold}), {variant.latency['fp32_ms']}ms -> {variant.latency['int8_ms']}ms"
+    )
+    if enable and variant.passed:
+        variant = registry.enable(spec.name, variant_name)
+    return variant
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build and manage INT8 model variants")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    quantize = commands.add_parser("quantize", help="Quantize a model and run its accuracy gate")
+    quantize.add_argument("model")
+    quantize.add_argument("--method", choices=METHODS, default=STATIC)
+    quantize.add_argument("--calibration-dir", required=True, help="Directory of corpus images")
+    quantize.add_argument("--samples", type=int, default=64, help="Images drawn from the corpus (calibration + gate)")
+    quantize.add_argument("--threshold", type=float, help="Override the model's gate threshold")
+    quantize.add_argument("--enable", action="store_true", help="Enable the variant if it passes the gate")
+
+    commands.add_parser("list", help="Show registered variants")
+    enable = commands.add_parser("enable", help="Enable a variant that passed its gate")
+    enable.add_argument("model")
+    enable.add_argument("variant")
+    disable = commands.add_parser("disable", help="Go back to the FP32 model")
+    disable.add_argument("model")
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        # Imported here so the config/logging setup of the service runs first
+        from app.processing import quantization_specs
+
+        specs = quantization_specs()
+        if args.model not in specs:
+            raise SystemExit(f"Unknown model {args.model}; quantizable models: {', '.join(specs)}")
+        variant = build_variant(
+            specs[args.model], args.method, args.calibration_dir, args.samples, args.threshold, args.enable
+        )
+        print(json.dumps(asdict(variant), indent=2))
+    elif args.command == "list":
+        print(json.dumps(model_registry.snapshot(), indent=2))
+    elif args.command == "enable":
+        try:
+            model_registry.enable(args.model, args.variant)
+        except (KeyError, QuantizationGateError) as e:
+            raise SystemExit(str(e))
+        print(f"Enabled {args.model}:{args.variant} for tiers {', '.join(QUANTIZED_TIERS)}")
+    elif args.command == "disable":
+        model_registry.disable(args.model)
+        print(f"{args.model} back to FP32")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Ruteo de modelos rembg por tier.
+Cada job segmenta con el modelo de su tier (REMBG_TIER_MODELS): los FREE con
+un modelo liviano (u2netp, 4.7 MB, o silueta, 43 MB) y los PREMIUM con uno
+completo (u2net, 176 MB). Las firmas van siempre a REMBG_SIGNATURE_MODEL y
+jobConfig["rembg_model"] (p. ej. el modo degradado) manda sobre ambos. El
+modelo elegido pasa por el pool de sesiones como cualquier otro y queda en
+el `model_version` del resultado.
+
+`python -m app.routing` mide la frontera latencia/calidad de los modelos
+sobre un directorio de imágenes: latencia por imagen y, contra máscaras de
+referencia (o contra el recorte del modelo más pesado), IoU y error medio
+del alpha. Los defaults de REMBG_TIER_MODELS salen de esa frontera.
+"""
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.admission import get_job_tier
+from app.config import REMBG_TIER_MODELS, REMBG_DEFAULT_MODEL, REMBG_SIGNATURE_MODEL
+
+logger = logging.getLogger(__name__)
+
+# Modelos rembg que este servicio sabe correr, del más liviano al más pesado
+REMBG_MODELS = ("u2netp", "silueta", "u2net", "isnet-general-use")
+
+ROUTE_CONFIG = "config"
+ROUTE_SIGNATURE = "signature"
+ROUTE_TIER = "tier"
+
+
+@dataclass
+class ModelRoute:
+    model: str
+    reason: str
+    tier: str
+
+    def to_params(self) -> Dict[str, Any]:
+        """Por qué el job usó su modelo, para processingParams."""
+        return {"model_route": self.reason, "model_tier": self.tier}
+
+
+def tier_model(tier: str) -> str:
+    """Modelo de las imágenes que no son firmas en un tier."""
+    model = REMBG_TIER_MODELS.get(tier.upper(), REMBG_DEFAULT_MODEL)
+    return model if model in REMBG_MODELS else REMBG_DEFAULT_MODEL
+
+
+def requested_model(config: Dict[str, Any]) -> Optional[str]:
+    """Modelo forzado por jobConfig["rembg_model"], si es uno conocido."""
+    model = config.get("rembg_model")
+    if not model:
+        return None
+    if model not in REMBG_MODELS:
+        logger.warning(f"⚠️ Modelo rembg desconocido en jobConfig: {model!r}, se usa el del tier")
+        return None
+    return model
+
+
+def route_model(config: Dict[str, Any], is_signature: bool = False) -> ModelRoute:
+    """Modelo de un job según su config, si es firma y su tier, en ese orden."""
+    tier = get_job_tier(config)
+    forced = requested_model(config)
+    if forced:
+        return ModelRoute(forced, ROUTE_CONFIG, tier)
+    if is_signature:
+        return ModelRoute(REMBG_SIGNATURE_MODEL, ROUTE_SIGNATURE, tier)
+    return ModelRoute(tier_model(tier), ROUTE_TIER, tier)
+
+
+def candidate_models(config: Dict[str, Any]) -> List[str]:
+    """Modelos que un job puede terminar usando antes de saber si es una firma."""
+    forced = requested_model(config)
+    if forced:
+        return [forced]
+    return [tier_model(get_job_tier(config)), REMBG_SIGNATURE_MODEL]
+
+
+def routed_models() -> List[str]:
+    """Todos los modelos a los que rutea la configuración actual, para precargarlos."""
+    models = [tier_model(tier) for tier in REMBG_TIER_MODELS] + [tier_model(""), REMBG_SIGNATURE_MODEL]
+    return list(dict.fromkeys(models))
+
+
+def _alpha_metrics(alpha: np.ndarray, reference: np.ndarray) -> Dict[str, float]:
+    predicted, expected = alpha > 127, reference > 127
+    union = np.logical_or(predicted, expected).sum()
+    iou = np.logical_and(predicted, expected).sum() / union if union else 1.0
+    mae = np.abs(alpha.astype(np.float32) - reference.astype(np.float32)).mean() / 255.0
+    return {"iou": float(iou), "mae": float(mae)}
+
+
+def benchmark(image_dir: str, models: List[str], mask_dir: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    """
+    Latencia y calidad de cada modelo sobre las imágenes de `image_dir`.
+    La referencia es la máscara del mismo nombre en `mask_dir` o, sin ella,
+    el alpha del último modelo de `models`. Marca los modelos de la frontera
+    (ningún otro es a la vez más rápido y más preciso).
+    """
+    from PIL import Image
+
+    from app.decoding import decode_image
+    from app.processing import remove_background
+
+    names = sorted(name for name in os.listdir(image_dir) if not name.startswith("."))[:limit]
+    images = []
+    for name in names:
+        with open(os.path.join(image_dir, name), "rb") as f:
+            images.append((name, decode_image(f.read()).convert("RGB")))
+
+    alphas: Dict[str, List[np.ndarray]] = {}
+    results = []
+    for model in models:
+        remove_background(images[0][1], model)  # Carga y calentamiento
+        latencies, alphas[model] = [], []
+        for _, image in images:
+            started = time.perf_counter()
+            output, _ = remove_background(image, model)
+            latencies.append(time.perf_counter() - started)
+            alphas[model].append(np.asarray(output.getchannel("A")))
+        latencies.sort()
+        results.append({
+            "model": model,
+            "images": len(images),
+            "p50_latency_ms": round(1000 * latencies[len(latencies) // 2], 1),
+            "p95_latency_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+        })
+
+    for result in results:
+        metrics = []
+        for index, (name, image) in enumerate(images):
+            if mask_dir:
+                stem = os.path.splitext(name)[0]
+                reference = Image.open(os.path.join(mask_dir, f"{stem}.png")).convert("L").resize(image.size)
+                reference = np.asarray(reference)
+            else:
+                reference = alphas[models[-1]][index]
+            metrics.append(_alpha_metrics(alphas[result["model"]][index], reference))
+        result["mean_iou"] = round(float(np.mean([m["iou"] for m in metrics])), 4)
+        result["mean_alpha_mae"] = round(float(np.mean([m["mae"] for m in metrics])), 4)
+
+    for result in results:
+        result["frontier"] = not any(
+            other["p50_latency_ms"] <= result["p50_latency_ms"] and other["mean_iou"] >= result["mean_iou"]
+            and (other["p50_latency_ms"], other["mean_iou"]) != (result["p50_latency_ms"], result["mean_iou"])
+            for other in results
+        )
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app.threads import thread_budget
+
+    parser = argparse.ArgumentParser(description="Frontera latencia/calidad de los modelos rembg")
+    parser.add_argument("--images", required=True, help="Directorio de imágenes de prueba")
+    parser.add_argument("--masks", help="Máscaras de referencia (PNG con el mismo nombre); sin ellas, el último modelo")
+    parser.add_argument("--models", default=",".join(REMBG_MODELS))
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    thread_budget.configure_libraries()
+    models = [model.strip() for model in args.models.split(",") if model.strip()]
+    print(json.dumps(benchmark(args.images, models, args.masks, args.limit), indent=2))
@@ -0,0 +1,191 @@
+"""
+Pool de sesiones rembg.
+Cada modelo (y variante cuantizada) tiene hasta REMBG_SESSIONS_PER_MODEL
+sesiones, una por slot de CPU: un job toma una sesión libre, la usa sola y la
+devuelve, así los jobs concurrentes no comparten el thread pool intra-op de
+una misma sesión ni cargan un modelo a mitad de un job. Los modelos a los que
+rutea el servicio (ver app.routing) se cargan completos al arrancar el worker;
+el resto se crea bajo demanda hasta llenar su pool.
+
+El pool registra cuánto espera cada job por una sesión (/metrics/sessions).
+`python -m app.sessions` compara el throughput de N jobs concurrentes con
+una sola sesión compartida y con el pool.
+"""
+
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+from app.quantization import ModelVariant, model_version
+
+logger = logging.getLogger(__name__)
+
+# Esperas recientes que se guardan por modelo para los percentiles
+WAIT_SAMPLES = 256
+
+# Crea una sesión rembg: (modelo, variante cuantizada o None) -> sesión
+SessionFactory = Callable[[str, Optional[ModelVariant]], Any]
+
+
+@dataclass
+class _ModelPool:
+    idle: "queue.LifoQueue[Any]" = field(default_factory=queue.LifoQueue)
+    created: int = 0
+    load_seconds: float = 0.0
+    acquisitions: int = 0
+    waited: int = 0
+    wait_seconds: float = 0.0
+    max_wait_seconds: float = 0.0
+    waits: Deque[float] = field(default_factory=lambda: deque(maxlen=WAIT_SAMPLES))
+
+
+class SessionPool:
+    """Sesiones rembg por versión de modelo, de uso exclusivo mientras un job las tiene."""
+
+    def __init__(self, size: int, factory: SessionFactory):
+        self.size = max(1, size)
+        self._factory = factory
+        self._pools: Dict[str, _ModelPool] = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, version: str) -> _ModelPool:
+        with self._lock:
+            return self._pools.setdefault(version, _ModelPool())
+
+    def _create(self, pool: _ModelPool, model_name: str, variant: Optional[ModelVariant]) -> Optional[Any]:
+        """Una sesión nueva si el pool todavía no llegó a `size`, si no None."""
+        with self._lock:
+            if pool.created >= self.size:
+                return None
+            pool.created += 1  # Reservada antes de cargar, para no pasarse con cargas en paralelo
+        started = time.perf_counter()
+        try:
+            session = self._factory(model_name, variant)
+        except Exception:
+            with self._lock:
+                pool.created -= 1
+            raise
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            pool.load_seconds += elapsed
+        logger.info(f"🔧 Sesión {pool.created}/{self.size} de {model_version(model_name, variant)} creada en {elapsed:.2f}s")
+        return session
+
+    def preload(self, model_name: str, variant: Optional[ModelVariant] = None) -> None:
+        """Llena el pool del modelo."""
+        pool = self._pool(model_version(model_name, variant))
+        while True:
+            session = self._create(pool, model_name, variant)
+            if session is None:
+                return
+            pool.idle.put(session)
+
+    def is_full(self, model_name: str, variant: Optional[ModelVariant] = None) -> bool:
+        """True si el modelo ya tiene todas sus sesiones en memoria."""
+        with self._lock:
+            pool = self._pools.get(model_version(model_name, variant))
+            return pool is not None and pool.created >= self.size
+
+    @contextmanager
+    def acquire(self, model_name: str, variant: Optional[ModelVariant] = None) -> Iterator[Any]:
+        """Una sesión del modelo para uso exclusivo; espera si están todas en uso."""
+        pool = self._pool(model_version(model_name, variant))
+        started = time.perf_counter()
+        try:
+            session = pool.idle.get_nowait()
+        except queue.Empty:
+            session = self._create(pool, model_name, variant)
+            if session is None:
+                session = pool.idle.get()
+            else:
+                started = time.perf_counter()  # La carga va a load_seconds, no a la espera
+        wait = time.perf_counter() - started
+        with self._lock:
+            pool.acquisitions += 1
+            pool.waits.append(wait)
+            pool.wait_seconds += wait
+            pool.max_wait_seconds = max(pool.max_wait_seconds, wait)
+            if wait > 0.001:
+                pool.waited += 1
+        try:
+            yield session
+        finally:
+            pool.idle.put(session)
+
+    def clear(self) -> None:
+        """Suelta las sesiones libres; las que están en uso vuelven a un pool nuevo."""
+        with self._lock:
+            self._pools = {}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            models = {}
+            for version, pool in self._pools.items():
+                waits = sorted(pool.waits)
+                models[version] = {
+                    "sessions": pool.created,
+                    "idle": pool.idle.qsize(),
+                    "load_seconds": round(pool.load_seconds, 3),
+                    "acquisitions": pool.acquisitions,
+                    "waited": pool.waited,
+                    "mean_wait_ms": round(1000 * pool.wait_seconds / max(1, pool.acquisitions), 2),
+                    "p95_wait_ms": round(1000 * waits[min(len(waits) - 1, int(len(waits) * 0.95))], 2) if waits else 0.0,
+                    "max_wait_ms": round(1000 * pool.max_wait_seconds, 2),
+                }
+            return {"sessions_per_model": self.size, "models": models}
+
+
+def benchmark(model_name: str, jobs: int, concurrency: int, size: int = 1024) -> Dict[str, Any]:
+    """Throughput de `jobs` remociones con `concurrency` threads: una sesión compartida vs el pool."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import numpy as np
+    from PIL import Image
+    from rembg import remove
+
+    from app.processing import create_rembg_session
+
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 255, (size, size, 3), dtype=np.uint8))
+    shared = create_rembg_session(model_name, None)
+    pool = SessionPool(concurrency, create_rembg_session)
+    pool.preload(model_name)
+
+    def shared_job() -> None:
+        remove(image, session=shared)
+
+    def pooled_job() -> None:
+        with pool.acquire(model_name) as session:
+            remove(image, session=session)
+
+    results: Dict[str, Any] = {"model": model_name, "jobs": jobs, "concurrency": concurrency}
+    for name, job in (("shared", shared_job), ("pool", pooled_job)):
+        job()  # Calentamiento
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(job) for _ in range(jobs)]:
+                future.result()
+        elapsed = time.perf_counter() - started
+        results[f"{name}_jobs_per_second"] = round(jobs / elapsed, 3)
+    results["pool"] = pool.snapshot()["models"]
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from app.threads import thread_budget
+
+    parser = argparse.ArgumentParser(description="Comparar una sesión rembg compartida con el pool")
+    parser.add_argument("--model", default="u2net")
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=thread_budget.slots)
+    args = parser.parse_args()
+
+    thread_budget.configure_libraries()
+    print(json.dumps(benchmark(args.model, args.jobs, args.concurrency), indent=2))
@@ -0,0 +1,380 @@
+"""
+Detección de firmas sin OCR.
+Decide si una imagen de fondo claro es una firma (se procesa con
+isnet-general-use) o no (u2net) con un modelo logístico sobre features
+NumPy/OpenCV calculadas a resolución reducida: proporción de tinta, grosor
+de trazo (runs horizontales y verticales), forma de los componentes
+conexos e interlineado. Corre en milisegundos dentro del proceso, en lugar
+de lanzar Tesseract por cada imagen.
+
+Los scores dudosos (a menos de SIGNATURE_OCR_BAND del umbral) los decide
+la heurística OCR (SIGNATURE_OCR_FALLBACK, activo por defecto mientras los
+pesos por defecto sigan siendo los sintéticos). `python -m app.signature` entrena los pesos sobre un set
+etiquetado y compara precisión y latencia contra la heurística OCR.
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image, ImageFilter
+
+from app.config import (
+    SIGNATURE_DETECT_MAX_SIDE,
+    SIGNATURE_THRESHOLD,
+    SIGNATURE_OCR_FALLBACK,
+    SIGNATURE_OCR_BAND,
+    SIGNATURE_MODEL_PATH,
+)
+
+logger = logging.getLogger(__name__)
+
+# Fondo claro mínimo para considerar firma (el mismo corte de la heurística OCR)
+MIN_LIGHT_RATIO = 0.85
+
+# Componentes más chicos que esto (en píxeles, a resolución reducida) son ruido del escaneo
+MIN_COMPONENT_AREA = 3
+
+# Cortes del histograma de alturas de componentes, relativos al alto de la imagen: letras chicas,
+# letras de texto y trazos largos. La franja de 5% a 15% del alto no es feature: en el set de
+# entrenamiento no tenía componentes y su peso quedaba en cero
+COMPONENT_HEIGHT_BINS = (0.02, 0.05, 0.15)
+HEIGHT_FEATURES = {0: "height_tiny", 1: "height_small", 3: "height_large"}
+
+FEATURE_NAMES = (
+    "light_ratio",
+    "ink_ratio",
+    "gray_ratio",
+    "run_median",
+    "run_cv",
+    "components",
+    "largest_share",
+    "height_cv",
+    "height_tiny",
+    "height_small",
+    "height_large",
+    "fill",
+    "row_bands",
+    "ink_extent",
+)
+
+# Modelo por defecto, ajustado con `python -m app.signature train --synthetic 300`: nunca se midió sobre
+# imágenes reales, por eso los scores dudosos pasan por el OCR (SIGNATURE_OCR_FALLBACK). Un modelo
+# entrenado con imágenes reales en SIGNATURE_MODEL_PATH lo reemplaza
+DEFAULT_MODEL: Dict[str, Any] = {
+    "features": list(FEATURE_NAMES),
+    "mean": [0.9478, 0.0457, 0.0065, 2.3963, 1.1713, 2.5024, 0.6198, 0.1614, 0.1731, 0.1975, 0.6294, 0.5081, 1.3828, 0.3792],
+    "std": [0.0308, 0.0271, 0.007, 1.592, 1.3134, 2.4367, 0.4475, 0.2561, 0.2517, 0.3126, 0.4629, 0.2873, 0.9129, 0.251],
+    "weights": [0.7185, -0.7506, -0.2581, -0.859, 0.7294, -0.3874, 0.2516, 0.4467, -0.1864, -0.2872, 0.2953, -1.2831, -0.392, 0.6352],
+    "bias": -1.9155,
+}
+
+
+@dataclass
+class SignatureDecision:
+    is_signature: bool
+    score: float
+    method: str
+    seconds: float
+    features: Dict[str, float] = field(default_factory=dict)
+
+    def to_params(self) -> Dict[str, Any]:
+        return {
+            "signature_detected": self.is_signature,
+            "signature_score": round(self.score, 4),
+            "signature_method": self.method,
+            "signature_seconds": round(self.seconds, 4),
+        }
+
+
+def load_model(path: Optional[str] = None) -> Dict[str, Any]:
+    """Pesos de SIGNATURE_MODEL_PATH si existe, si no los de DEFAULT_MODEL."""
+    path = path if path is not None else SIGNATURE_MODEL_PATH
+    if path and os.path.exists(path):
+        with open(path) as f:
+            model = json.load(f)
+        if list(model.get("features", [])) == list(FEATURE_NAMES):
+            logger.info(f"✍️ Modelo de firmas cargado desde {path}")
+            return model
+        logger.warning(f"⚠️ {path} tiene otras features, usando el modelo por defecto")
+    return DEFAULT_MODEL
+
+
+_model = load_model()
+
+
+def reduced_gray(image: Image.Image, max_side: int = SIGNATURE_DETECT_MAX_SIDE) -> np.ndarray:
+    """Escala de grises con el lado mayor ≈ max_side, reduciendo por bloques antes de convertir."""
+    factor = max(1, max(image.size) // max_side)
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.asarray(image.convert("L"))
+
+
+def _otsu_threshold(gray: np.ndarray) -> int:
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    total = histogram.sum()
+    levels = np.arange(256)
+    weight_low = np.cumsum(histogram)
+    weight_high = total - weight_low
+    cumulative_mean = np.cumsum(histogram * levels)
+    mean_low = cumulative_mean / np.maximum(weight_low, 1)
+    mean_high = (cumulative_mean[-1] - cumulative_mean) / np.maximum(weight_high, 1)
+    between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.argmax(between))
+
+
+def _run_lengths(mask: np.ndarray) -> np.ndarray:
+    """Largo de cada run de True por fila de `mask`."""
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return ends - starts
+
+
+def extract_features(gray: np.ndarray) -> Dict[str, float]:
+    """Features de una imagen en escala de grises (ya reducida)."""
+    height, width = gray.shape
+    light_ratio = float(np.mean(gray > 200))
+    # Otsu separa tinta de papel; el tope evita que un fondo apenas gris cuente como tinta
+    threshold = min(160, _otsu_threshold(gray))
+    ink = gray < threshold
+    ink_pixels = int(ink.sum())
+    features = dict.fromkeys(FEATURE_NAMES, 0.0)
+    features["light_ratio"] = light_ratio
+    features["ink_ratio"] = ink_pixels / ink.size
+    features["gray_ratio"] = float(np.mean((gray >= threshold) & (gray <= 200)))
+    if ink_pixels == 0:
+        return features
+
+    # Grosor de trazo: runs horizontales y verticales de tinta
+    runs = np.concatenate([_run_lengths(ink), _run_lengths(ink.T)])
+    features["run_median"] = math.log1p(float(np.median(runs)))
+    features["run_cv"] = float(runs.std() / max(runs.mean(), 1e-6))
+
+    # Componentes conexos: una firma son pocos trazos largos, un texto muchas letras de alto parecido
+    count, _, stats, _ = cv2.connectedComponentsWithStats(ink.view(np.uint8), connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= MIN_COMPONENT_AREA]
+    if len(stats):
+        areas = stats[:, cv2.CC_STAT_AREA].astype(np.float64)
+        heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float64)
+        boxes = heights * stats[:, cv2.CC_STAT_WIDTH]
+        features["components"] = math.log1p(len(stats))
+        features["largest_share"] = float(areas.max() / areas.sum())
+        features["height_cv"] = float(heights.std() / max(heights.mean(), 1e-6))
+        bins = np.digitize(heights / height, COMPONENT_HEIGHT_BINS)
+        for index, name in HEIGHT_FEATURES.items():
+            features[name] = float(np.mean(bins == index))
+        features["fill"] = float(np.mean(areas / np.maximum(boxes, 1)))
+
+    # Interlineado: bandas de filas con tinta (renglones de un documento)
+    rows = ink.any(axis=1)
+    features["row_bands"] = math.log1p(int(np.count_nonzero(np.diff(rows.astype(np.int8)) == 1)) + int(rows[0]))
+    ys = np.flatnonzero(rows)
+    xs = np.flatnonzero(ink.any(axis=0))
+    features["ink_extent"] = float((ys[-1] - ys[0] + 1) * (xs[-1] - xs[0] + 1) / (height * width))
+    return features
+
+
+def score_features(features: Dict[str, float], model: Optional[Dict[str, Any]] = None) -> float:
+    """Probabilidad de firma según el modelo logístico."""
+    model = model or _model
+    x = np.array([features[name] for name in model["features"]])
+    z = float(np.dot((x - model["mean"]) / model["std"], model["weights"]) + model["bias"])
+    return 1.0 / (1.0 + math.exp(-max(-60.0, min(60.0, z))))
+
+
+def ocr_signature_heuristic(image: Image.Image, ocr_confidence_threshold: float = 30.0) -> bool:
+    """
+    Heurística original: fondo blanco y confianza OCR baja (Tesseract) = firma.
+    Necesita pytesseract y el binario tesseract.
+    """
+    import pytesseract
+
+    gray = image.convert("L")
+    if np.mean(np.asarray(gray) > 200) < MIN_LIGHT_RATIO:
+        return False
+    # Enfocar las líneas finas y pasar a alto contraste
+    high_contrast = gray.filter(ImageFilter.SHARPEN).point(lambda x: 0 if x < 200 else 255)
+    ocr_config = r'--psm 6 --oem 3 -c tessedit_char_whitelist=abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    ocr_data = pytesseract.image_to_data(high_contrast, lang="eng", output_type=pytesseract.Output.DICT, config=ocr_config)
+    confidences = []
+    for conf in ocr_data['conf']:
+        try:
+            c = float(conf)
+            if c > 0:  # Ignorar valores negativos o cero
+                confidences.append(c)
+        except (ValueError, TypeError):
+            continue
+    return (max(confidences) if confidences else 0) <= ocr_confidence_threshold
+
+
+def detect_signature(image: Image.Image, ocr_confidence_threshold: float = 30.0) -> SignatureDecision:
+    """
+    Clasifica una imagen ya decodificada como firma o no.
+
+    Args:
+        image: Imagen completa (se reduce a SIGNATURE_DETECT_MAX_SIDE)
+        ocr_confidence_threshold: Corte de la heurística OCR, si se usa de fallback
+
+    Returns:
+        La decisión con su score, el método que decidió y lo que tardó
+    """
+    started = time.perf_counter()
+    features = extract_features(reduced_gray(image))
+    if features["light_ratio"] < MIN_LIGHT_RATIO:
+        # Sin fondo claro no es firma: ni siquiera hace falta el modelo
+        return SignatureDecision(False, 0.0, "light_ratio", time.perf_counter() - started, features)
+
+    score = score_features(features)
+    is_signature, method = score >= SIGNATURE_THRESHOLD, "classifier"
+    if SIGNATURE_OCR_FALLBACK and abs(score - SIGNATURE_THRESHOLD) < SIGNATURE_OCR_BAND:
+        try:
+            is_signature, method = ocr_signature_heuristic(image, ocr_confidence_threshold), "ocr"
+        except Exception as e:
+            logger.warning(f"⚠️ Fallback OCR fallido: {e}, se usa el clasificador")
+    return SignatureDecision(is_signature, score, method, time.perf_counter() - started, features)
+
+
+def _synthetic_sample(rng: np.random.Generator, kind: str, size: Tuple[int, int] = (1200, 800)) -> Image.Image:
+    """Firma, documento o producto sobre fondo blanco, para entrenar/medir sin un set real."""
+    width, height = size
+    canvas = np.full((height, width, 3), int(rng.integers(225, 256)), np.uint8)
+    canvas = np.clip(canvas + rng.normal(0, rng.uniform(0, 4), canvas.shape), 0, 255).astype(np.uint8)
+    ink = tuple(int(v) for v in rng.integers(0, 90, 3))
+    if kind == "signature":
+        for _ in range(int(rng.integers(1, 4))):
+            points, position = [], np.array([rng.uniform(0.15, 0.5) * width, rng.uniform(0.35, 0.65) * height])
+            velocity = rng.normal(0, 1, 2)
+            for _ in range(int(rng.integers(40, 120))):
+                velocity = 0.8 * velocity + rng.normal(0, 6, 2) * np.array([1.0, 1.6])
+                velocity[0] += 1.5
+                position = np.clip(position + velocity, 10, [width - 10, height - 10])
+                points.append(position.copy())
+            cv2.polylines(canvas, [np.array(points, np.int32)], False, ink, int(rng.integers(2, 6)), cv2.LINE_AA)
+        if rng.random() < 0.5:
+            y = int(height * rng.uniform(0.7, 0.85))
+            cv2.line(canvas, (int(width * 0.1), y), (int(width * 0.9), y), ink, int(rng.integers(1, 4)), cv2.LINE_AA)
+    elif kind == "document":
+        scale = rng.uniform(0.6, 1.2)
+        y = int(rng.integers(40, 90))
+        while y < height - 40:
+            words = "".join(rng.choice(list("abcdefghijklmnopqrstuvwxyz  "), int(rng.integers(20, 60))))
+            cv2.putText(canvas, words, (int(rng.integers(20, 60)), y), cv2.FONT_HERSHEY_SIMPLEX, scale, ink, 2, cv2.LINE_AA)
+            y += int(40 * scale + rng.integers(5, 25))
+            if rng.random() < 0.15:
+                y += 40
+    else:
+        center = (int(width * rng.uniform(0.35, 0.65)), int(height * rng.uniform(0.35, 0.65)))
+        axes = (int(width * rng.uniform(0.08, 0.2)), int(height * rng.uniform(0.08, 0.2)))
+        cv2.ellipse(canvas, center, axes, float(rng.uniform(0, 180)), 0, 360, ink, -1, cv2.LINE_AA)
+        cv2.GaussianBlur(canvas, (0, 0), float(rng.uniform(0.5, 3)), dst=canvas)
+    return Image.fromarray(cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB))
+
+
+def _load_dataset(data_dir: Optional[str], synthetic: int, seed: int = 0) -> List[Tuple[Image.Image, bool]]:
+    """Imágenes etiquetadas: data_dir/signature/* son firmas, cualquier otra subcarpeta no."""
+    samples: List[Tuple[Image.Image, bool]] = []
+    if data_dir:
+        from app.decoding import decode_image
+
+        for label in sorted(os.listdir(data_dir)):
+            folder = os.path.join(data_dir, label)
+            if not os.path.isdir(folder):
+                continue
+            for name in sorted(os.listdir(folder)):
+                with open(os.path.join(folder, name), "rb") as f:
+                    samples.append((decode_image(f.read()), label == "signature"))
+    rng = np.random.default_rng(seed)
+    for index in range(synthetic):
+        kind = ("signature", "document", "object")[index % 3]
+        samples.append((_synthetic_sample(rng, kind), kind == "signature"))
+    return samples
+
+
+def train(samples: List[Tuple[Image.Image, bool]], l2: float = 0.01, steps: int = 3000, lr: float = 0.1) -> Dict[str, Any]:
+    """Ajusta el modelo logístico (gradiente descendente con L2) sobre las imágenes de fondo claro."""
+    rows, labels = [], []
+    for image, label in samples:
+        features = extract_features(reduced_gray(image))
+        if features["light_ratio"] >= MIN_LIGHT_RATIO:
+            rows.append([features[name] for name in FEATURE_NAMES])
+            labels.append(float(label))
+    x, y = np.array(rows), np.array(labels)
+    mean, std = x.mean(axis=0), np.maximum(x.std(axis=0), 1e-3)
+    z = (x - mean) / std
+    weights, bias = np.zeros(z.shape[1]), 0.0
+    for _ in range(steps):
+        p = 1.0 / (1.0 + np.exp(-(z @ weights + bias)))
+        weights -= lr * (z.T @ (p - y) / len(y) + l2 * weights)
+        bias -= lr * float(np.mean(p - y))
+    return {
+        "features": list(FEATURE_NAMES),
+        "mean": [round(float(v), 4) for v in mean],
+        "std": [round(float(v), 4) for v in std],
+        "weights": [round(float(v), 4) for v in weights],
+        "bias": round(bias, 4),
+    }
+
+
+def benchmark(samples: List[Tuple[Image.Image, bool]], with_ocr: bool = True) -> Dict[str, Any]:
+    """Precisión y latencia del clasificador y de la heurística OCR sobre un set etiquetado."""
+    def summarize(predictions: List[bool], latencies: List[float]) -> Dict[str, Any]:
+        labels = [label for _, label in samples]
+        true_positive = sum(p and l for p, l in zip(predictions, labels))
+        latencies = sorted(latencies)
+        return {
+            "accuracy": round(sum(p == l for p, l in zip(predictions, labels)) / len(labels), 4),
+            "precision": round(true_positive / max(1, sum(predictions)), 4),
+            "recall": round(true_positive / max(1, sum(labels)), 4),
+            "p50_ms": round(1000 * latencies[len(latencies) // 2], 2),
+            "p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+        }
+
+    results: Dict[str, Any] = {"samples": len(samples), "signatures": sum(label for _, label in samples)}
+    decisions = [detect_signature(image) for image, _ in samples]
+    results["classifier"] = summarize([d.is_signature for d in decisions], [d.seconds for d in decisions])
+    if with_ocr:
+        predictions, latencies = [], []
+        try:
+            for image, _ in samples:
+                started = time.perf_counter()
+                predictions.append(ocr_signature_heuristic(image))
+                latencies.append(time.perf_counter() - started)
+            results["ocr"] = summarize(predictions, latencies)
+        except Exception as e:
+            results["ocr"] = f"unavailable: {e}"
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Entrenar y medir el detector de firmas")
+    parser.add_argument("command", choices=("train", "benchmark"))
+    parser.add_argument("--data", help="Carpeta con subcarpetas signature/ y de otras clases")
+    parser.add_argument("--synthetic", type=int, default=0, help="Cantidad de muestras sintéticas a agregar")
+    parser.add_argument("--output", default=SIGNATURE_MODEL_PATH, help="Dónde guardar el modelo entrenado")
+    parser.add_argument("--no-ocr", action="store_true", help="No medir la heurística OCR")
+    args = parser.parse_args()
+
+    dataset = _load_dataset(args.data, args.synthetic)
+    if not dataset:
+        parser.error("sin muestras: usar --data y/o --synthetic")
+    if args.command == "train":
+        trained = train(dataset)
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(trained, f, indent=2)
+        print(json.dumps(trained))
+    else:
+        print(json.dumps(benchmark(dataset, with_ocr=not args.no_ocr), indent=2))
@@ -0,0 +1,281 @@
+"""
+Shared diffusion runtime module.
+Loads the Stable Diffusion 1.x components once per process and builds the
+inpaint (enlarge-service) and img2img (style-transfer-service) pipelines on
+top of the same tokenizer, text encoder and VAE, so only the UNets are
+model-specific.
+
+`python -m app.diffusion` runs both pipelines in one combined inference
+sidecar: point both services' INFERENCE_SOCKET_PATH at its socket when they
+are co-located.
+"""
+
+import asyncio
+import logging
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from app.threads import thread_budget  # Before torch: exports the thread env vars
+
+import torch
+from diffusers import (
+    AutoencoderKL,
+    DPMSolverMultistepScheduler,
+    PNDMScheduler,
+    StableDiffusionImg2ImgPipeline,
+    StableDiffusionInpaintPipeline,
+    UNet2DConditionModel
+)
+from transformers import CLIPTextModel, CLIPTokenizer
+
+from app.config import (
+    MODELS_DIR,
+    DIFFUSION_BASE_MODEL,
+    DIFFUSION_INPAINT_MODEL,
+    INFERENCE_SOCKET_PATH,
+    INFERENCE_BATCH_WINDOW_MS
+)
+
+logger = logging.getLogger(__name__)
+
+# Pipeline names, also used as model names on the inference sidecar
+INPAINT = "sd-inpaint"
+IMG2IMG = "sd-img2img"
+
+# Components every pipeline gets from the runtime instead of its own checkpoint
+SHARED_COMPONENTS = ("tokenizer", "text_encoder", "vae")
+
+MB = 1024 * 1024
+
+
+def _module_bytes(module: Any) -> int:
+    if not isinstance(module, torch.nn.Module):
+        return 0
+    return sum(tensor.numel() * tensor.element_size() for tensor in list(module.parameters()) + list(module.buffers()))
+
+
+class DiffusionRuntime:
+    """
+    Builds Stable Diffusion pipelines that share text encoder, tokenizer and VAE.
+
+    The inpainting checkpoint was fine-tuned from SD 1.x with the text
+    encoder and VAE frozen, so its pipeline can use the base model's
+    modules and only needs its own 9-channel UNet. Pipelines are built on
+    first use and cached; every call to a cached pipeline goes through
+    `timed`, which runs it alone and records its latency.
+    """
+
+    def __init__(self, base_model: str, inpaint_model: str, cache_dir: Optional[str] = None, torch_dtype=torch.float32):
+        self.base_model = base_model
+        self.inpaint_model = inpaint_model
+        self.cache_dir = cache_dir
+        self.torch_dtype = torch_dtype
+        self._shared: Dict[str, Any] = {}
+        self._pipelines: Dict[str, Any] = {}
+        self._latency: Dict[str, Dict[str, float]] = {}
+        self._load_seconds: Dict[str, float] = {}
+        self._call_locks: Dict[str, threading.Lock] = {}
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._shared_lock = threading.Lock()
+        # Only guards the dicts and stats: never held while building or running a pipeline
+        self._lock = threading.Lock()
+
+    def _load_shared(self) -> Dict[str, Any]:
+        with self._shared_lock:
+            return self._load_shared_locked()
+
+    def _load_shared_locked(self) -> Dict[str, Any]:
+        if not self._shared:
+            started = time.perf_counter()
+            logger.info(f"Loading shared diffusion components from {self.base_model}")
+            options = {"cache_dir": self.cache_dir}
+            self._shared = {
+                "tokenizer": CLIPTokenizer.from_pretrained(self.base_model, subfolder="tokenizer", **options),
+                "text_encoder": CLIPTextModel.from_pretrained(
+                    self.base_model, subfolder="text_encoder", torch_dtype=self.torch_dtype, **options
+                ),
+                "vae": AutoencoderKL.from_pretrained(self.base_model, subfolder="vae", torch_dtype=self.torch_dtype, **options),
+            }
+            with self._lock:
+                self._load_seconds["shared"] = time.perf_counter() - started
+        return self._shared
+
+    def _load_unet(self, repo: str) -> UNet2DConditionModel:
+        return UNet2DConditionModel.from_pretrained(
+            repo, subfolder="unet", torch_dtype=self.torch_dtype, cache_dir=self.cache_dir
+        )
+
+    def _build(self, name: str) -> Any:
+        shared = self._load_shared()
+        started = time.perf_counter()
+        common = dict(shared, safety_checker=None, feature_extractor=None, requires_safety_checker=False)
+        if name == INPAINT:
+            pipeline = StableDiffusionInpaintPipeline(
+                unet=self._load_unet(self.inpaint_model),
+                scheduler=DPMSolverMultistepScheduler.from_pretrained(
+                    self.inpaint_model, subfolder="scheduler", cache_dir=self.cache_dir
+                ),
+                **common
+            )
+        elif name == IMG2IMG:
+            pipeline = StableDiffusionImg2ImgPipeline(
+                unet=self._load_unet(self.base_model),
+                scheduler=PNDMScheduler.from_pretrained(self.base_model, subfolder="scheduler", cache_dir=self.cache_dir),
+                **common
+            )
+        else:
+            raise ValueError(f"Unknown diffusion pipeline: {name}")
+        pipeline.to("cpu")
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self._load_seconds[name] = seconds
+        logger.info(f"Built {name} pipeline in {seconds:.1f}s")
+        return pipeline
+
+    def pipeline(self, name: str) -> Any:
+        """The cached INPAINT or IMG2IMG pipeline, built on first use."""
+        with self._lock:
+            pipeline = self._pipelines.get(name)
+            build_lock = self._build_locks.setdefault(name, threading.Lock())
+        if pipeline is not None:
+            return pipeline
+        # A cold build takes minutes: only callers of the same pipeline wait for it
+        with build_lock:
+            with self._lock:
+                pipeline = self._pipelines.get(name)
+            if pipeline is None:
+                pipeline = self._build(name)
+                with self._lock:
+                    self._pipelines[name] = pipeline
+            return pipeline
+
+    def inpaint_pipeline(self) -> StableDiffusionInpaintPipeline:
+        return self.pipeline(INPAINT)
+
+    def img2img_pipeline(self) -> StableDiffusionImg2ImgPipeline:
+        return self.pipeline(IMG2IMG)
+
+    def release(self, name: str) -> None:
+        """Drop a pipeline, and the shared components once no pipeline uses them."""
+        with self._lock:
+            self._pipelines.pop(name, None)
+            if not self._pipelines:
+                self._shared = {}
+
+    def _call_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._call_locks.setdefault(name, threading.Lock())
+
+    @contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        """
+        Run one pipeline call alone and record its latency.
+
+        The scheduler keeps per-call state (set_timesteps, step index), so
+        concurrent jobs on one pipeline would corrupt each other's denoising:
+        calls to the same pipeline are serialized, different pipelines overlap.
+        """
+        with self._call_lock(name):
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    stats = self._latency.setdefault(name, {"calls": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+                    stats["calls"] += 1
+                    stats["total_seconds"] += elapsed
+                    stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+                    stats["last_seconds"] = elapsed
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Loaded pipelines, memory saved by sharing components and per-pipeline latency."""
+        with self._lock:
+            pipelines = list(self._pipelines)
+            component_bytes = {name: _module_bytes(module) for name, module in self._shared.items()}
+            unet_bytes = {name: _module_bytes(pipeline.unet) for name, pipeline in self._pipelines.items()}
+            # Each pipeline beyond the first would otherwise hold its own copy of the shared modules
+            saved_bytes = sum(component_bytes.values()) * max(0, len(pipelines) - 1)
+            return {
+                "base_model": self.base_model,
+                "inpaint_model": self.inpaint_model,
+                "pipelines": pipelines,
+                "shared_components_mb": {name: round(size / MB) for name, size in component_bytes.items()},
+                "unet_mb": {name: round(size / MB) for name, size in unet_bytes.items()},
+                "total_mb": round((sum(component_bytes.values()) + sum(unet_bytes.values())) / MB),
+                "memory_saved_mb": round(saved_bytes / MB),
+                "load_seconds": {name: round(seconds, 1) for name, seconds in self._load_seconds.items()},
+                "latency": {
+                    name: {
+                        "calls": int(stats["calls"]),
+                        "avg_seconds": round(stats["total_seconds"] / stats["calls"], 2),
+                        "max_seconds": round(stats["max_seconds"], 2),
+                        "last_seconds": round(stats["last_seconds"], 2),
+                    }
+                    for name, stats in self._latency.items()
+                },
+                "timestamp": time.time(),
+            }
+
+
+_runtime: Optional[DiffusionRuntime] = None
+_runtime_lock = threading.Lock()
+
+
+def get_diffusion_runtime() -> DiffusionRuntime:
+    """The process-wide runtime, so every pipeline in the process shares one set of components."""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = DiffusionRuntime(DIFFUSION_BASE_MODEL, DIFFUSION_INPAINT_MODEL, cache_dir=MODELS_DIR)
+        return _runtime
+
+
+def timed_handler(name: str) -> Any:
+    """Sidecar handler for a cached pipeline, with its calls serialized and timed like in-process ones."""
+    from app.inference import ModelHandler, pipeline_handler
+
+    runtime = get_diffusion_runtime()
+    handler = pipeline_handler(runtime.pipeline(name))
+
+    def run(arrays, params, cancelled):
+        with runtime.timed(name):
+            return handler.run(arrays, params, cancelled)
+
+    return ModelHandler(run)
+
+
+def main() -> None:
+    """Combined inference sidecar serving both pipelines from one runtime."""
+    from app import inference
+    from app.inference import InferenceServer
+
+    if not INFERENCE_SOCKET_PATH:
+        raise SystemExit("INFERENCE_SOCKET_PATH is not set")
+    inference._serving = True
+
+    runtime = get_diffusion_runtime()
+    handlers = {name: timed_handler(name) for name in (INPAINT, IMG2IMG)}
+    thread_budget.configure_libraries()
+    stats = runtime.snapshot()
+    logger.info(
+        f"Diffusion runtime ready: {stats['total_mb']}MB for {', '.join(stats['pipelines'])}, "
+        f"{stats['memory_saved_mb']}MB saved by sharing {', '.join(SHARED_COMPONENTS)}"
+    )
+
+    async def run() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await InferenceServer(INFERENCE_SOCKET_PATH, handlers, INFERENCE_BATCH_WINDOW_MS).serve(stop)
+
+    asyncio.run(run())
+    logger.info(f"Diffusion runtime stopped: {runtime.snapshot()['latency']}")
+
+
+if __name__ == "__main__":
+    main()
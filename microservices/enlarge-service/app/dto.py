@@ -62,6 +62,8 @@ class JobMessageDTO(BaseModel):
     imageStoragePath: str
     jobType: JobType
     jobConfig: Optional[Dict[str, Any]] = Field(default_factory=dict)
+    enqueuedAt: Optional[int] = None  # Epoch millis when the backend published the job
+    deadline: Optional[int] = None  # Epoch millis after which the result is no longer useful
 
 class JobStatusUpdateRequestDTO(BaseModel):
     """
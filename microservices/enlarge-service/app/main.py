@@ -6,7 +6,9 @@ Handles image enlargement with generative fill and aspect ratio expansion.
 
 import json
 import asyncio
+import signal
 import logging
+import time
 import traceback
 from typing import Dict, Any, Optional
 
@@ -14,7 +16,7 @@ import aio_pika
 import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.responses import JSONResponse
-from aio_pika.abc import AbstractIncomingMessage, AbstractRobustConnection
+from aio_pika.abc import AbstractChannel, AbstractIncomingMessage, AbstractQueue, AbstractRobustConnection
 
 from app.config import (
     RABBITMQ_URL,
@@ -24,9 +26,44 @@ from app.config import (
     SPRING_BOOT_CALLBACK_URL_TEMPLATE,
     validate_config,
     SERVICE_HOST,
-    SERVICE_PORT
+    SERVICE_PORT,
+    SHORT_LANE_WORKERS,
+    LONG_LANE_WORKERS,
+    SHORT_LANE_MAX_COST,
+    COST_PROBE_TIMEOUT,
+    CONSUMER_PREFETCH,
+    JOB_MAX_AGE_SECONDS,
+    SHED_QUEUE_DEPTH,
+    SHED_RECOVERY_DEPTH,
+    SHED_SUSTAIN_SECONDS,
+    QUEUE_DEPTH_SAMPLE_INTERVAL,
+    DEGRADE_ENTER_DEPTH,
+    DEGRADE_EXIT_DEPTH,
+    DEGRADE_ENTER_WAIT_SECONDS,
+    DEGRADE_EXIT_WAIT_SECONDS,
+    CANCEL_EXCHANGE_NAME,
+    MEMORY_ADMISSION_ENABLED,
+    MEMORY_HEADROOM_MB,
+    MEMORY_ADMISSION_MAX_WAIT_SECONDS,
+    MEMORY_POLL_INTERVAL_SECONDS,
+    DRAIN_GRACE_SECONDS,
+    CALLBACK_FLUSH_TIMEOUT_SECONDS,
+    CALLBACK_RETRY_INTERVAL_SECONDS,
+    CALLBACK_OUTBOX_MAX_SIZE,
+    PREVIEW_ENABLED,
+    PREVIEW_MIN_COST,
+    PREVIEW_MAX_SIDE,
+    PREVIEW_JPEG_QUALITY
 )
-from app.processing import perform_image_enlargement, ImageProcessingError
+from app.threads import thread_budget  # Before processing: exports the thread env vars ahead of numpy/torch
+from app.processing import perform_image_enlargement, estimate_job_cost, estimate_peak_memory, DEGRADED_MODE_OVERRIDES, ImageProcessingError
+from app.scheduling import LaneScheduler, probe_image
+from app.admission import LoadShedder, DegradationPolicy, check_deadline, get_job_tier, EXPIRED_REASON, SHED_REASON
+from app.cancellation import cancellation_registry, JobCancelledError
+from app.memory import MemoryAdmissionController, MemoryAdmissionRejected
+from app.diffusion import get_diffusion_runtime
+from app.lifecycle import DrainCoordinator, CallbackOutbox
+from app.preview import PreviewPublisher, JobPreview
 from app.dto import JobMessageDTO, JobStatusUpdateRequestDTO, JobStatus
 from app.cloudinary_config import *  # Initialize Cloudinary configuration
 
@@ -43,6 +80,41 @@ app = FastAPI(
 # Global variables for the RabbitMQ connection and HTTP client
 rabbitmq_connection: Optional[AbstractRobustConnection] = None
 http_client: Optional[httpx.AsyncClient] = None
+consume_queue: Optional[AbstractQueue] = None
+consumer_tag: Optional[str] = None
+drain_task: Optional[asyncio.Task] = None
+
+# Size-aware lanes so small enlargements don't wait behind large ones
+lane_scheduler = LaneScheduler(
+    SHORT_LANE_WORKERS, LONG_LANE_WORKERS, SHORT_LANE_MAX_COST, thread_initializer=thread_budget.slot_initializer()
+)
+
+# Drops expired jobs and, under sustained overload, FREE-tier jobs first
+load_shedder = LoadShedder(SHED_QUEUE_DEPTH, SHED_SUSTAIN_SECONDS, SHED_RECOVERY_DEPTH)
+
+# Cheaper processing modes while the backlog is high
+degradation_policy = DegradationPolicy(
+    DEGRADE_ENTER_DEPTH,
+    DEGRADE_EXIT_DEPTH,
+    DEGRADE_ENTER_WAIT_SECONDS,
+    DEGRADE_EXIT_WAIT_SECONDS,
+    DEGRADED_MODE_OVERRIDES
+)
+
+# Reserve each job's estimated peak memory before it runs
+memory_admission = MemoryAdmissionController(
+    MEMORY_HEADROOM_MB * 1024 * 1024,
+    MEMORY_ADMISSION_MAX_WAIT_SECONDS,
+    MEMORY_POLL_INTERVAL_SECONDS,
+    MEMORY_ADMISSION_ENABLED
+)
+
+# Drain state for graceful shutdown and callbacks waiting to be redelivered
+drain_coordinator = DrainCoordinator()
+callback_outbox = CallbackOutbox(CALLBACK_OUTBOX_MAX_SIZE)
+
+# Vista previa rápida para los trabajos lentos, antes del resultado final
+preview_publisher = PreviewPublisher(PREVIEW_ENABLED, PREVIEW_MIN_COST, PREVIEW_MAX_SIDE, PREVIEW_JPEG_QUALITY)
 
 @app.on_event("startup")
 async def startup_event():
@@ -53,6 +125,8 @@ async def startup_event():
         # Validate configuration
         validate_config()
         
+        thread_budget.configure_libraries()
+        
         # Create HTTP client for callbacks
         http_client = httpx.AsyncClient(timeout=30.0)
         
@@ -70,6 +144,9 @@ async def shutdown_event():
     
     logger.info("Shutting down the service...")
     
+    # Stop taking jobs and let the in-flight ones finish before closing anything
+    await start_drain()
+    
     # Close HTTP client
     if http_client:
         await http_client.aclose()
@@ -80,6 +157,9 @@ async def shutdown_event():
         await rabbitmq_connection.close()
         rabbitmq_connection = None
     
+    lane_scheduler.shutdown(wait=False)
+    preview_publisher.shutdown()
+    
     logger.info("Service shutdown completed")
 
 @app.get("/health")
@@ -90,17 +170,72 @@ async def health_check():
     
     return JSONResponse(
         content={
-            "status": "healthy" if rabbitmq_status == "connected" else "degraded",
+            "status": "draining" if drain_coordinator.draining else ("healthy" if rabbitmq_status == "connected" else "degraded"),
             "services": {
                 "rabbitmq": rabbitmq_status,
                 "cloudinary": "configured",
                 "generative_fill": "available"
             }
         },
-        status_code=200 if rabbitmq_status == "connected" else 503
+        status_code=200 if rabbitmq_status == "connected" and not drain_coordinator.draining else 503
     )
 
-async def send_status_update(job_id: str, status_update: JobStatusUpdateRequestDTO) -> bool:
+@app.get("/metrics/lanes")
+async def lane_metrics():
+    """Per-lane queue and latency metrics."""
+    return JSONResponse(content=lane_scheduler.snapshot())
+
+@app.get("/metrics/admission")
+async def admission_metrics():
+    """Expired and shed job counters, overload and degraded-mode state."""
+    return JSONResponse(content={
+        **load_shedder.snapshot(),
+        "degradation": degradation_policy.snapshot(),
+    })
+
+@app.get("/metrics/cancellation")
+async def cancellation_metrics():
+    """Cancelled job ids and skip/abort counters."""
+    return JSONResponse(content=cancellation_registry.snapshot())
+
+@app.get("/metrics/memory")
+async def memory_metrics():
+    """Available memory, per-job reservations and memory admission decisions."""
+    return JSONResponse(content=memory_admission.snapshot())
+
+@app.get("/metrics/threads")
+async def thread_metrics():
+    """CPU budget per job slot and the thread counts applied to each library."""
+    return JSONResponse(content=thread_budget.snapshot())
+
+@app.get("/metrics/previews")
+async def preview_metrics():
+    """Previews started, delivered and failed for slow jobs."""
+    return JSONResponse(content=preview_publisher.snapshot())
+
+@app.get("/metrics/diffusion")
+async def diffusion_metrics():
+    """Pipelines built by the shared diffusion runtime, memory saved by sharing components and per-pipeline latency."""
+    return JSONResponse(content=get_diffusion_runtime().snapshot())
+
+@app.post("/admin/drain")
+async def drain_service():
+    """Start draining for a rolling deploy: stop consuming, finish in-flight jobs and flush pending callbacks."""
+    start_drain()
+    return JSONResponse(content=drain_status_snapshot(), status_code=202)
+
+@app.get("/admin/drain")
+async def drain_status():
+    """Drain progress: in-flight jobs and callbacks still pending."""
+    return JSONResponse(content=drain_status_snapshot())
+
+@app.post("/admin/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    """Cancel a job: queued copies are skipped and a running job aborts at its next stage or denoising step."""
+    cancellation_registry.mark_cancelled(job_id, "admin endpoint")
+    return JSONResponse(content={"jobId": job_id, "cancelled": True})
+
+async def post_status_update(job_id: str, status_update: JobStatusUpdateRequestDTO) -> bool:
     """
     Send a status update to the Spring Boot backend.
     
@@ -141,9 +276,73 @@ async def send_status_update(job_id: str, status_update: JobStatusUpdateRequestD
         logger.error(f"Callback request error for job {job_id}: {e}")
         return False
 
+async def send_status_update(job_id: str, status_update: JobStatusUpdateRequestDTO) -> bool:
+    """
+    Send a status update, keeping it in the callback outbox for retry if it
+    can't be delivered. A delivered update makes any older pending one obsolete.
+    """
+    delivered = await post_status_update(job_id, status_update)
+    if delivered:
+        callback_outbox.discard(job_id)
+    else:
+        callback_outbox.put(job_id, status_update)
+    return delivered
+
+async def reject_job(job_id: str, message: AbstractIncomingMessage, reason: str, detail: str) -> None:
+    """
+    Fail a job without processing it and drop its message.
+    
+    The backend has no EXPIRED status, so expired and shed jobs are reported
+    as FAILED with the reason in the error message and processing params.
+    """
+    failed_status = JobStatusUpdateRequestDTO(
+        status=JobStatus.FAILED,
+        processingParams={"rejectReason": reason},
+        errorMessage=f"{reason}: {detail}"
+    )
+    await send_status_update(job_id, failed_status)
+    await message.ack()
+
+async def sample_queue_depth(queue: AbstractQueue) -> None:
+    """Feed the load policies with the current queue depth (re-declaring an existing queue is a no-op)."""
+    try:
+        declaration = await queue.declare()
+        load_shedder.record_queue_depth(declaration.message_count)
+        degradation_policy.update(
+            declaration.message_count,
+            lane_scheduler.mean_service_seconds(),
+            lane_scheduler.total_workers
+        )
+    except Exception as e:
+        logger.debug(f"Queue depth sample failed: {e}")
+
+async def process_cancellation(message: AbstractIncomingMessage) -> None:
+    """Mark the job ids of a cancellation broadcast as cancelled."""
+    try:
+        data = json.loads(message.body.decode("utf-8"))
+        job_ids = data.get("jobIds") or [data.get("jobId")]
+        for cancelled_job_id in job_ids:
+            if cancelled_job_id:
+                cancellation_registry.mark_cancelled(str(cancelled_job_id), data.get("reason"))
+    except (json.JSONDecodeError, AttributeError) as e:
+        logger.error(f"Invalid cancellation message: {e}")
+    await message.ack()
+
+async def start_cancellation_listener(channel: AbstractChannel) -> None:
+    """Consume cancellations through an exclusive queue so every instance sees every broadcast."""
+    exchange = await channel.declare_exchange(
+        CANCEL_EXCHANGE_NAME,
+        aio_pika.ExchangeType.FANOUT,
+        durable=True
+    )
+    queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+    await queue.bind(exchange)
+    await queue.consume(process_cancellation)
+    logger.info(f"Listening for job cancellations on exchange: {CANCEL_EXCHANGE_NAME}")
+
 MAX_RETRIES = 3  # Maximum number of attempts allowed
 
-async def process_message(message: AbstractIncomingMessage) -> None:
+async def handle_message(message: AbstractIncomingMessage) -> None:
     """
     Process a message from RabbitMQ with retry logic and status updates visible to frontend.
     
@@ -152,6 +351,12 @@ async def process_message(message: AbstractIncomingMessage) -> None:
     """
     job_id = "unknown"
     retry_count = 0
+    lane = None
+    scheduling_info: Dict[str, Any] = {}
+    degraded_overrides: Dict[str, Any] = {}
+    estimated_memory: Optional[int] = None
+    degraded_memory: Optional[int] = None
+    preview: Optional[JobPreview] = None
 
     while retry_count <= MAX_RETRIES:
         try:
@@ -172,6 +377,29 @@ async def process_message(message: AbstractIncomingMessage) -> None:
                 await message.ack()
                 return
 
+            # Skip jobs that were cancelled while queued
+            if cancellation_registry.is_cancelled(job_id):
+                cancellation_registry.record_skipped()
+                logger.info(f"Skipping cancelled job {job_id}")
+                await message.ack()
+                return
+
+            # Fail expired jobs before downloading anything
+            expired_reason = check_deadline(job_dto.enqueuedAt, job_dto.deadline, JOB_MAX_AGE_SECONDS)
+            if expired_reason:
+                load_shedder.record_expired()
+                logger.warning(f"Job {job_id} expired: {expired_reason}")
+                await reject_job(job_id, message, EXPIRED_REASON, expired_reason)
+                return
+
+            # Under sustained overload, shed the cheaper tiers first
+            tier = get_job_tier(job_dto.jobConfig)
+            if retry_count == 0 and load_shedder.should_shed(tier):
+                load_shedder.record_shed(tier)
+                logger.warning(f"Shedding {tier} job {job_id}: queue depth {load_shedder.queue_depth}")
+                await reject_job(job_id, message, SHED_REASON, f"service overloaded, {tier} jobs are being shed")
+                return
+
             # Send PROCESSING status on first attempt, RETRYING on subsequent attempts
             if retry_count == 0:
                 status_update = JobStatusUpdateRequestDTO(status=JobStatus.PROCESSING)
@@ -182,12 +410,54 @@ async def process_message(message: AbstractIncomingMessage) -> None:
                 )
             await send_status_update(job_id, status_update)
 
+            # Estimate the job cost from a header probe before downloading the image
+            if lane is None:
+                # Under load, switch to the cheaper mode and record the downgrade
+                degraded_overrides = degradation_policy.overrides_for_job()
+                probe = await asyncio.to_thread(probe_image, job_dto.imageStoragePath, COST_PROBE_TIMEOUT)
+                estimated_cost = estimate_job_cost(probe, {**(job_dto.jobConfig or {}), **degraded_overrides})
+                estimated_memory = estimate_peak_memory(probe, {**(job_dto.jobConfig or {}), **degraded_overrides})
+                if not degraded_overrides:
+                    degraded_memory = estimate_peak_memory(probe, {**(job_dto.jobConfig or {}), **DEGRADED_MODE_OVERRIDES})
+                lane = lane_scheduler.select_lane(estimated_cost)
+                scheduling_info = {
+                    "schedulingLane": lane,
+                    "estimatedCost": round(estimated_cost, 3) if estimated_cost is not None else None,
+                    "inputProbe": probe.to_dict(),
+                    **degradation_policy.describe(degraded_overrides),
+                }
+                logger.info(f"Job {job_id} routed to {lane} lane (estimated cost: {estimated_cost})")
+
+            # Wait until the estimated peak memory fits; otherwise degrade or requeue
+            memory_grant = await memory_admission.acquire(job_id, estimated_memory, degraded_memory)
+            if memory_grant.rerouted:
+                # Not enough memory for the normal mode: run the cheaper one instead
+                degraded_overrides = dict(DEGRADED_MODE_OVERRIDES)
+                degraded_memory = None
+                scheduling_info["degradeOverrides"] = degraded_overrides
+            # La vista previa se crea en el primer intento; los reintentos la conservan hasta el estado final
+            if retry_count == 0:
+                preview = preview_publisher.start(job_id, estimated_cost, send_status_update)
             # Perform image enlargement with Cloudinary integration
-            processed_image_url, processing_params = await perform_image_enlargement(
-                job_id,
-                job_dto.imageStoragePath,  # This is now a Cloudinary URL
-                job_dto.jobConfig or {}
-            )
+            try:
+                processed_image_url, processing_params = await lane_scheduler.run(
+                    lane,
+                    perform_image_enlargement,
+                    job_id,
+                    job_dto.imageStoragePath,  # This is now a Cloudinary URL
+                    {**(job_dto.jobConfig or {}), **degraded_overrides},
+                    preview=preview
+                )
+            finally:
+                memory_admission.release(job_id)
+                # La actualización de la vista previa no puede llegar después de la final
+                await preview_publisher.settle(preview)
+            processing_params = {
+                **processing_params,
+                **scheduling_info,
+                **memory_grant.to_params(),
+                **(preview.to_params() if preview else {}),
+            }
 
             # Send COMPLETED status update with Cloudinary URL
             completed_status = JobStatusUpdateRequestDTO(
@@ -196,6 +466,7 @@ async def process_message(message: AbstractIncomingMessage) -> None:
                 processingParams=processing_params
             )
             await send_status_update(job_id, completed_status)
+            preview_publisher.discard(preview)
 
             # Acknowledge the message on successful processing
             await message.ack()
@@ -207,6 +478,19 @@ async def process_message(message: AbstractIncomingMessage) -> None:
             await message.nack(requeue=False)
             return  # Don't retry if JSON is invalid
         
+        except MemoryAdmissionRejected as e:
+            preview_publisher.discard(preview)
+            logger.warning(f"Requeueing job {job_id}: {e}")
+            await message.nack(requeue=True)
+            return
+
+        except JobCancelledError as e:
+            cancellation_registry.record_aborted()
+            preview_publisher.discard(preview)
+            logger.info(f"Job {job_id} aborted: {e}")
+            await message.ack()
+            return
+
         except Exception as e:
             retry_count += 1
             logger.error(f"Error processing job {job_id} on attempt {retry_count}: {e}")
@@ -219,6 +503,7 @@ async def process_message(message: AbstractIncomingMessage) -> None:
                     errorMessage=str(e)
                 )
                 await send_status_update(job_id, failed_status)
+                preview_publisher.discard(preview)
                 await message.nack(requeue=False)
                 return
             else:
@@ -234,12 +519,73 @@ async def process_message(message: AbstractIncomingMessage) -> None:
     # In case of unexpected error outside try, we don't want the message to remain unacknowledged
     await message.nack(requeue=False)
 
+async def process_message(message: AbstractIncomingMessage) -> None:
+    """Handle a delivery, or hand it back to the queue if the service is draining."""
+    if drain_coordinator.draining:
+        drain_coordinator.record_requeued()
+        await message.nack(requeue=True)
+        return
+    with drain_coordinator.track(str(message.delivery_tag)):
+        await handle_message(message)
+
+async def drain() -> Dict[str, Any]:
+    """
+    Stop consuming, wait up to DRAIN_GRACE_SECONDS for in-flight jobs and
+    flush the callback outbox. Messages still unacked after the grace period
+    are redelivered by RabbitMQ once the connection closes.
+    """
+    drain_coordinator.start()
+    if consume_queue is not None and consumer_tag is not None:
+        try:
+            await consume_queue.cancel(consumer_tag)
+            logger.info(f"Consumer {consumer_tag} cancelled")
+        except Exception as e:
+            logger.warning(f"Failed to cancel consumer {consumer_tag}: {e}")
+
+    drained = await drain_coordinator.wait_idle(DRAIN_GRACE_SECONDS)
+    pending_callbacks = await callback_outbox.flush(post_status_update, CALLBACK_FLUSH_TIMEOUT_SECONDS)
+    return {"drained": drained, "pending_callbacks": pending_callbacks}
+
+def start_drain() -> asyncio.Task:
+    """Start draining once; later calls (e.g. SIGTERM after /admin/drain) get the same task."""
+    global drain_task
+    if drain_task is None:
+        drain_task = asyncio.create_task(drain())
+    return drain_task
+
+def drain_status_snapshot() -> Dict[str, Any]:
+    return {
+        **drain_coordinator.snapshot(),
+        "completed": drain_task is not None and drain_task.done(),
+        "callback_outbox": callback_outbox.snapshot(),
+    }
+
+async def run_worker(worker) -> None:
+    """
+    Entry point of a worker forked by app.supervisor: runs the consumer
+    without uvicorn until SIGTERM or until the worker has done its share of
+    jobs, then drains and closes like a normal shutdown.
+    """
+    await startup_event()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+        worker.publish(drain_coordinator.completed)
+        if worker.should_recycle(drain_coordinator.completed):
+            logger.info(f"Worker {worker.index} reached {drain_coordinator.completed} jobs, recycling")
+            break
+    await shutdown_event()
+
 async def start_rabbitmq_consumer() -> None:
     """
     Connect to RabbitMQ and start consuming messages.
     Implements retry logic for connection failures.
     """
-    global rabbitmq_connection
+    global rabbitmq_connection, consume_queue, consumer_tag
     
     retry_delay = 5  # seconds
     max_retries = 12  # 1 minute at 5 second intervals
@@ -255,8 +601,8 @@ async def start_rabbitmq_consumer() -> None:
             # Create a channel
             channel = await rabbitmq_connection.channel()
             
-            # Set QoS to process one message at a time
-            await channel.set_qos(prefetch_count=1)
+            # Prefetch enough messages to keep both lanes busy
+            await channel.set_qos(prefetch_count=CONSUMER_PREFETCH)
             
             # Declare the exchange
             exchange = await channel.declare_exchange(
@@ -281,15 +627,27 @@ async def start_rabbitmq_consumer() -> None:
             logger.info("Cloudinary integration enabled for image enlargement processing")
             
             # Start consuming messages
-            await queue.consume(process_message)
+            consume_queue = queue
+            consumer_tag = await queue.consume(process_message)
+            await start_cancellation_listener(channel)
             
-            # Keep the connection alive
+            # Keep the connection alive, sampling queue depth for the load policies
+            last_depth_sample = 0.0
+            last_outbox_flush = 0.0
             while True:
                 await asyncio.sleep(1)
-                if rabbitmq_connection.is_closed:
+                if rabbitmq_connection is None or rabbitmq_connection.is_closed:
                     break
+                if (load_shedder.enabled or degradation_policy.enabled) and time.monotonic() - last_depth_sample >= QUEUE_DEPTH_SAMPLE_INTERVAL:
+                    last_depth_sample = time.monotonic()
+                    await sample_queue_depth(queue)
+                if callback_outbox.pending_count and time.monotonic() - last_outbox_flush >= CALLBACK_RETRY_INTERVAL_SECONDS:
+                    last_outbox_flush = time.monotonic()
+                    await callback_outbox.flush(post_status_update, CALLBACK_FLUSH_TIMEOUT_SECONDS)
             
             logger.info("RabbitMQ connection closed")
+            if drain_coordinator.draining:
+                break
             
         except aio_pika.exceptions.AMQPError as e:
             logger.error(f"RabbitMQ connection error: {e}")
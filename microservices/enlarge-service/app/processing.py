@@ -3,14 +3,22 @@ import os
 import cv2
 import numpy as np
 
-from typing import Dict, Tuple, Any, Literal
+from typing import Dict, Tuple, Any, Literal, Optional
 from PIL import Image, ImageFilter
 import torch
-from diffusers import StableDiffusionInpaintPipeline, DPMSolverMultistepScheduler
+from diffusers import StableDiffusionInpaintPipeline
 import gc
 
 from app.cloudinary_service import CloudinaryService
-from app.config import MODELS_DIR
+from app.config import MODELS_DIR, MODEL_MEMORY_MB
+from app.scheduling import ImageProbe
+from app.cancellation import cancellation_registry, diffusers_cancel_kwargs, JobCancelledError
+from app.inference import ModelHandler, RemotePipeline, get_inference_client
+from app.diffusion import INPAINT, get_diffusion_runtime, timed_handler
+from app.preview import JobPreview
+from app.decoding import decode_bgr
+from app.encoding import encode_bgr, select_preset
+from app.thumbnails import publish_result
 
 logger = logging.getLogger(__name__)
 
@@ -20,34 +28,45 @@ class ImageProcessingError(Exception):
 
 AspectRatio = Literal["portrait", "landscape", "square"]
 
+# Límite del canvas generado (múltiplo de 8) y pasos de difusión por defecto (y máximos)
+MAX_CANVAS_RESOLUTION = 640
+NUM_INFERENCE_STEPS = 40
+# Memoria de activaciones de la UNet para un canvas de 512x512, en MB
+UNET_ACTIVATION_MB_512 = 1500
+# Entrada BGR más las copias float32 del blending, por píxel de entrada
+IMAGE_BYTES_PER_PIXEL = 40
+
+# Modo degradado bajo carga: menos pasos de difusión (un tope; no sube los que pidió el job)
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"max_inference_steps": 20}
+
+# Procesador cargado una sola vez por el supervisor antes del fork; los workers
+# comparten sus pesos copy-on-write en lugar de cargar el pipeline en cada job
+_shared_processor: Optional["MVPGenerativeFillProcessor"] = None
+
 class MVPGenerativeFillProcessor:
     """MVP Ultra ligero - Solo Stable Diffusion con configuración mejorada para outpainting horizontal y vertical"""
 
     def __init__(self):
         self.device = "cpu"
-        self.max_resolution = 640  # Resolución conservadora (ya es múltiplo de 8)
+        self.max_resolution = MAX_CANVAS_RESOLUTION  # Resolución conservadora (ya es múltiplo de 8)
         self.model_loaded = False
         
-        # Initialize pipeline first
-        try:
-            # Replace "your-model-name" with the actual model you want to use
-            self.pipeline = StableDiffusionInpaintPipeline.from_pretrained(
-                "runwayml/stable-diffusion-inpainting",  # or your preferred model
-                torch_dtype=torch.float32,  # Use float32 for CPU
-                device_map="cpu"
-            )
-            
-            # Now you can safely configure the scheduler
-            self.pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-                self.pipeline.scheduler.config
-            )
-            
+        # Con el sidecar de inferencia el pipeline vive en otro proceso
+        inference_client = get_inference_client()
+        if inference_client is not None:
+            self.pipeline = RemotePipeline(inference_client, INPAINT)
             self.model_loaded = True
+        else:
+            # Initialize pipeline first: the shared runtime builds it with the DPM-Solver
+            # scheduler, reusing text encoder and VAE with any other pipeline in the process
+            try:
+                self.pipeline = get_diffusion_runtime().inpaint_pipeline()
+                self.model_loaded = True
             
-        except Exception as e:
-            print(f"Error loading pipeline: {e}")
-            self.pipeline = None
-            self.model_loaded = False
+            except Exception as e:
+                print(f"Error loading pipeline: {e}")
+                self.pipeline = None
+                self.model_loaded = False
        
         self.base_prompts = {
     "landscape": (
@@ -401,8 +420,12 @@ class MVPGenerativeFillProcessor:
         
         return canvas, mask, original_bounds
 
-    def _generate_fill(self, canvas: Image.Image, mask: Image.Image, aspect: AspectRatio, original_image: np.ndarray) -> Image.Image:
-        """Generar el fill usando prompt específico para el aspecto y contenido de la imagen"""
+    def _generate_fill(self, canvas: Image.Image, mask: Image.Image, aspect: AspectRatio, original_image: np.ndarray,
+                       job_id: Optional[str] = None, num_inference_steps: int = NUM_INFERENCE_STEPS) -> Image.Image:
+        """Generar el fill usando prompt específico para el aspecto y contenido de la imagen.
+
+        Si se pasa job_id, la difusión se aborta en el siguiente paso cuando el job se cancela.
+        """
         try:
             self._clear_memory()
 
@@ -419,24 +442,30 @@ class MVPGenerativeFillProcessor:
             logger.info(f"Content analysis: {content_description}")
             logger.info(f"Canvas dimensions: {canvas_w}x{canvas_h}")
 
+            cancel_kwargs = diffusers_cancel_kwargs(self.pipeline, job_id) if job_id else {}
+
             # CONFIGURACIÓN OPTIMIZADA para generative fill efectivo
-            result = self.pipeline(
-            prompt=enhanced_prompt,
-            negative_prompt=self.negative_prompt,
-            image=canvas,
-            mask_image=mask,
-            num_inference_steps=40,        # Más pasos
-            guidance_scale=12,              # Intermedio - ni muy alto ni muy bajo
-            strength=0.99,                  # Intermedio - suficiente para generar
-            eta=0.0,
-            height=canvas_h,
-            width=canvas_w,
-            
-        ).images[0]
+            with get_diffusion_runtime().timed(INPAINT):
+                result = self.pipeline(
+                prompt=enhanced_prompt,
+                negative_prompt=self.negative_prompt,
+                image=canvas,
+                mask_image=mask,
+                num_inference_steps=num_inference_steps,        # Más pasos
+                guidance_scale=12,              # Intermedio - ni muy alto ni muy bajo
+                strength=0.99,                  # Intermedio - suficiente para generar
+                eta=0.0,
+                height=canvas_h,
+                width=canvas_w,
+                **cancel_kwargs
+            ).images[0]
 
             logger.info("Fill generation completed")
             return result
 
+        except JobCancelledError:
+            logger.info("Fill generation aborted: job cancelled")
+            raise
         except Exception as e:
             logger.error(f"Fill generation failed: {e}")
             raise
@@ -522,8 +551,21 @@ class MVPGenerativeFillProcessor:
         logger.info(f"Original image overlaid with {blend_margin}px soft blending")
         return result
 
+    def _publish_preview(self, canvas: Image.Image, mask: Image.Image, preview: JobPreview) -> None:
+        """Rellenar el canvas con OpenCV TELEA a tamaño de preview, mientras corre la difusión"""
+        try:
+            size = preview.fit(*canvas.size)
+            small_canvas = cv2.resize(cv2.cvtColor(np.array(canvas), cv2.COLOR_RGB2BGR), size, interpolation=cv2.INTER_AREA)
+            small_mask = cv2.resize(np.array(mask.convert("L")), size, interpolation=cv2.INTER_NEAREST)
+            small_mask = np.where(small_mask > 128, 255, 0).astype(np.uint8)
+            preview.publish(cv2.inpaint(small_canvas, small_mask, 5, cv2.INPAINT_TELEA), "opencv_telea")
+        except Exception as e:
+            logger.warning(f"Preview fill failed: {e}")
+
     def process(self, input_image: np.ndarray, target_aspect: AspectRatio, 
-                preserve_original: bool = True, blend_margin: int = 10) -> np.ndarray:
+                preserve_original: bool = True, blend_margin: int = 10,
+                job_id: Optional[str] = None, num_inference_steps: int = NUM_INFERENCE_STEPS,
+                preview: Optional[JobPreview] = None) -> np.ndarray:
         """
         Función principal de procesamiento - siempre agranda la imagen
         
@@ -532,6 +574,9 @@ class MVPGenerativeFillProcessor:
             target_aspect: Aspecto deseado (portrait, landscape, square)
             preserve_original: Si True, superpone la imagen original sobre el resultado
             blend_margin: Margen en píxeles para el blending suave (0 = sin blending)
+            job_id: Si se pasa, el procesamiento se aborta entre etapas y entre pasos de difusión al cancelarse el job
+            num_inference_steps: Pasos de difusión (menos pasos en modo degradado)
+            preview: Si se pasa, recibe un relleno rápido con OpenCV antes de la difusión
         """
         try:
             # Cargar modelo
@@ -557,8 +602,16 @@ class MVPGenerativeFillProcessor:
             # Crear canvas y máscara para agrandamiento
             canvas, mask, original_bounds = self._create_canvas_and_mask(input_image, target_w, target_h, target_aspect)
 
+            if preview is not None and preview.wanted:
+                self._publish_preview(canvas, mask, preview)
+
             # Generar el fill con prompt específico
-            result_pil = self._generate_fill(canvas, mask, target_aspect, input_image)
+            if job_id:
+                cancellation_registry.check(job_id, "generative fill")
+            result_pil = self._generate_fill(
+                canvas, mask, target_aspect, input_image,
+                job_id=job_id, num_inference_steps=num_inference_steps
+            )
 
             # Si preserve_original está habilitado, superponer la imagen original
             if preserve_original:
@@ -577,6 +630,8 @@ class MVPGenerativeFillProcessor:
             
             return result_bgr
 
+        except JobCancelledError:
+            raise
         except Exception as e:
             logger.error(f"Processing failed: {e}")
             raise
@@ -584,11 +639,80 @@ class MVPGenerativeFillProcessor:
             self._clear_memory()
 
 
+def get_inference_steps(config: Dict[str, Any]) -> int:
+    """Pasos de difusión del job: jobConfig["num_inference_steps"] entre 1 y NUM_INFERENCE_STEPS,
+    con el tope de jobConfig["max_inference_steps"] (modo degradado) si lo hay."""
+    try:
+        steps = max(1, min(int(config.get('num_inference_steps', NUM_INFERENCE_STEPS)), NUM_INFERENCE_STEPS))
+        max_steps = config.get('max_inference_steps')
+        if max_steps is not None:
+            steps = max(1, min(steps, int(max_steps)))
+    except (TypeError, ValueError):
+        steps = NUM_INFERENCE_STEPS
+    return steps
+
+
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """Estimar el costo del job como megapíxeles del canvas por pasos de difusión.
+
+    El canvas crece ~1.4x sobre el lado mayor de la entrada hasta
+    MAX_CANVAS_RESOLUTION, así que imágenes chicas generan canvas chicos.
+    """
+    if not probe.width or not probe.height:
+        return None
+
+    canvas_side = min(max(probe.width, probe.height) * 1.4, MAX_CANVAS_RESOLUTION)
+    canvas_megapixels = (canvas_side * canvas_side) / 1_000_000
+    return canvas_megapixels * get_inference_steps(config)
+
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """Estimar el pico de memoria del job en bytes.
+
+    Sin procesador precargado, el pipeline se carga en cada job (MODEL_MEMORY_MB);
+    encima, las activaciones de la UNet escalan con el área del canvas y la
+    entrada decodificada más el blending en float32 escalan con la imagen original.
+    Con el sidecar de inferencia, pipeline y activaciones viven en otro proceso.
+    """
+    if not probe.width or not probe.height:
+        return None
+
+    image_bytes = probe.width * probe.height * IMAGE_BYTES_PER_PIXEL
+    if get_inference_client() is not None:
+        return int(image_bytes)
+
+    canvas_side = min(max(probe.width, probe.height) * 1.4, MAX_CANVAS_RESOLUTION)
+    activation_mb = UNET_ACTIVATION_MB_512 * (canvas_side * canvas_side) / (512 * 512)
+    model_mb = 0 if _shared_processor is not None else MODEL_MEMORY_MB
+    return int((model_mb + activation_mb) * 1024 * 1024 + image_bytes)
+
+
+def preload_models():
+    """Cargar el pipeline una sola vez antes de que el supervisor haga fork de los workers."""
+    global _shared_processor
+    if _shared_processor is not None or get_inference_client() is not None:
+        return
+    processor = MVPGenerativeFillProcessor()
+    if not processor.model_loaded:
+        logger.warning("Pipeline preload failed, workers will load it per job")
+        return
+    _shared_processor = processor
+
+
+def inference_handlers() -> Dict[str, ModelHandler]:
+    """Modelos que sirve el sidecar de inferencia (python -m app.inference)."""
+    processor = MVPGenerativeFillProcessor()
+    if not processor.model_loaded:
+        raise ImageProcessingError("Failed to load the inpainting model")
+    return {INPAINT: timed_handler(INPAINT)}
+
+
 # Función principal mejorada
 async def perform_image_enlargement(
     job_id: str,
     image_url: str,
-    config: Dict[str, Any]
+    config: Dict[str, Any],
+    preview: Optional[JobPreview] = None
 ) -> Tuple[str, Dict[str, Any]]:
     """Función principal del MVP con mejoras de expansión horizontal y vertical"""
 
@@ -597,16 +721,16 @@ async def perform_image_enlargement(
         # Crear directorio de modelos
         os.makedirs(MODELS_DIR, exist_ok=True)
 
+        cancellation_registry.check(job_id, "download")
+
         # Descargar imagen
         logger.info(f"Downloading image for job {job_id}")
         image_bytes = CloudinaryService.download_image_from_url(image_url)
 
         # Decodificar imagen
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        input_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        input_image = decode_bgr(image_bytes)
 
-        if input_image is None:
-            raise ValueError("Failed to decode image")
+        cancellation_registry.check(job_id, "model loading")
 
         # Configuración
         aspect_ratio = config.get('aspectRatio', 'square')
@@ -617,53 +741,36 @@ async def perform_image_enlargement(
         # NUEVAS OPCIONES DE CONFIGURACIÓN
         preserve_original = config.get('preserveOriginal', True)  # Por defecto True
         blend_margin = config.get('blendMargin', 8)  # Margen de blending por defecto
+        num_inference_steps = get_inference_steps(config)
 
-        # Crear procesador mejorado
-        logger.info("Initializing enhanced MVP Generative Fill processor")
-        processor = MVPGenerativeFillProcessor()
+        # Crear procesador mejorado (o reutilizar el precargado por el supervisor)
+        if _shared_processor is not None:
+            processor = _shared_processor
+        else:
+            logger.info("Initializing enhanced MVP Generative Fill processor")
+            processor = MVPGenerativeFillProcessor()
 
-        # Procesar imagen con nuevas opciones
+        # Procesar imagen con nuevas opciones (las llamadas al pipeline compartido se serializan en DiffusionRuntime.timed)
         output_image = processor.process(
             input_image, 
             aspect_ratio, 
             preserve_original=preserve_original,
-            blend_margin=blend_margin
+            blend_margin=blend_margin,
+            job_id=job_id,
+            num_inference_steps=num_inference_steps,
+            preview=preview
         )
 
-        # Codificar resultado
-        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
-        is_success, buffer = cv2.imencode('.png', output_image, encode_params)
-
-        if not is_success:
-            raise RuntimeError("Failed to encode output image")
+        # Codificar resultado con el preset del tier
+        encoded = encode_bgr(output_image, "PNG", select_preset(config))
+        output_bytes = encoded.data
 
-        output_bytes = buffer.tobytes()
+        cancellation_registry.check(job_id, "upload")
 
-        # Crear thumbnail
-        h, w = output_image.shape[:2]
-        thumb_scale = min(300 / w, 300 / h, 1.0)
-
-        if thumb_scale < 1.0:
-            new_w = int(w * thumb_scale)
-            new_h = int(h * thumb_scale)
-            thumbnail = cv2.resize(output_image, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        else:
-            thumbnail = output_image.copy()
-
-        is_success, thumb_buffer = cv2.imencode('.png', thumbnail)
-        if not is_success:
-            raise RuntimeError("Failed to encode thumbnail")
-
-        thumbnail_bytes = thumb_buffer.tobytes()
-
-        # Subir a Cloudinary
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            output_bytes, job_id, "generative_fill"
-        )
-
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
-        )
+        # Subir a Cloudinary junto con el thumbnail, reducido desde el array en memoria (o derivado por Cloudinary)
+        published = publish_result(job_id, output_bytes, "generative_fill", output_image)
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
 
         # Información del procesamiento
         original_h, original_w = input_image.shape[:2]
@@ -679,16 +786,23 @@ async def perform_image_enlargement(
             "expansion_factor": f"{output_w/original_w:.1f}x{output_h/original_h:.1f}",
             "preserve_original": preserve_original,
             "blend_margin": blend_margin if preserve_original else None,
+            "inference_steps": num_inference_steps,
             "full_quality_public_id": processed_public_id,
             "thumbnail_public_id": thumbnail_public_id,
             "thumbnail_url": thumbnail_url,
             "device_used": processor.device,
-            "improvements": "intelligent_content_analysis_enhanced_masking_and_original_overlay"
+            "improvements": "intelligent_content_analysis_enhanced_masking_and_original_overlay",
+            **encoded.to_params(),
+            **published.to_params()
         }
 
         logger.info(f"Job {job_id} completed successfully with enhanced generative fill and original overlay")
         return processed_url, processing_info
 
+    except JobCancelledError:
+        # La cancelación no es un fallo: se propaga sin envolver para no reintentar
+        raise
+
     except Exception as e:
         logger.error(f"Job {job_id} failed: {e}")
         raise ImageProcessingError(f"Enhanced generative fill processing failed: {e}")
@@ -0,0 +1,217 @@
+"""
+Thumbnail module.
+Publishes a job's result together with its thumbnail, in one of two modes
+(THUMBNAIL_MODE):
+- "eager": the result is uploaded once and Cloudinary derives the thumbnail
+  as an eager transformation of it during that upload, so no second upload;
+- "local": the thumbnail is downscaled from the result already in memory
+  (an integer box reduce, then one small resample) and encoded as compact
+  WebP/JPEG, and its upload runs alongside the result's.
+Both fit the thumbnail within THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT, never
+enlarging it. `python -m app.thumbnails` compares the modes.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.cloudinary_service import CloudinaryService
+from app.config import THUMBNAIL_MODE, THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT, THUMBNAIL_FORMAT, THUMBNAIL_QUALITY
+from app.encoding import encode_bgr, encode_image
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_MODES = ("eager", "local")
+
+# Encoder and Cloudinary names of the thumbnail formats
+THUMBNAIL_FORMATS = {"webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg"), "jpg": ("JPEG", "jpg")}
+
+# Threads uploading local thumbnails while the job thread uploads the result
+THUMBNAIL_UPLOAD_WORKERS = 2
+
+ImageLike = Union[np.ndarray, Image.Image]
+
+_upload_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_UPLOAD_WORKERS, thread_name_prefix="thumbnail-upload")
+
+
+@dataclass
+class PublishedResult:
+    url: str
+    public_id: str
+    thumbnail_url: str
+    thumbnail_public_id: str
+    mode: str
+    thumbnail_seconds: float
+    upload_seconds: float
+
+    def to_params(self) -> Dict[str, Any]:
+        """Timing of the publish step for processingParams."""
+        return {
+            "thumbnail_mode": self.mode,
+            "thumbnail_seconds": round(self.thumbnail_seconds, 3),
+            "upload_seconds": round(self.upload_seconds, 3),
+        }
+
+
+def fit_size(width: int, height: int, size: Tuple[int, int]) -> Tuple[int, int]:
+    """Size of a `width`x`height` image fitted within `size`, never enlarged."""
+    scale = min(size[0] / width, size[1] / height, 1.0)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def downscale(image: ImageLike, size: Tuple[int, int]) -> ImageLike:
+    """
+    Fit an image (BGR(A) array or PIL image) within `size`: a box reduce by
+    the largest integer factor that leaves at least 2x to go, then one
+    INTER_AREA/LANCZOS resample of the already small image.
+    """
+    if isinstance(image, Image.Image):
+        if image.mode not in ("L", "LA", "RGB", "RGBA"):
+            # Palette, CMYK or 16-bit results (conversion jobs) resample poorly or not at all
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.getbands() else "RGB")
+        target = fit_size(image.width, image.height, size)
+        if target == image.size:
+            return image
+        # reducing_gap makes PIL run Image.reduce first, the same split as below
+        return image.resize(target, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    height, width = image.shape[:2]
+    target = fit_size(width, height, size)
+    if target == (width, height):
+        return image
+    factor = int(min(width / target[0], height / target[1]) // 2)
+    if factor >= 2:
+        # An exact integer ratio takes OpenCV's fast box-averaging path
+        cropped = image[:height - height % factor, :width - width % factor]
+        image = cv2.resize(cropped, (width // factor, height // factor), interpolation=cv2.INTER_AREA)
+    return cv2.resize(image, target, interpolation=cv2.INTER_AREA)
+
+
+def thumbnail_bytes(image: ImageLike, size: Optional[Tuple[int, int]] = None) -> bytes:
+    """The thumbnail of a result in memory, encoded as THUMBNAIL_FORMAT (WebP keeps alpha)."""
+    size = size or (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+    image_format = THUMBNAIL_FORMATS.get(THUMBNAIL_FORMAT, THUMBNAIL_FORMATS["webp"])[0]
+    thumbnail = downscale(image, size)
+    if isinstance(thumbnail, Image.Image):
+        return encode_image(thumbnail, image_format, "balanced", THUMBNAIL_QUALITY).data
+    return encode_bgr(thumbnail, image_format, "balanced", THUMBNAIL_QUALITY).data
+
+
+def eager_transformation(size: Optional[Tuple[int, int]] = None) -> Dict[str, Any]:
+    """Cloudinary transformation deriving the thumbnail from the uploaded result."""
+    width, height = size or (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+    cloudinary_format = THUMBNAIL_FORMATS.get(THUMBNAIL_FORMAT, THUMBNAIL_FORMATS["webp"])[1]
+    return {"width": width, "height": height, "crop": "limit", "quality": THUMBNAIL_QUALITY, "format": cloudinary_format}
+
+
+def publish_result(
+    job_id: str,
+    output_bytes: bytes,
+    suffix: str,
+    image: ImageLike,
+    size: Optional[Tuple[int, int]] = None,
+    mode: Optional[str] = None
+) -> PublishedResult:
+    """
+    Upload a job's encoded result and its thumbnail.
+
+    Args:
+        job_id: Unique job identifier
+        output_bytes: The encoded result
+        suffix: Suffix of the result's public id
+        image: The result in memory (BGR(A) array or PIL image), for a local thumbnail
+        size: Thumbnail bounding box, THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT by default
+        mode: "eager" or "local", THUMBNAIL_MODE by default
+
+    Returns:
+        URLs and public ids of the result and its thumbnail, with timings
+    """
+    mode = mode if mode in THUMBNAIL_MODES else THUMBNAIL_MODE
+    started = time.perf_counter()
+    if mode == "eager":
+        url, public_id, thumbnail_url = CloudinaryService.upload_with_thumbnail(
+            output_bytes, job_id, suffix, eager_transformation(size)
+        )
+        # The thumbnail is a derived asset of the result, under the result's public id
+        thumbnail_public_id, thumbnail_seconds = public_id, 0.0
+    else:
+        data = thumbnail_bytes(image, size)
+        thumbnail_seconds = time.perf_counter() - started
+        thumbnail_upload = _upload_executor.submit(CloudinaryService.upload_thumbnail, data, job_id, False)
+        url, public_id = CloudinaryService.upload_processed_image(output_bytes, job_id, suffix)
+        thumbnail_url, thumbnail_public_id = thumbnail_upload.result()
+    published = PublishedResult(
+        url, public_id, thumbnail_url, thumbnail_public_id, mode, thumbnail_seconds, time.perf_counter() - started
+    )
+    logger.info(f"☁️ Published result of job {job_id} with {mode} thumbnail in {published.upload_seconds:.2f}s")
+    return published
+
+
+def benchmark(image: ImageLike, output_bytes: bytes, upload: bool = False, runs: int = 5) -> Dict[str, Any]:
+    """
+    Time the thumbnail step of a job: the legacy path (full-size copy,
+    LANCZOS resize, PNG), the local thumbnail and, with `upload`, the whole
+    publish step in each mode (needs Cloudinary credentials).
+    """
+    def timed(fn) -> float:
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - started)
+        return round(sorted(samples)[len(samples) // 2], 4)
+
+    size = (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT)
+    pil_image = image if isinstance(image, Image.Image) else Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+
+    def legacy() -> None:
+        thumbnail = pil_image.copy()
+        thumbnail.thumbnail(size, Image.Resampling.LANCZOS, reducing_gap=None)
+        encode_image(thumbnail, "PNG", "compact")
+
+    results: Dict[str, Any] = {
+        "image": f"{pil_image.width}x{pil_image.height}",
+        "legacy_thumbnail_seconds": timed(legacy),
+        "local_thumbnail_seconds": timed(lambda: thumbnail_bytes(image)),
+        "local_thumbnail_bytes": len(thumbnail_bytes(image)),
+    }
+    if upload:
+        def separate() -> None:
+            CloudinaryService.upload_processed_image(output_bytes, "thumbnail_benchmark", "benchmark")
+            CloudinaryService.upload_thumbnail(thumbnail_bytes(image), "thumbnail_benchmark")
+
+        results["separate_publish_seconds"] = timed(separate)
+        for mode in THUMBNAIL_MODES:
+            results[f"{mode}_publish_seconds"] = timed(
+                lambda: publish_result("thumbnail_benchmark", output_bytes, "benchmark", image, mode=mode)
+            )
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Benchmark the thumbnail modes")
+    parser.add_argument("--image", help="Result image to publish (default: a synthetic 4096x4096 one)")
+    parser.add_argument("--upload", action="store_true", help="Also time the uploads (needs Cloudinary credentials)")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            output_bytes = f.read()
+        from app.decoding import decode_bgr
+        image = decode_bgr(output_bytes)
+    else:
+        image = cv2.GaussianBlur(np.random.default_rng(0).integers(0, 255, (4096, 4096, 3), dtype=np.uint8), (0, 0), 4)
+        output_bytes = encode_bgr(image, "PNG", "fast").data
+    if args.upload:
+        import app.cloudinary_config  # noqa: F401  (configures the Cloudinary client)
+    print(json.dumps(benchmark(image, output_bytes, args.upload, args.runs), indent=2))
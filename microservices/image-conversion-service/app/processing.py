@@ -21,6 +21,11 @@ except ImportError:
     HEIF_SUPPORTED = False
 
 from app.cloudinary_service import CloudinaryService
+from app.scheduling import ImageProbe
+from app.cancellation import cancellation_registry, JobCancelledError
+from app.decoding import ImageHeader, read_header, decode_image
+from app.encoding import encode_image, select_preset
+from app.thumbnails import publish_result
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +49,23 @@ SUPPORTED_FORMATS = {
 if HEIF_SUPPORTED:
     SUPPORTED_FORMATS['HEIC'] = {'extensions': ['.heic', '.heif'], 'mime': 'image/heif', 'pil_format': 'HEIF'}
 
+# Relative encode cost per megapixel for each target format (JPEG = 1.0)
+ENCODE_COST_FACTORS = {
+    'JPEG': 1.0,
+    'PNG': 2.0,
+    'WEBP': 3.0,
+    'TIFF': 1.0,
+    'BMP': 0.5,
+    'GIF': 2.0,
+    'HEIC': 3.0,
+}
+
+# Degraded mode under load: fast encoder settings instead of maximum compression
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"fast_encode": True}
+
+# Decoded, converted, resized and encoded copies alive at once, per input pixel
+IMAGE_BYTES_PER_PIXEL = 20
+
 def get_active_jobs_count() -> int:
     """Returns the number of jobs currently being processed."""
     with _jobs_lock:
@@ -56,19 +78,22 @@ def clear_active_jobs():
         logger.info("🧹 Clearing active jobs list")
         _active_jobs.clear()
 
-def detect_image_format(image_bytes: bytes) -> Optional[str]:
+def preload_models():
+    """Nothing to preload: conversion uses Pillow only. Kept for the supervisor."""
+    Image.init()  # Register every format plugin once so forked workers inherit them
+
+def detect_image_format(header: ImageHeader) -> Optional[str]:
     """
-    Detect the format of an image from its bytes.
+    Detect the format of an image from its header.
     
     Args:
-        image_bytes: Raw image data
+        header: Header read by app.decoding.read_header
         
     Returns:
         Format name (JPEG, PNG, etc.) or None if unrecognized
     """
     try:
-        image = Image.open(io.BytesIO(image_bytes))
-        format_name = image.format
+        format_name = header.format
         
         # Map PIL format names to our standard format names
         format_mapping = {
@@ -120,7 +145,7 @@ def preserve_exif_data(original_image: Image.Image, converted_image: Image.Image
         logger.warning(f"Could not preserve EXIF data: {e}")
         return converted_image
 
-def apply_compression(image: Image.Image, target_format: str, quality: int = 85, optimize: bool = True) -> bytes:
+def apply_compression(image: Image.Image, target_format: str, quality: int = 85, preset: str = "balanced") -> bytes:
     """
     Apply compression to image based on target format and quality settings.
     
@@ -128,51 +153,19 @@ def apply_compression(image: Image.Image, target_format: str, quality: int = 85,
         image: PIL Image object
         target_format: Target format (JPEG, PNG, WebP, etc.)
         quality: Quality level (1-100, only for lossy formats)
-        optimize: Whether to optimize the image
+        preset: Encoder preset for PNG, JPEG and WebP ("fast", "balanced" or "compact")
         
     Returns:
         Compressed image as bytes
     """
-    output_buffer = io.BytesIO()
+    if target_format in ('JPEG', 'PNG', 'WebP'):
+        # Web formats go through the shared encoder, which also flattens alpha for JPEG
+        return encode_image(image, target_format, preset, quality).data
     
-    # Format-specific compression settings
-    save_kwargs = {'format': target_format, 'optimize': optimize}
-    
-    if target_format == 'JPEG':
-        # JPEG compression
-        save_kwargs.update({
-            'quality': quality,
-            'progressive': True,
-            'subsampling': 0 if quality > 85 else 2
-        })
-        
-        # Convert to RGB if necessary (JPEG doesn't support transparency)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            if image.mode in ('RGBA', 'LA'):
-                background.paste(image, mask=image.split()[-1])
-            image = background
-            
-    elif target_format == 'PNG':
-        # PNG compression (lossless but can optimize)
-        save_kwargs.update({
-            'compress_level': 6 if optimize else 1,
-            'pnginfo': None  # Remove metadata to reduce size
-        })
-        
-    elif target_format == 'WebP':
-        # WebP compression (supports both lossy and lossless)
-        if quality >= 100:
-            save_kwargs.update({'lossless': True})
-        else:
-            save_kwargs.update({
-                'quality': quality,
-                'method': 6  # Better compression
-            })
+    output_buffer = io.BytesIO()
+    save_kwargs = {'format': target_format}
             
-    elif target_format == 'TIFF':
+    if target_format == 'TIFF':
         # TIFF compression
         save_kwargs.update({
             'compression': 'tiff_lzw',  # Lossless compression
@@ -187,7 +180,7 @@ def apply_compression(image: Image.Image, target_format: str, quality: int = 85,
         # GIF specific handling
         if image.mode != 'P':
             image = image.convert('P', palette=Image.ADAPTIVE, colors=256)
-        save_kwargs.update({'save_all': True})
+        save_kwargs.update({'save_all': True, 'optimize': preset != 'fast'})
     
     try:
         image.save(output_buffer, **save_kwargs)
@@ -206,8 +199,10 @@ def convert_image_format(
     quality: int = 85,
     preserve_exif: bool = True,
     resize_dimensions: Optional[Tuple[int, int]] = None,
-    maintain_aspect_ratio: bool = True
-) -> Tuple[bytes, Dict[str, Any]]:
+    maintain_aspect_ratio: bool = True,
+    preset: str = "balanced",
+    header: Optional[ImageHeader] = None
+) -> Tuple[bytes, Dict[str, Any], Image.Image]:
     """
     Convert image to target format with optional compression and resizing.
     
@@ -218,31 +213,36 @@ def convert_image_format(
         preserve_exif: Whether to preserve EXIF data
         resize_dimensions: Optional (width, height) for resizing
         maintain_aspect_ratio: Whether to maintain aspect ratio when resizing
+        preset: Encoder preset ("fast", "balanced" or "compact")
+        header: Header already read by app.decoding.read_header, if any
         
     Returns:
-        Tuple of (converted_image_bytes, processing_info)
+        Tuple of (converted_image_bytes, processing_info, converted_image)
     """
     start_time = time.perf_counter()
     
     try:
-        # Load and analyze original image
-        original_image = Image.open(io.BytesIO(image_bytes))
+        # Decode once, upright; a resize lets a JPEG decode at a reduced draft scale
+        header = header or read_header(image_bytes)
+        original_image = decode_image(
+            image_bytes, max_side=max(resize_dimensions) if resize_dimensions else None, header=header
+        )
         original_format = original_image.format
         original_mode = original_image.mode
-        original_size = original_image.size
+        original_size = (header.width, header.height)
         
         logger.info(f"Converting {original_format} ({original_mode}) {original_size} to {target_format}")
         
-        # Work with a copy
-        converted_image = original_image.copy()
+        # The decoded image is only used here, so no defensive copy
+        converted_image = original_image
         
         # Handle resizing if requested
         if resize_dimensions:
             new_width, new_height = resize_dimensions
             
             if maintain_aspect_ratio:
-                # Calculate dimensions maintaining aspect ratio
-                aspect_ratio = original_size[0] / original_size[1]
+                # Calculate dimensions maintaining aspect ratio (of the upright image)
+                aspect_ratio = converted_image.size[0] / converted_image.size[1]
                 
                 if new_width / new_height > aspect_ratio:
                     # Height is the limiting factor
@@ -263,7 +263,7 @@ def convert_image_format(
             converted_image = preserve_exif_data(original_image, converted_image)
         
         # Apply format-specific compression
-        compressed_bytes = apply_compression(converted_image, target_format, quality, optimize=True)
+        compressed_bytes = apply_compression(converted_image, target_format, quality, preset=preset)
         
         processing_time = time.perf_counter() - start_time
         
@@ -285,22 +285,64 @@ def convert_image_format(
             'quality_setting': quality,
             'processing_time_seconds': round(processing_time, 3),
             'exif_preserved': preserve_exif and target_format in ['JPEG', 'TIFF'],
-            'resized': resize_dimensions is not None
+            'resized': resize_dimensions is not None,
+            'encode_preset': preset
         }
         
         logger.info(f"Conversion completed: {compression_ratio:.1f}% size reduction")
         
-        return compressed_bytes, processing_info
+        return compressed_bytes, processing_info, converted_image
         
     except Exception as e:
         logger.error(f"Image conversion failed: {e}")
         logger.error(traceback.format_exc())
         raise ImageProcessingError(f"Failed to convert image: {e}")
 
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """
+    Estimate the cost of a conversion job from the probed input size.
+    
+    Args:
+        probe: Header probe of the input image
+        config: Conversion configuration
+        
+    Returns:
+        Cost in JPEG-equivalent megapixels (decode + encode), or None if unknown
+    """
+    input_megapixels = probe.megapixels
+    if input_megapixels is None:
+        return None
+    
+    output_megapixels = input_megapixels
+    resize_width = config.get('resize_width')
+    resize_height = config.get('resize_height')
+    if resize_width and resize_height:
+        output_megapixels = min(input_megapixels, (resize_width * resize_height) / 1_000_000)
+    
+    target_format = str(config.get('target_format', 'JPEG')).upper()
+    encode_factor = ENCODE_COST_FACTORS.get(target_format, 1.0)
+    
+    return input_megapixels + output_megapixels * encode_factor
+
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """
+    Estimate the peak memory of a conversion job in bytes.
+    
+    The decoded image, the mode-converted copy, an optional resize and the
+    encoder's buffers each hold roughly 4 bytes per pixel; no model is loaded.
+    """
+    input_megapixels = probe.megapixels
+    if input_megapixels is None:
+        return None
+    return int(input_megapixels * 1_000_000 * IMAGE_BYTES_PER_PIXEL)
+
+
 async def perform_image_conversion(
     job_id: str,
     image_url: str,
-    config: Dict[str, Any]
+    config: Dict[str, Any],
+    tier: Optional[str] = None
 ) -> Tuple[str, Dict[str, Any]]:
     """
     Main function to perform image conversion with Cloudinary integration.
@@ -309,6 +351,7 @@ async def perform_image_conversion(
         job_id: Unique job identifier
         image_url: Source image URL from Cloudinary
         config: Conversion configuration
+        tier: Job tier, which picks the encoder preset (config's quality is the lossy quality here)
         
     Returns:
         Tuple of (processed_image_url, processing_params)
@@ -354,44 +397,38 @@ async def perform_image_conversion(
                 resize_height or 0  # Will be calculated if 0
             )
         
+        cancellation_registry.check(job_id, "download")
+
         logger.info(f"⬇️ Downloading image from: {image_url}")
         input_image_bytes = CloudinaryService.download_image_from_url(image_url)
+        cancellation_registry.check(job_id, "conversion")
         
-        # Detect original format
-        original_format = detect_image_format(input_image_bytes)
+        # Detect original format from the header, which also enforces the pixel budget
+        header = read_header(input_image_bytes)
+        original_format = detect_image_format(header)
         logger.info(f"📋 Detected original format: {original_format}")
         
         # Perform conversion
         logger.info(f"🔄 Converting to {target_format} with quality {quality}")
-        converted_bytes, processing_info = convert_image_format(
+        converted_bytes, processing_info, converted_image = convert_image_format(
             input_image_bytes,
             target_format,
             quality=quality,
             preserve_exif=preserve_exif,
             resize_dimensions=resize_dimensions,
-            maintain_aspect_ratio=maintain_aspect_ratio
+            maintain_aspect_ratio=maintain_aspect_ratio,
+            preset=select_preset(config, tier),
+            header=header
         )
         
-        # Generate thumbnail for preview
-        logger.info(f"🖼️ Generating thumbnail for {job_id}")
-        thumbnail_image = Image.open(io.BytesIO(converted_bytes)).convert("RGB")
-        thumbnail_image.thumbnail((400, 300), Image.Resampling.LANCZOS)
+        cancellation_registry.check(job_id, "upload")
         
-        thumbnail_buffer = io.BytesIO()
-        thumbnail_image.save(thumbnail_buffer, format="JPEG", optimize=True, quality=70)
-        thumbnail_bytes = thumbnail_buffer.getvalue()
-        
-        # Upload converted image to Cloudinary
-        logger.info(f"☁️ Uploading converted image to Cloudinary for {job_id}")
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            converted_bytes, job_id, f"converted_{target_format.lower()}"
-        )
-        
-        # Upload thumbnail
-        logger.info(f"☁️ Uploading thumbnail to Cloudinary for {job_id}")
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
-        )
+        # Upload converted image with its thumbnail, downscaled from the pixels already in memory
+        # (or derived by Cloudinary)
+        logger.info(f"☁️ Uploading converted image and thumbnail to Cloudinary for {job_id}")
+        published = publish_result(job_id, converted_bytes, f"converted_{target_format.lower()}", converted_image)
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
         
         # Prepare final processing information
         final_processing_info = {
@@ -402,7 +439,8 @@ async def perform_image_conversion(
             'thumbnail_url': thumbnail_url,
             'job_id': job_id,
             'timestamp': time.time(),
-            'conversion_successful': True
+            'conversion_successful': True,
+            **published.to_params()
         }
         
         logger.info(f"✅ Image conversion job {job_id} completed successfully")
@@ -412,6 +450,10 @@ async def perform_image_conversion(
         
         return processed_url, final_processing_info
         
+    except JobCancelledError:
+        # Cancellation is not a failure; propagate it unwrapped so it isn't retried
+        raise
+        
     except Exception as e:
         logger.error(f"❌ Error in image conversion job {job_id}: {e}")
         logger.error(f"📋 Full traceback: {traceback.format_exc()}")
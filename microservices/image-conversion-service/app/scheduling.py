@@ -0,0 +1,282 @@
+"""
+Job scheduling module: cost estimation and size-aware worker lanes.
+Probes the image header before any heavy work so small jobs can run in a
+short lane instead of waiting behind large ones.
+"""
+
+import asyncio
+import io
+import logging
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Optional
+
+import requests
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+SHORT_LANE = "short"
+LONG_LANE = "long"
+
+# Bytes requested from storage to read the image header (dimensions)
+PROBE_RANGE_BYTES = 64 * 1024
+
+# Rough compressed bytes per pixel used when the header can't be parsed
+FALLBACK_BYTES_PER_PIXEL = 0.5
+
+# Number of recent latencies kept per lane for percentiles
+LATENCY_WINDOW = 200
+
+
+@dataclass
+class ImageProbe:
+    """Cheap facts about a job's input image, gathered without downloading it."""
+    content_length: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    format: Optional[str] = None
+    probe_time_seconds: float = 0.0
+
+    @property
+    def megapixels(self) -> Optional[float]:
+        """Input size in megapixels, estimated from bytes when dimensions are unknown."""
+        if self.width and self.height:
+            return (self.width * self.height) / 1_000_000
+        if self.content_length:
+            return self.content_length / FALLBACK_BYTES_PER_PIXEL / 1_000_000
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "content_length": self.content_length,
+            "width": self.width,
+            "height": self.height,
+            "format": self.format,
+            "megapixels": round(self.megapixels, 3) if self.megapixels is not None else None,
+            "probe_time_seconds": round(self.probe_time_seconds, 4),
+        }
+
+
+def _parse_total_length(response: requests.Response) -> Optional[int]:
+    """Extract the full object size from Content-Range, falling back to Content-Length."""
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and response.status_code == 200:
+        return int(content_length)
+    return None
+
+
+def probe_image(image_url: str, timeout: float = 3.0) -> ImageProbe:
+    """
+    Read the image size and dimensions using a ranged GET of the first bytes.
+
+    Only the header is parsed (PIL opens images lazily), so the cost is one
+    small request regardless of how large the image is. Never raises: a
+    failed probe returns an empty ImageProbe.
+
+    Args:
+        image_url: Storage URL of the input image
+        timeout: Request timeout in seconds
+
+    Returns:
+        ImageProbe with whatever could be determined
+    """
+    probe = ImageProbe()
+    start_time = time.perf_counter()
+
+    try:
+        with requests.get(
+            image_url,
+            headers={"Range": f"bytes=0-{PROBE_RANGE_BYTES - 1}"},
+            timeout=timeout,
+            stream=True,
+        ) as response:
+            response.raise_for_status()
+            probe.content_length = _parse_total_length(response)
+
+            # Servers that ignore Range send the whole body; stop reading early
+            head = bytearray()
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                head.extend(chunk)
+                if len(head) >= PROBE_RANGE_BYTES:
+                    break
+
+        try:
+            with Image.open(io.BytesIO(bytes(head))) as header_image:
+                probe.width, probe.height = header_image.size
+                probe.format = header_image.format
+        except Exception as e:
+            logger.debug(f"Could not parse image header from first {len(head)} bytes: {e}")
+
+    except Exception as e:
+        logger.warning(f"Image probe failed for {image_url}: {e}")
+
+    probe.probe_time_seconds = time.perf_counter() - start_time
+    return probe
+
+
+class LaneStats:
+    """Latency counters for a single lane."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._wait_times: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._service_times: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def record(self, wait_seconds: float, service_seconds: float, success: bool) -> None:
+        self._wait_times.append(wait_seconds)
+        self._service_times.append(service_seconds)
+        self._latencies.append(wait_seconds + service_seconds)
+        if success:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    @staticmethod
+    def _percentile(values: Deque[float], percentile: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(percentile * (len(ordered) - 1))))
+        return round(ordered[index], 3)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "wait_seconds_p50": self._percentile(self._wait_times, 0.5),
+            "wait_seconds_p95": self._percentile(self._wait_times, 0.95),
+            "service_seconds_mean": round(statistics.fmean(self._service_times), 3) if self._service_times else None,
+            "latency_seconds_p50": self._percentile(self._latencies, 0.5),
+            "latency_seconds_p95": self._percentile(self._latencies, 0.95),
+        }
+
+
+def _run_coroutine_function(func: Callable[..., Any], args: tuple, kwargs: dict) -> Any:
+    """Run an async processing function to completion on the calling worker thread."""
+    return asyncio.run(func(*args, **kwargs))
+
+
+class LaneScheduler:
+    """
+    Routes jobs into a short and a long lane, each with its own worker budget.
+
+    Jobs whose estimated cost is at or below `short_lane_max_cost` go to the
+    short lane, so a cheap job never queues behind an expensive one. This
+    approximates shortest-job-first without reordering the broker queue.
+    """
+
+    def __init__(self, short_workers: int, long_workers: int, short_lane_max_cost: float, thread_initializer=None):
+        self.short_lane_max_cost = short_lane_max_cost
+        # `thread_initializer` runs once in every lane thread (e.g. to pin it to a core set)
+        self._executors = {
+            SHORT_LANE: ThreadPoolExecutor(
+                max_workers=max(1, short_workers), thread_name_prefix="lane-short", initializer=thread_initializer
+            ),
+            LONG_LANE: ThreadPoolExecutor(
+                max_workers=max(1, long_workers), thread_name_prefix="lane-long", initializer=thread_initializer
+            ),
+        }
+        self._stats = {
+            SHORT_LANE: LaneStats(max(1, short_workers)),
+            LONG_LANE: LaneStats(max(1, long_workers)),
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def total_workers(self) -> int:
+        return sum(stats.workers for stats in self._stats.values())
+
+    def mean_service_seconds(self) -> Optional[float]:
+        """Mean service time over both lanes' recent jobs, None before any job finished."""
+        with self._lock:
+            samples = [t for stats in self._stats.values() for t in stats._service_times]
+        return statistics.fmean(samples) if samples else None
+
+    def select_lane(self, estimated_cost: Optional[float]) -> str:
+        """Pick a lane for a job; unknown cost is treated as expensive."""
+        if estimated_cost is not None and estimated_cost <= self.short_lane_max_cost:
+            return SHORT_LANE
+        return LONG_LANE
+
+    async def run(self, lane: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Run an async processing function on the lane's worker pool.
+
+        Args:
+            lane: SHORT_LANE or LONG_LANE
+            func: Async function performing the job
+            *args, **kwargs: Arguments for `func`
+
+        Returns:
+            Whatever `func` returns
+        """
+        stats = self._stats[lane]
+        enqueued_at = time.perf_counter()
+        # Guarded by self._lock: whichever side gets there first (the worker starting the job or the caller
+        # being cancelled while it waits) settles the waiting counter, exactly once
+        state = {"started": False, "abandoned": False}
+
+        def _work():
+            with self._lock:
+                if state["abandoned"]:
+                    # The caller was cancelled before this thread started: nobody awaits the result
+                    return None
+                state["started"] = True
+                stats.waiting -= 1
+                stats.running += 1
+            start = time.perf_counter()
+            success = False
+            try:
+                result = _run_coroutine_function(func, args, kwargs)
+                success = True
+                return result
+            finally:
+                # Recorded here, not by the caller, so a job keeps counting as running until it really ends
+                finished_at = time.perf_counter()
+                with self._lock:
+                    stats.running -= 1
+                    stats.record(start - enqueued_at, finished_at - start, success)
+
+        with self._lock:
+            stats.waiting += 1
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executors[lane], _work)
+        finally:
+            with self._lock:
+                if not state["started"] and not state["abandoned"]:
+                    # Cancelled before a worker picked it up
+                    state["abandoned"] = True
+                    stats.waiting -= 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Per-lane counters and latency percentiles for monitoring."""
+        with self._lock:
+            return {
+                "short_lane_max_cost": self.short_lane_max_cost,
+                "lanes": {name: stats.snapshot() for name, stats in self._stats.items()},
+                "timestamp": time.time(),
+            }
+
+    def shutdown(self, wait: bool = False) -> None:
+        for executor in self._executors.values():
+            executor.shutdown(wait=wait)
@@ -0,0 +1,261 @@
+"""
+Job admission module: deadlines, load shedding and quality degradation.
+Rejects stale jobs before any download, switches to cheaper processing
+modes when the backlog grows and sheds lower tiers first when the queue
+stays backed up.
+"""
+
+import logging
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+FREE_TIER = "FREE"
+PREMIUM_TIER = "PREMIUM"
+
+# Reasons reported back in the FAILED status
+EXPIRED_REASON = "EXPIRED"
+SHED_REASON = "SHED"
+
+
+def now_ms() -> int:
+    """Current wall-clock time in epoch milliseconds (same unit as the backend)."""
+    return int(time.time() * 1000)
+
+
+def get_job_tier(job_config: Optional[Dict[str, Any]], fallback: Optional[str] = None) -> str:
+    """Quality tier of a job; jobs without one are treated as FREE."""
+    tier = (job_config or {}).get("quality") or fallback or FREE_TIER
+    return str(tier).upper()
+
+
+def check_deadline(
+    enqueued_at: Optional[int],
+    deadline: Optional[int],
+    max_age_seconds: float = 0.0,
+) -> Optional[str]:
+    """
+    Decide whether a job has expired.
+
+    The explicit deadline from the message wins; otherwise the job expires
+    when it has been queued longer than `max_age_seconds` (0 disables it).
+
+    Args:
+        enqueued_at: Epoch millis when the backend published the job
+        deadline: Epoch millis after which the result is no longer useful
+        max_age_seconds: Local maximum queue age
+
+    Returns:
+        A human readable reason if the job expired, None otherwise
+    """
+    current = now_ms()
+    if deadline is not None and current > deadline:
+        return f"deadline passed {(current - deadline) / 1000:.1f}s ago"
+    if enqueued_at is not None and max_age_seconds > 0:
+        age_seconds = (current - enqueued_at) / 1000
+        if age_seconds > max_age_seconds:
+            return f"queued for {age_seconds:.1f}s (max {max_age_seconds:.0f}s)"
+    return None
+
+
+class LoadShedder:
+    """
+    Tracks queue depth and decides when to shed work.
+
+    The service is overloaded once the queue depth has stayed at or above
+    `overload_depth` for `sustain_seconds`, and recovers only when it drops
+    below `recovery_depth`, so short bursts don't trigger shedding and the
+    state doesn't flap around the threshold. While overloaded, jobs in
+    `shed_tiers` are rejected; other tiers are only subject to deadlines.
+    """
+
+    def __init__(
+        self,
+        overload_depth: int,
+        sustain_seconds: float,
+        recovery_depth: Optional[int] = None,
+        shed_tiers: Sequence[str] = (FREE_TIER,),
+    ):
+        self.overload_depth = overload_depth
+        self.sustain_seconds = sustain_seconds
+        self.recovery_depth = recovery_depth if recovery_depth is not None else overload_depth // 2
+        self.shed_tiers = {tier.upper() for tier in shed_tiers}
+        self.queue_depth: Optional[int] = None
+        self.overloaded = False
+        self._above_since: Optional[float] = None
+        self._expired_count = 0
+        self._shed_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.overload_depth > 0
+
+    def record_queue_depth(self, depth: int) -> None:
+        """Feed a queue depth sample and update the overload state."""
+        current = time.monotonic()
+        with self._lock:
+            self.queue_depth = depth
+            if not self.enabled:
+                return
+
+            if depth >= self.overload_depth:
+                if self._above_since is None:
+                    self._above_since = current
+                if not self.overloaded and current - self._above_since >= self.sustain_seconds:
+                    self.overloaded = True
+                    logger.warning(f"Sustained overload: queue depth {depth} >= {self.overload_depth}, shedding {sorted(self.shed_tiers)}")
+            else:
+                self._above_since = None
+                if self.overloaded and depth < self.recovery_depth:
+                    self.overloaded = False
+                    logger.info(f"Overload cleared: queue depth {depth} < {self.recovery_depth}")
+
+    def should_shed(self, tier: str) -> bool:
+        with self._lock:
+            return self.overloaded and tier.upper() in self.shed_tiers
+
+    def record_expired(self) -> None:
+        with self._lock:
+            self._expired_count += 1
+
+    def record_shed(self, tier: str) -> None:
+        with self._lock:
+            self._shed_counts[tier] = self._shed_counts.get(tier, 0) + 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters and overload state for monitoring."""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "overloaded": self.overloaded,
+                "queue_depth": self.queue_depth,
+                "overload_depth": self.overload_depth,
+                "recovery_depth": self.recovery_depth,
+                "sustain_seconds": self.sustain_seconds,
+                "shed_tiers": sorted(self.shed_tiers),
+                "expired_jobs": self._expired_count,
+                "shed_jobs": dict(self._shed_counts),
+                "shed_jobs_total": sum(self._shed_counts.values()),
+                "timestamp": time.time(),
+            }
+
+
+class DegradationPolicy:
+    """
+    Switches jobs to cheaper processing modes while the backlog is high.
+
+    The backlog is judged by queue depth and by the estimated wait for a
+    newly queued job (depth x mean service time / workers). Degraded mode
+    starts when either reaches its enter threshold and ends only when both
+    are below their exit thresholds, so the mode doesn't flap. While
+    degraded, `overrides` are merged into each job's config; the service's
+    processing code decides what they mean (fewer steps, lighter model...).
+    """
+
+    def __init__(
+        self,
+        enter_depth: int,
+        exit_depth: int,
+        enter_wait_seconds: float,
+        exit_wait_seconds: float,
+        overrides: Mapping[str, Any],
+    ):
+        self.enter_depth = enter_depth
+        self.exit_depth = exit_depth
+        self.enter_wait_seconds = enter_wait_seconds
+        self.exit_wait_seconds = exit_wait_seconds
+        self.overrides = dict(overrides)
+        self.degraded = False
+        self.queue_depth: Optional[int] = None
+        self.estimated_wait_seconds: Optional[float] = None
+        self._degraded_since: Optional[float] = None
+        self._transitions = 0
+        self._degraded_jobs = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.overrides) and (self.enter_depth > 0 or self.enter_wait_seconds > 0)
+
+    def update(self, queue_depth: int, mean_service_seconds: Optional[float], workers: int) -> None:
+        """Feed a queue depth sample plus the current service-time estimate."""
+        estimated_wait = None
+        if mean_service_seconds is not None:
+            estimated_wait = queue_depth * mean_service_seconds / max(1, workers)
+
+        with self._lock:
+            self.queue_depth = queue_depth
+            self.estimated_wait_seconds = estimated_wait
+            if not self.enabled:
+                return
+
+            depth_high = self.enter_depth > 0 and queue_depth >= self.enter_depth
+            wait_high = (
+                self.enter_wait_seconds > 0
+                and estimated_wait is not None
+                and estimated_wait >= self.enter_wait_seconds
+            )
+            depth_low = queue_depth < self.exit_depth
+            wait_low = estimated_wait is None or estimated_wait < self.exit_wait_seconds
+
+            if not self.degraded and (depth_high or wait_high):
+                self.degraded = True
+                self._degraded_since = time.monotonic()
+                self._transitions += 1
+                logger.warning(
+                    f"Entering degraded mode: queue depth {queue_depth}, "
+                    f"estimated wait {estimated_wait if estimated_wait is None else round(estimated_wait, 1)}s, "
+                    f"overrides {self.overrides}"
+                )
+            elif self.degraded and depth_low and wait_low:
+                self.degraded = False
+                self._degraded_since = None
+                self._transitions += 1
+                logger.info(f"Leaving degraded mode: queue depth {queue_depth}")
+
+    def overrides_for_job(self) -> Dict[str, Any]:
+        """Config overrides for a job starting now; empty when not degraded."""
+        with self._lock:
+            if not self.degraded:
+                return {}
+            self._degraded_jobs += 1
+            return dict(self.overrides)
+
+    def describe(self, overrides: Mapping[str, Any]) -> Dict[str, Any]:
+        """processingParams entries recording a downgrade, empty if none was applied."""
+        if not overrides:
+            return {}
+        with self._lock:
+            return {
+                "degradedMode": True,
+                "degradeOverrides": dict(overrides),
+                "degradeQueueDepth": self.queue_depth,
+                "degradeEstimatedWaitSeconds": (
+                    round(self.estimated_wait_seconds, 1) if self.estimated_wait_seconds is not None else None
+                ),
+            }
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "degraded": self.degraded,
+                "degraded_for_seconds": (
+                    round(time.monotonic() - self._degraded_since, 1) if self._degraded_since is not None else None
+                ),
+                "queue_depth": self.queue_depth,
+                "estimated_wait_seconds": (
+                    round(self.estimated_wait_seconds, 1) if self.estimated_wait_seconds is not None else None
+                ),
+                "enter_depth": self.enter_depth,
+                "exit_depth": self.exit_depth,
+                "enter_wait_seconds": self.enter_wait_seconds,
+                "exit_wait_seconds": self.exit_wait_seconds,
+                "overrides": dict(self.overrides),
+                "transitions": self._transitions,
+                "degraded_jobs": self._degraded_jobs,
+                "timestamp": time.time(),
+            }
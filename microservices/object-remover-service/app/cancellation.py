@@ -0,0 +1,154 @@
+"""
+Job cancellation module.
+Keeps the set of cancelled job ids so consumers can skip queued jobs and
+processing code can abort running ones at stage boundaries.
+"""
+
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from app.config import CANCELLED_JOB_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on remembered cancellations, on top of the TTL
+MAX_CANCELLED_JOBS = 10_000
+
+
+class JobCancelledError(Exception):
+    """Raised inside processing code when the current job has been cancelled."""
+
+    def __init__(self, job_id: str, stage: Optional[str] = None):
+        self.job_id = job_id
+        self.stage = stage
+        where = f" at stage '{stage}'" if stage else ""
+        super().__init__(f"Job {job_id} cancelled{where}")
+
+
+class CancellationRegistry:
+    """
+    Thread-safe set of cancelled job ids.
+
+    Entries expire after `ttl_seconds` so a service that never sees the
+    cancelled job doesn't keep its id forever. Processing runs on lane
+    worker threads, so every access goes through a lock.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600.0):
+        self.ttl_seconds = ttl_seconds
+        self._cancelled: "OrderedDict[str, float]" = OrderedDict()
+        self._reasons: Dict[str, Optional[str]] = {}
+        self._skipped_count = 0
+        self._aborted_count = 0
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> None:
+        while self._cancelled:
+            job_id, cancelled_at = next(iter(self._cancelled.items()))
+            if now - cancelled_at <= self.ttl_seconds and len(self._cancelled) <= MAX_CANCELLED_JOBS:
+                break
+            self._cancelled.popitem(last=False)
+            self._reasons.pop(job_id, None)
+
+    def mark_cancelled(self, job_id: str, reason: Optional[str] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._cancelled[job_id] = now
+            self._cancelled.move_to_end(job_id)
+            self._reasons[job_id] = reason
+            self._purge(now)
+        logger.info(f"Job {job_id} marked as cancelled" + (f": {reason}" if reason else ""))
+
+    def is_cancelled(self, job_id: str) -> bool:
+        with self._lock:
+            self._purge(time.monotonic())
+            return job_id in self._cancelled
+
+    def check(self, job_id: str, stage: Optional[str] = None) -> None:
+        """Raise JobCancelledError if the job was cancelled; call between processing stages."""
+        if self.is_cancelled(job_id):
+            logger.info(f"Aborting job {job_id}" + (f" before {stage}" if stage else ""))
+            raise JobCancelledError(job_id, stage)
+
+    def record_skipped(self) -> None:
+        with self._lock:
+            self._skipped_count += 1
+
+    def record_aborted(self) -> None:
+        with self._lock:
+            self._aborted_count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            self._purge(time.monotonic())
+            return {
+                "cancelled_jobs": {job_id: self._reasons.get(job_id) for job_id in self._cancelled},
+                "cancelled_count": len(self._cancelled),
+                "skipped_on_receipt": self._skipped_count,
+                "aborted_while_running": self._aborted_count,
+                "ttl_seconds": self.ttl_seconds,
+                "timestamp": time.time(),
+            }
+
+
+# Shared by the consumer (main.py) and the processing code
+cancellation_registry = CancellationRegistry(CANCELLED_JOB_TTL_SECONDS)
+
+
+def broadcast_cancellation(job_id: str, reason: Optional[str] = None) -> None:
+    """
+    Publish a cancellation on the fanout exchange so every worker of every
+    instance marks the job. Blocking, for the pre-fork supervisor, which has
+    no event loop or AMQP connection of its own.
+    """
+    import asyncio
+    import json
+
+    import aio_pika
+
+    from app.config import RABBITMQ_URL, CANCEL_EXCHANGE_NAME
+
+    async def publish() -> None:
+        connection = await aio_pika.connect(RABBITMQ_URL)
+        async with connection:
+            channel = await connection.channel()
+            exchange = await channel.declare_exchange(CANCEL_EXCHANGE_NAME, aio_pika.ExchangeType.FANOUT, durable=True)
+            body = json.dumps({"jobId": job_id, "reason": reason}).encode("utf-8")
+            await exchange.publish(aio_pika.Message(body=body), routing_key="")
+
+    asyncio.run(publish())
+
+
+def diffusers_cancel_kwargs(pipeline: Any, job_id: str) -> Dict[str, Any]:
+    """
+    Pipeline call kwargs that abort a diffusers run at the next denoising step.
+
+    Uses `callback_on_step_end` when the installed diffusers supports it and
+    falls back to the legacy per-step `callback` otherwise. In both cases the
+    callback raises JobCancelledError, which unwinds the pipeline call and
+    frees the worker right away. A pipeline served by the inference sidecar
+    gets a `cancel_check` instead, polled while the client waits.
+    """
+    if getattr(pipeline, "remote", False):
+        return {"cancel_check": lambda: cancellation_registry.check(job_id, "remote inference")}
+
+    try:
+        parameters = inspect.signature(pipeline.__call__).parameters
+    except (TypeError, ValueError):
+        parameters = {}
+
+    if "callback_on_step_end" in parameters:
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            cancellation_registry.check(job_id, f"denoising step {step}")
+            return callback_kwargs
+
+        return {"callback_on_step_end": on_step_end}
+
+    def on_step(step, timestep, latents):
+        cancellation_registry.check(job_id, f"denoising step {step}")
+
+    return {"callback": on_step, "callback_steps": 1}
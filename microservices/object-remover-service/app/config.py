@@ -38,6 +38,120 @@ SPRING_BOOT_CALLBACK_URL_TEMPLATE = os.getenv(
 SERVICE_PORT = int(os.getenv("PORT", "8004"))
 SERVICE_HOST = os.getenv("HOST", "0.0.0.0")
 
+# Scheduling Configuration
+# Jobs with an estimated cost (input megapixels) up to SHORT_LANE_MAX_COST run in the short lane
+SHORT_LANE_WORKERS = int(os.getenv("SHORT_LANE_WORKERS", "1"))
+LONG_LANE_WORKERS = int(os.getenv("LONG_LANE_WORKERS", "1"))
+SHORT_LANE_MAX_COST = float(os.getenv("SHORT_LANE_MAX_COST", "2.0"))
+COST_PROBE_TIMEOUT = float(os.getenv("COST_PROBE_TIMEOUT", "3.0"))
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", str(SHORT_LANE_WORKERS + LONG_LANE_WORKERS + 2)))
+
+# Admission Configuration
+# Jobs queued longer than JOB_MAX_AGE_SECONDS are failed without processing (0 = only the message deadline applies)
+JOB_MAX_AGE_SECONDS = float(os.getenv("JOB_MAX_AGE_SECONDS", "0"))
+# FREE-tier jobs are shed while the queue stays at SHED_QUEUE_DEPTH or more for SHED_SUSTAIN_SECONDS (0 disables)
+SHED_QUEUE_DEPTH = int(os.getenv("SHED_QUEUE_DEPTH", "50"))
+SHED_RECOVERY_DEPTH = int(os.getenv("SHED_RECOVERY_DEPTH", str(SHED_QUEUE_DEPTH // 2)))
+SHED_SUSTAIN_SECONDS = float(os.getenv("SHED_SUSTAIN_SECONDS", "30"))
+# Cheaper processing modes start when queue depth reaches DEGRADE_ENTER_DEPTH or the estimated wait
+# (depth x mean service time / workers) reaches DEGRADE_ENTER_WAIT_SECONDS; they stop once both are below the exit values
+DEGRADE_ENTER_DEPTH = int(os.getenv("DEGRADE_ENTER_DEPTH", "20"))
+DEGRADE_EXIT_DEPTH = int(os.getenv("DEGRADE_EXIT_DEPTH", str(DEGRADE_ENTER_DEPTH // 4)))
+DEGRADE_ENTER_WAIT_SECONDS = float(os.getenv("DEGRADE_ENTER_WAIT_SECONDS", "60"))
+DEGRADE_EXIT_WAIT_SECONDS = float(os.getenv("DEGRADE_EXIT_WAIT_SECONDS", "15"))
+QUEUE_DEPTH_SAMPLE_INTERVAL = float(os.getenv("QUEUE_DEPTH_SAMPLE_INTERVAL", "5"))
+
+# Cancellation Configuration
+# Cancelled job ids are broadcast on a fanout exchange ({"jobId": ...}) and remembered for CANCELLED_JOB_TTL_SECONDS
+CANCEL_EXCHANGE_NAME = os.getenv("CANCEL_EXCHANGE_NAME", "job_cancellation_exchange")
+CANCELLED_JOB_TTL_SECONDS = float(os.getenv("CANCELLED_JOB_TTL_SECONDS", "3600"))
+
+# Memory Admission Configuration
+# Jobs wait until their estimated peak memory fits in available memory (psutil / cgroup limit) minus the headroom;
+# after MEMORY_ADMISSION_MAX_WAIT_SECONDS they run in degraded mode, or are requeued for another instance
+MEMORY_ADMISSION_ENABLED = os.getenv("MEMORY_ADMISSION_ENABLED", "true").lower() == "true"
+MEMORY_HEADROOM_MB = int(os.getenv("MEMORY_HEADROOM_MB", "512"))
+MEMORY_ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("MEMORY_ADMISSION_MAX_WAIT_SECONDS", "60"))
+MEMORY_POLL_INTERVAL_SECONDS = float(os.getenv("MEMORY_POLL_INTERVAL_SECONDS", "1.0"))
+# Model footprint added to the estimate of a job that has to load a LaMa ONNX session (workers keep them loaded)
+MODEL_MEMORY_MB = int(os.getenv("MODEL_MEMORY_MB", "1200"))
+
+# Drain Configuration
+# On shutdown (SIGTERM) or POST /admin/drain: stop consuming, give in-flight jobs DRAIN_GRACE_SECONDS to finish,
+# then flush status callbacks that couldn't be delivered (those are also retried every CALLBACK_RETRY_INTERVAL_SECONDS)
+DRAIN_GRACE_SECONDS = float(os.getenv("DRAIN_GRACE_SECONDS", "120"))
+CALLBACK_FLUSH_TIMEOUT_SECONDS = float(os.getenv("CALLBACK_FLUSH_TIMEOUT_SECONDS", "15"))
+CALLBACK_RETRY_INTERVAL_SECONDS = float(os.getenv("CALLBACK_RETRY_INTERVAL_SECONDS", "10"))
+CALLBACK_OUTBOX_MAX_SIZE = int(os.getenv("CALLBACK_OUTBOX_MAX_SIZE", "1000"))
+
+# Supervisor Configuration (python -m app.supervisor)
+# Loads models once and forks SUPERVISOR_WORKERS consumers sharing them copy-on-write; a worker is restarted
+# after WORKER_MAX_JOBS jobs (0 = never) or once its private (non-shared) memory exceeds WORKER_MAX_RSS_MB
+SUPERVISOR_WORKERS = int(os.getenv("SUPERVISOR_WORKERS", "2"))
+WORKER_MAX_JOBS = int(os.getenv("WORKER_MAX_JOBS", "200"))
+WORKER_MAX_RSS_MB = int(os.getenv("WORKER_MAX_RSS_MB", "3072"))
+SUPERVISOR_STATS_INTERVAL = float(os.getenv("SUPERVISOR_STATS_INTERVAL", "60"))
+
+# CPU Thread Budget Configuration
+# The usable CPUs (affinity mask capped by the cgroup quota) are split among CPU_JOB_SLOTS concurrent jobs;
+# torch, onnxruntime, OpenCV and the BLAS/OpenMP pools get CPU_THREADS_PER_SLOT threads each (0 = CPUs / slots).
+# CPU_PINNING binds every lane thread (and supervisor worker) to its own core set
+CPU_JOB_SLOTS = int(os.getenv("CPU_JOB_SLOTS", str(SHORT_LANE_WORKERS + LONG_LANE_WORKERS)))
+CPU_THREADS_PER_SLOT = int(os.getenv("CPU_THREADS_PER_SLOT", "0"))
+CPU_PINNING = os.getenv("CPU_PINNING", "false").lower() == "true"
+
+# Image Decode Configuration
+# Images whose header reports more than MAX_IMAGE_PIXELS pixels are rejected before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "64000000"))
+
+# Output Encoding Configuration
+# Results are encoded with their tier's preset (TIER=preset pairs, DEFAULT_ENCODE_PRESET otherwise): "fast" (least
+# CPU, larger files), "balanced" or "compact" (smallest files, most CPU); jobConfig["encode_preset"] overrides it.
+# PNGs of at least PARALLEL_ENCODE_MIN_PIXELS pixels are filtered and deflated in strips across the job slot's threads
+ENCODE_PRESETS = {
+    tier.strip().upper(): preset.strip().lower()
+    for tier, preset in (
+        item.split("=", 1) for item in os.getenv("ENCODE_PRESETS", "FREE=fast,PREMIUM=balanced").split(",") if "=" in item
+    )
+}
+DEFAULT_ENCODE_PRESET = os.getenv("DEFAULT_ENCODE_PRESET", "balanced").lower()
+PARALLEL_ENCODE_MIN_PIXELS = int(os.getenv("PARALLEL_ENCODE_MIN_PIXELS", "4000000"))
+
+# Thumbnail Configuration
+# THUMBNAIL_MODE "local" downscales the thumbnail from the result in memory and uploads it alongside the result;
+# "eager" uploads the result only, with Cloudinary deriving the thumbnail during that upload. Either way it fits
+# within THUMBNAIL_WIDTH x THUMBNAIL_HEIGHT, as THUMBNAIL_FORMAT (webp keeps transparency, or jpeg)
+THUMBNAIL_MODE = os.getenv("THUMBNAIL_MODE", "local").lower()
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "300"))
+THUMBNAIL_HEIGHT = int(os.getenv("THUMBNAIL_HEIGHT", "300"))
+THUMBNAIL_FORMAT = os.getenv("THUMBNAIL_FORMAT", "webp").lower()
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+
+# Preview Delivery Configuration
+# Jobs with an estimated cost of at least PREVIEW_MIN_COST (by default, the ones routed to the long lane) send a
+# cheap preview through an intermediate PROCESSING update before the final result, as a JPEG of at most
+# PREVIEW_MAX_SIDE pixels
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "true").lower() == "true"
+PREVIEW_MIN_COST = float(os.getenv("PREVIEW_MIN_COST", str(SHORT_LANE_MAX_COST)))
+PREVIEW_MAX_SIDE = int(os.getenv("PREVIEW_MAX_SIDE", "768"))
+PREVIEW_JPEG_QUALITY = int(os.getenv("PREVIEW_JPEG_QUALITY", "75"))
+
+# LaMa Session Configuration (python -m app.processing)
+# Workers keep their LaMa sessions loaded across jobs, with the input layout resolved and the 512x512 input and
+# output tensors allocated once; with LAMA_IO_BINDING they are bound to the session (ORT IOBinding) so each run
+# reads and writes them in place. LAMA_DIAGNOSTICS logs tensor shapes and value ranges at DEBUG (costs a pass each)
+LAMA_IO_BINDING = os.getenv("LAMA_IO_BINDING", "true").lower() == "true"
+LAMA_DIAGNOSTICS = os.getenv("LAMA_DIAGNOSTICS", "false").lower() == "true"
+
+# Inference Sidecar Configuration (python -m app.inference)
+# With INFERENCE_SOCKET_PATH set, consumers send model calls to the sidecar holding the models over this Unix socket
+# (tensors go through shared memory) instead of loading them in-process; the sidecar listens on the same path.
+# Requests for a batchable model arriving within INFERENCE_BATCH_WINDOW_MS are run together, up to INFERENCE_MAX_BATCH
+INFERENCE_SOCKET_PATH = os.getenv("INFERENCE_SOCKET_PATH", "")
+INFERENCE_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "120"))
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "4"))
+INFERENCE_BATCH_WINDOW_MS = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "10"))
+
 BASE_DIR = Path(__file__).resolve().parent.parent  # Goes up to enlarge-service/
 
 # Models directory relative to project root
@@ -46,6 +160,12 @@ MODELS_DIR = os.environ.get('MODELS_DIR', str(BASE_DIR / 'models'))
 # Ensure the directory exists
 os.makedirs(MODELS_DIR, exist_ok=True)
 
+# Model Quantization Configuration (python -m app.quantization)
+# INT8 variants and their manifest live in QUANTIZED_MODELS_DIR; jobs of the QUANTIZED_TIERS run a model's
+# enabled variant (one that passed its accuracy gate against FP32), every other job keeps the FP32 model
+QUANTIZED_MODELS_DIR = os.getenv("QUANTIZED_MODELS_DIR", os.path.join(MODELS_DIR, "quantized"))
+QUANTIZED_TIERS = [tier.strip().upper() for tier in os.getenv("QUANTIZED_TIERS", "FREE").split(",") if tier.strip()]
+
 def validate_config() -> bool:
     """
     Validate that all required configuration values are present.
@@ -45,6 +45,8 @@ class JobMessageDTO(BaseModel):
     jobType: Optional[JobType] = None
     jobConfig: Optional[Dict[str, Any]] = Field(default_factory=dict)
     quality: Optional[str] = None
+    enqueuedAt: Optional[int] = None  # Epoch millis when the backend published the job
+    deadline: Optional[int] = None  # Epoch millis after which the result is no longer useful
 
     def __init__(self, **data):
         super().__init__(**data)
@@ -0,0 +1,356 @@
+"""
+Output encoding module.
+Every result is encoded through here with one of three presets instead of
+hard-coded encoder settings:
+- "fast": least CPU per image, larger files (PNG zlib level 1, baseline JPEG);
+- "balanced": the default for most tiers;
+- "compact": smallest files, most CPU (PNG level 9, progressive JPEG, WebP method 6).
+The preset follows the job's tier (ENCODE_PRESETS) unless the job asks for
+one in jobConfig["encode_preset"].
+
+Large lossless PNGs are filtered and deflated in horizontal strips across
+the job slot's threads: each strip is an independent deflate stream ending
+on a byte boundary, so the strips concatenate into a single valid zlib
+stream, the same trick pigz uses. JPEG and WebP have no such split here and
+always run the library encoder.
+"""
+
+import io
+import logging
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.admission import get_job_tier
+from app.config import ENCODE_PRESETS, DEFAULT_ENCODE_PRESET, PARALLEL_ENCODE_MIN_PIXELS
+from app.threads import thread_budget
+
+logger = logging.getLogger(__name__)
+
+PRESETS = ("fast", "balanced", "compact")
+
+# zlib level of PNG output, per preset
+PNG_LEVELS = {"fast": 1, "balanced": 4, "compact": 9}
+
+# (optimize, progressive) of JPEG output, per preset
+JPEG_OPTIONS = {"fast": (False, False), "balanced": (True, False), "compact": (True, True)}
+
+# libwebp effort (0-6), per preset
+WEBP_METHODS = {"fast": 2, "balanced": 4, "compact": 6}
+
+# PNG scanline filter of the strip encoder, per preset: Up is one subtraction, Paeth compresses photos better
+PNG_FILTER_UP = 2
+PNG_FILTER_PAETH = 4
+PNG_STRIP_FILTERS = {"fast": PNG_FILTER_UP, "balanced": PNG_FILTER_PAETH, "compact": PNG_FILTER_PAETH}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG color type by channel count (gray, gray+alpha, RGB, RGBA)
+PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+# Rows filtered at a time inside a strip, which bounds the int16 scratch memory of the Paeth filter
+ROWS_PER_CHUNK = 64
+
+ADLER_BASE = 65521
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    format: str
+    preset: str
+    width: int
+    height: int
+    seconds: float
+    strips: int = 1
+
+    def to_params(self) -> Dict[str, Any]:
+        """Encode report for processingParams."""
+        return {
+            "encode_format": self.format,
+            "encode_preset": self.preset,
+            "encode_seconds": round(self.seconds, 3),
+            "encode_bytes": len(self.data),
+            "encode_strips": self.strips,
+        }
+
+
+def select_preset(job_config: Optional[Dict[str, Any]], tier: Optional[str] = None) -> str:
+    """Preset of a job: its explicit encode_preset, "fast" for fast_encode, else its tier's."""
+    config = job_config or {}
+    requested = str(config.get("encode_preset") or "").lower()
+    if requested in PRESETS:
+        return requested
+    if config.get("fast_encode"):
+        return "fast"
+    preset = ENCODE_PRESETS.get((tier or get_job_tier(config)).upper(), DEFAULT_ENCODE_PRESET)
+    return preset if preset in PRESETS else "balanced"
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Created on first use, after a supervisor worker has narrowed the thread budget
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=thread_budget.cpus, thread_name_prefix="encode")
+        return _executor
+
+
+def _adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """Adler-32 of two concatenated buffers from theirs (zlib's adler32_combine)."""
+    remainder = length2 % ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = (remainder * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xFFFF) + ((adler2 >> 16) & 0xFFFF) + ADLER_BASE - remainder
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+
+def _zlib_header(level: int) -> bytes:
+    flevel = 0 if level <= 1 else 1 if level <= 5 else 2 if level == 6 else 3
+    cmf, flg = 0x78, flevel << 6
+    flg |= (31 - ((cmf << 8) | flg) % 31) % 31
+    return bytes((cmf, flg))
+
+
+def _png_chunk(tag: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(data, zlib.crc32(tag)))
+
+
+def _rows_with_above(pixels: np.ndarray, start: int, stop: int, order: Optional[Sequence[int]]) -> np.ndarray:
+    """Rows [start, stop) preceded by the row above (zeros for the first row), as RGB(A) scanlines."""
+    if start == 0:
+        block = np.concatenate([np.zeros_like(pixels[:1]), pixels[:stop]])
+    else:
+        block = pixels[start - 1:stop]
+    if order is not None:
+        block = block[..., order]
+    block = np.ascontiguousarray(block)
+    return block.reshape(block.shape[0], -1)
+
+
+def _filter_rows(block: np.ndarray, bpp: int, filter_type: int) -> np.ndarray:
+    """PNG-filter the rows of `block` after its first one; each output row starts with its filter byte."""
+    raw, above = block[1:], block[:-1]
+    filtered = np.empty((raw.shape[0], raw.shape[1] + 1), np.uint8)
+    filtered[:, 0] = filter_type
+    if filter_type == PNG_FILTER_UP:
+        np.subtract(raw, above, out=filtered[:, 1:])  # uint8 arithmetic wraps mod 256, as PNG wants
+        return filtered
+    # Paeth predicts from the raw left, above and upper-left bytes, so every row filters independently
+    a = np.zeros(raw.shape, np.int16)
+    a[:, bpp:] = raw[:, :-bpp]
+    b = above.astype(np.int16)
+    c = np.zeros(raw.shape, np.int16)
+    c[:, bpp:] = above[:, :-bpp]
+    pa = np.abs(b - c)
+    pb = np.abs(a - c)
+    pc = np.abs(a + b - 2 * c)
+    predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c)).astype(np.uint8)
+    np.subtract(raw, predictor, out=filtered[:, 1:])
+    return filtered
+
+
+def _deflate_strip(
+    pixels: np.ndarray,
+    start: int,
+    stop: int,
+    order: Optional[Sequence[int]],
+    filter_type: int,
+    level: int,
+    last: bool
+) -> Tuple[bytes, int, int]:
+    """Filter and deflate one strip; returns (raw deflate data, adler32 of the filtered bytes, their length)."""
+    bpp = 1 if pixels.ndim == 2 else pixels.shape[2]
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    parts: List[bytes] = []
+    adler, length = 1, 0
+    for chunk_start in range(start, stop, ROWS_PER_CHUNK):
+        filtered = _filter_rows(
+            _rows_with_above(pixels, chunk_start, min(chunk_start + ROWS_PER_CHUNK, stop), order), bpp, filter_type
+        )
+        adler = zlib.adler32(filtered, adler)
+        length += filtered.size
+        parts.append(compressor.compress(filtered))
+    # A sync flush ends the strip on a byte boundary without closing the stream, so strips concatenate
+    parts.append(compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH))
+    return b"".join(parts), adler, length
+
+
+def encode_png_strips(
+    pixels: np.ndarray,
+    level: int,
+    filter_type: int = PNG_FILTER_PAETH,
+    strips: int = 2,
+    order: Optional[Sequence[int]] = None
+) -> bytes:
+    """
+    Encode an 8-bit image as PNG, filtering and deflating `strips` row bands in parallel.
+
+    Args:
+        pixels: HxW or HxWxC uint8 array with 1 to 4 channels
+        level: zlib level
+        filter_type: PNG_FILTER_UP or PNG_FILTER_PAETH, used on every scanline
+        strips: Row bands encoded concurrently
+        order: Channel order turning `pixels` into gray/RGB(A), e.g. (2, 1, 0) for BGR
+
+    Returns:
+        The PNG file
+    """
+    height, width = pixels.shape[:2]
+    channels = 1 if pixels.ndim == 2 else pixels.shape[2]
+    strips = max(1, min(strips, height))
+    bounds = np.linspace(0, height, strips + 1).astype(int)
+    executor = _get_executor()
+    futures = [
+        executor.submit(_deflate_strip, pixels, bounds[i], bounds[i + 1], order, filter_type, level, i == strips - 1)
+        for i in range(strips)
+    ]
+    results = [future.result() for future in futures]
+
+    adler = results[0][1]
+    for _, strip_adler, strip_length in results[1:]:
+        adler = _adler32_combine(adler, strip_adler, strip_length)
+
+    output = io.BytesIO()
+    output.write(PNG_SIGNATURE)
+    output.write(_png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, PNG_COLOR_TYPES[channels], 0, 0, 0)))
+    # One IDAT per strip; decoders read consecutive IDATs as a single zlib stream
+    output.write(_png_chunk(b"IDAT", _zlib_header(level) + results[0][0]))
+    for data, _, _ in results[1:]:
+        output.write(_png_chunk(b"IDAT", data))
+    output.write(_png_chunk(b"IDAT", struct.pack(">I", adler)))
+    output.write(_png_chunk(b"IEND", b""))
+    return output.getvalue()
+
+
+def _strip_count(pixels: np.ndarray) -> int:
+    """Strips for a PNG of `pixels`: the slot's threads for large 8-bit images, 1 (library encoder) otherwise."""
+    if pixels.dtype != np.uint8 or pixels.shape[0] * pixels.shape[1] < PARALLEL_ENCODE_MIN_PIXELS:
+        return 1
+    return thread_budget.threads_per_slot
+
+
+def _flatten_on_white(image: Image.Image) -> Image.Image:
+    # JPEG has no alpha: composite on white like the conversion service always did
+    background = Image.new("RGB", image.size, (255, 255, 255))
+    background.paste(image, mask=image.convert("RGBA").split()[-1])
+    return background
+
+
+def _jpeg_subsampling(quality: int) -> int:
+    # 4:4:4 above quality 85, where chroma blur starts to show; 4:2:0 below
+    return 0 if quality > 85 else 2
+
+
+def _log(encoded: EncodedImage) -> EncodedImage:
+    logger.info(
+        f"🗜️ Encoded {encoded.format} {encoded.width}x{encoded.height} ({encoded.preset}, {encoded.strips} strip(s)): "
+        f"{len(encoded.data) / 1e6:.2f} MB in {encoded.seconds:.2f}s"
+    )
+    return encoded
+
+
+def encode_image(image: Image.Image, image_format: str = "PNG", preset: str = "balanced", quality: int = 85) -> EncodedImage:
+    """
+    Encode a PIL image as PNG, JPEG or WEBP with a preset.
+
+    Args:
+        image: Image to encode; an alpha channel is flattened on white for JPEG
+        image_format: "PNG", "JPEG" or "WEBP"
+        preset: "fast", "balanced" or "compact"
+        quality: Lossy quality; WEBP at 100 or more is lossless
+
+    Returns:
+        The encoded bytes with their format, preset and timing
+    """
+    started = time.perf_counter()
+    image_format = image_format.upper()
+    strips = 1
+    if image_format == "PNG" and image.mode in ("L", "LA", "RGB", "RGBA"):
+        pixels = np.asarray(image)
+        strips = _strip_count(pixels)
+    if strips > 1:
+        data = encode_png_strips(pixels, PNG_LEVELS[preset], PNG_STRIP_FILTERS[preset], strips)
+    else:
+        buffer = io.BytesIO()
+        if image_format == "PNG":
+            image.save(buffer, format="PNG", compress_level=PNG_LEVELS[preset])
+        elif image_format == "JPEG":
+            if "A" in image.getbands() or image.mode == "P":
+                image = _flatten_on_white(image)
+            optimize, progressive = JPEG_OPTIONS[preset]
+            image.convert("RGB").save(
+                buffer, format="JPEG", quality=quality, optimize=optimize, progressive=progressive,
+                subsampling=_jpeg_subsampling(quality)
+            )
+        elif image_format == "WEBP":
+            if quality >= 100:
+                image.save(buffer, format="WEBP", lossless=True, method=WEBP_METHODS[preset])
+            else:
+                image.save(buffer, format="WEBP", quality=quality, method=WEBP_METHODS[preset])
+        else:
+            raise ValueError(f"Unsupported output format: {image_format}")
+        data = buffer.getvalue()
+    return _log(EncodedImage(data, image_format, preset, image.width, image.height, time.perf_counter() - started, strips))
+
+
+def encode_bgr(image: np.ndarray, image_format: str = "PNG", preset: str = "balanced", quality: int = 85) -> EncodedImage:
+    """
+    Encode an OpenCV image (BGR, BGRA or gray) as PNG, JPEG or WEBP with a preset.
+
+    Args:
+        image: HxW or HxWxC array in OpenCV channel order
+        image_format: "PNG", "JPEG" or "WEBP"
+        preset: "fast", "balanced" or "compact"
+        quality: Lossy quality; WEBP at 100 or more is lossless
+
+    Returns:
+        The encoded bytes with their format, preset and timing
+    """
+    image_format = image_format.upper()
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    if image_format == "WEBP" or (image_format == "JPEG" and channels == 4):
+        # WebP presets need libwebp's method, and JPEG flattens alpha, both through PIL
+        code = {3: cv2.COLOR_BGR2RGB, 4: cv2.COLOR_BGRA2RGBA}.get(channels)
+        return encode_image(Image.fromarray(cv2.cvtColor(image, code) if code else image), image_format, preset, quality)
+
+    started = time.perf_counter()
+    height, width = image.shape[:2]
+    strips = 1
+    if image_format == "PNG":
+        strips = _strip_count(image)
+        if strips > 1:
+            order = {3: (2, 1, 0), 4: (2, 1, 0, 3)}.get(channels)
+            data = encode_png_strips(image, PNG_LEVELS[preset], PNG_STRIP_FILTERS[preset], strips, order)
+        else:
+            is_success, buffer = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_LEVELS[preset]])
+            if not is_success:
+                raise RuntimeError("Failed to encode PNG")
+            data = buffer.tobytes()
+    elif image_format == "JPEG":
+        optimize, progressive = JPEG_OPTIONS[preset]
+        is_success, buffer = cv2.imencode(".jpg", image, [
+            cv2.IMWRITE_JPEG_QUALITY, quality,
+            cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize),
+            cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive),
+        ])
+        if not is_success:
+            raise RuntimeError("Failed to encode JPEG")
+        data = buffer.tobytes()
+    else:
+        raise ValueError(f"Unsupported output format: {image_format}")
+    return _log(EncodedImage(data, image_format, preset, width, height, time.perf_counter() - started, strips))
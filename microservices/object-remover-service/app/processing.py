@@ -3,13 +3,34 @@ import cv2
 import numpy as np
 from PIL import Image, ImageFilter, ImageEnhance
 import gc
-from typing import Dict, Tuple, Any, List, Union
+import threading
+from typing import Dict, Tuple, Any, List, Union, Optional
 import os
 import urllib.request
 from pathlib import Path
 
+from app.config import MODEL_MEMORY_MB, LAMA_IO_BINDING, LAMA_DIAGNOSTICS
+from app.scheduling import ImageProbe
+from app.cancellation import cancellation_registry
+from app.inference import ModelHandler, get_inference_client
+from app.threads import thread_budget
+from app.admission import get_job_tier
+from app.quantization import QuantizationSpec, ModelVariant, model_registry, model_version
+from app.preview import JobPreview
+from app.decoding import decode_bgr
+from app.encoding import encode_bgr, select_preset
+from app.thumbnails import publish_result
+
 logger = logging.getLogger(__name__)
 
+# Degraded mode under load: OpenCV inpainting instead of LaMa
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"use_lama": False}
+
+# Full-resolution uint8 and float32 working copies alive at once, per input pixel
+IMAGE_BYTES_PER_PIXEL = 80
+
+# Name of the LaMa session on the inference sidecar
+LAMA_MODEL = "lama"
 
 class ImageProcessingError(Exception):
     """Custom exception for image processing errors."""
@@ -29,6 +50,18 @@ class LaMaLiteModel:
         self.session = None
         self.model_loaded = False
         self.input_size = 512  # Standard LaMa input size
+        self.diagnostics = LAMA_DIAGNOSTICS
+
+        # Resolved once in load_model: input layout, reusable tensors and their IOBinding
+        self.input_names: List[str] = []
+        self.output_name: Optional[str] = None
+        self.concatenated_input = False
+        self._input_buffer: Optional[np.ndarray] = None
+        self._image_buffer: Optional[np.ndarray] = None
+        self._mask_buffer: Optional[np.ndarray] = None
+        self._output_buffer: Optional[np.ndarray] = None
+        self._binding = None
+        self._lock = threading.Lock()
         
         # Model URLs - Enlaces REALES verificados
         self.model_urls = {
@@ -104,9 +137,8 @@ class LaMaLiteModel:
             
             # Configure ONNX Runtime for CPU
             providers = ['CPUExecutionProvider']
-            sess_options = ort.SessionOptions()
-            sess_options.intra_op_num_threads = 4
-            sess_options.inter_op_num_threads = 4
+            # Threads per job slot, so concurrent jobs don't oversubscribe the CPUs
+            sess_options = thread_budget.ort_session_options(ort)
             sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
             
             self.session = ort.InferenceSession(
@@ -114,9 +146,16 @@ class LaMaLiteModel:
                 providers=providers,
                 sess_options=sess_options
             )
+            self._resolve_layout()
+            if LAMA_IO_BINDING:
+                self._bind(ort)
             
             self.model_loaded = True
-            logger.info("LaMa model loaded successfully for CPU inference")
+            logger.info(
+                f"LaMa model loaded successfully for CPU inference "
+                f"({'concatenated' if self.concatenated_input else 'separate'} inputs, "
+                f"IOBinding: {self._binding is not None})"
+            )
             return True
             
         except ImportError:
@@ -126,8 +165,49 @@ class LaMaLiteModel:
             logger.error(f"Failed to load LaMa model: {e}")
             return False
     
+    def _resolve_layout(self) -> None:
+        """Read the model's inputs and output once and allocate the tensors every call reuses."""
+        inputs_info = self.session.get_inputs()
+        outputs_info = self.session.get_outputs()
+        if self.diagnostics:
+            for inp in inputs_info:
+                logger.debug(f"LaMa input {inp.name}: shape {inp.shape}, type {inp.type}")
+            for out in outputs_info:
+                logger.debug(f"LaMa output {out.name}: shape {out.shape}, type {out.type}")
+
+        self.input_names = [inp.name for inp in inputs_info]
+        self.output_name = outputs_info[0].name
+        self.concatenated_input = len(self.input_names) == 1
+        size = self.input_size
+        if self.concatenated_input:
+            # One [image, mask] tensor: the image and mask buffers are views into it, so nothing is concatenated per call
+            self._input_buffer = np.zeros((1, 4, size, size), dtype=np.float32)
+            self._image_buffer = self._input_buffer[:, :3]
+            self._mask_buffer = self._input_buffer[:, 3:]
+        else:
+            self._image_buffer = np.zeros((1, 3, size, size), dtype=np.float32)
+            self._mask_buffer = np.zeros((1, 1, size, size), dtype=np.float32)
+
+        # Symbolic output dimensions (batch, height, width) are those of the input
+        shape = outputs_info[0].shape
+        fixed = [dim if isinstance(dim, int) else default for dim, default in zip(shape, (1, 3, size, size))]
+        self._output_buffer = np.zeros(fixed if len(fixed) == 4 else (1, 3, size, size), dtype=np.float32)
+
+    def _bind(self, ort) -> None:
+        """Bind the reusable tensors once: every run reads and writes them in place."""
+        try:
+            binding = self.session.io_binding()
+            feeds = [self._input_buffer] if self.concatenated_input else [self._image_buffer, self._mask_buffer]
+            for name, buffer in zip(self.input_names, feeds):
+                binding.bind_ortvalue_input(name, ort.OrtValue.ortvalue_from_numpy(buffer))
+            binding.bind_ortvalue_output(self.output_name, ort.OrtValue.ortvalue_from_numpy(self._output_buffer))
+            self._binding = binding
+        except Exception as e:
+            logger.warning(f"LaMa IOBinding unavailable, using session.run: {e}")
+            self._binding = None
+
     def preprocess(self, image: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
-        """VERSIÓN CORREGIDA del preprocessing"""
+        """Resize, pad and normalize into the model's input tensors (the reusable ones once loaded)."""
         h, w = image.shape[:2]
         
         # Calculate resize ratio
@@ -149,163 +229,169 @@ class LaMaLiteModel:
             mask_resized, 0, pad_h, 0, pad_w, cv2.BORDER_CONSTANT, value=0
         )
         
-        # *** FIX CRÍTICO 1: Conversión correcta ***
-        image_rgb = cv2.cvtColor(image_padded, cv2.COLOR_BGR2RGB)
-        image_norm = image_rgb.astype(np.float32) / 255.0
-        
-        # *** FIX CRÍTICO 2: Máscara correcta para LaMa ***
-        # LaMa espera: 1 = remover, 0 = conservar
-        # Tu máscara actual tiene 255 donde remover, así que:
-        mask_binary = (mask_padded > 127).astype(np.float32)  # Esto está CORRECTO
+        size = self.input_size
+        image_tensor = self._image_buffer if self._image_buffer is not None else np.empty((1, 3, size, size), np.float32)
+        mask_tensor = self._mask_buffer if self._mask_buffer is not None else np.empty((1, 1, size, size), np.float32)
+
+        # BGR HWC uint8 -> RGB CHW float in [0, 1], one channel at a time straight into the tensor
+        for channel in range(3):
+            np.multiply(image_padded[:, :, 2 - channel], 1.0 / 255.0, out=image_tensor[0, channel], casting="unsafe")
         
-        # Convert to tensors
-        image_tensor = np.transpose(image_norm, (2, 0, 1))[np.newaxis, ...]
-        mask_tensor = mask_binary[np.newaxis, np.newaxis, ...]
+        # LaMa expects 1 = remove, 0 = keep; the mask has 255 where to remove
+        np.greater(mask_padded, 127, out=mask_tensor[0, 0], casting="unsafe")
         
         return image_tensor, mask_tensor, (h, w), (new_h, new_w), (pad_h, pad_w)
 
     
     def postprocess(self, output: np.ndarray, original_size: Tuple[int, int], 
                      new_size: Tuple[int, int], padding: Tuple[int, int]) -> np.ndarray:
-        """VERSIÓN CORREGIDA del postprocessing"""
-        
-        # Convert from [1, C, H, W] to [H, W, C]
-        if len(output.shape) == 4:
-            output = np.transpose(output[0], (1, 2, 0))
-        elif len(output.shape) == 3:
-            output = np.transpose(output, (1, 2, 0))
-        
-        # *** FIX CRÍTICO 3: Verificar rango del output ***
-        print(f"Output range: {output.min():.3f} to {output.max():.3f}")
-        
-        # Manejar diferentes rangos de salida del modelo
-        if output.max() <= 1.0:
-            # Output en [0, 1]
-            output = np.clip(output * 255.0, 0, 255).astype(np.uint8)
-        elif output.min() >= -1.0 and output.max() <= 1.0:
-            # Output en [-1, 1]
-            output = np.clip((output + 1.0) * 127.5, 0, 255).astype(np.uint8)
-        else:
-            # Output ya en [0, 255]
-            output = np.clip(output, 0, 255).astype(np.uint8)
+        """Crop the padding, scale to uint8 BGR and resize back to the original size."""
+        if output.ndim == 4:
+            output = output[0]
+        
+        # [C, H, W] RGB -> [H, W, C] BGR view of the unpadded region, converted in a single pass
+        new_h, new_w = new_size
+        view = output[::-1, :new_h, :new_w].transpose(1, 2, 0)
         
-        # Remove padding
-        pad_h, pad_w = padding
-        if pad_h > 0:
-            output = output[:-pad_h, :]
-        if pad_w > 0:
-            output = output[:, :-pad_w]
+        # Models output either [0, 1] or [0, 255]
+        scale = 255.0 if view.max() <= 1.0 else 1.0
+        if self.diagnostics:
+            logger.debug(f"LaMa output range: {view.min():.3f} to {view.max():.3f}, mean {view.mean():.3f}")
+        result = np.empty((new_h, new_w, 3), dtype=np.uint8)
+        np.clip(view * scale, 0, 255, out=result, casting="unsafe")
         
         # Resize back
         original_h, original_w = original_size
-        output = cv2.resize(output, (original_w, original_h), interpolation=cv2.INTER_LINEAR)
-        
-        # Convert RGB back to BGR
-        if len(output.shape) == 3 and output.shape[2] == 3:
-            output_bgr = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
-        else:
-            output_bgr = output
-        
-        return output_bgr
+        return cv2.resize(result, (original_w, original_h), interpolation=cv2.INTER_LINEAR)
         
     def inpaint(self, image: np.ndarray, mask: np.ndarray) -> np.ndarray:
-        """VERSIÓN CORREGIDA de la inferencia"""
+        """Inpaint the masked region of a BGR image with LaMa at 512x512."""
         if not self.model_loaded or not self.session:
             raise RuntimeError("LaMa model not loaded")
         
-        # *** FIX CRÍTICO 4: Validar inputs ***
-        print(f"Input image shape: {image.shape}, dtype: {image.dtype}")
-        print(f"Input mask shape: {mask.shape}, dtype: {mask.dtype}")
-        print(f"Mask unique values: {np.unique(mask)}")
-        
-        # Preprocess
-        image_tensor, mask_tensor, orig_size, new_size, padding = self.preprocess(image, mask)
-        
-        # *** FIX CRÍTICO 5: Debug tensors ***
-        print(f"Image tensor - shape: {image_tensor.shape}, range: {image_tensor.min():.3f} to {image_tensor.max():.3f}")
-        print(f"Mask tensor - shape: {mask_tensor.shape}, range: {mask_tensor.min():.3f} to {mask_tensor.max():.3f}")
-        
-        # Get model info
-        inputs_info = self.session.get_inputs()
-        outputs_info = self.session.get_outputs()
-        
-        print(f"Model expects {len(inputs_info)} inputs:")
-        for i, inp in enumerate(inputs_info):
-            print(f"  Input {i}: {inp.name}, shape: {inp.shape}, type: {inp.type}")
+        if self.diagnostics:
+            logger.debug(f"LaMa input image {image.shape} {image.dtype}, mask {mask.shape} {mask.dtype}, "
+                         f"mask values {np.unique(mask)}")
         
-        print(f"Model produces {len(outputs_info)} outputs:")
-        for i, out in enumerate(outputs_info):
-            print(f"  Output {i}: {out.name}, shape: {out.shape}, type: {out.type}")
-        
-        # Prepare inputs
-        input_names = [inp.name for inp in inputs_info]
-        
-        if len(input_names) == 2:
-            # Separate inputs
-            inputs = {
-                input_names[0]: image_tensor,
-                input_names[1]: mask_tensor
-            }
-        elif len(input_names) == 1:
-            # *** FIX CRÍTICO 6: Verificar el orden de concatenación ***
-            # Algunos modelos esperan [image, mask], otros [mask, image]
-            # Probar ambas versiones:
-            try:
-                # Versión 1: [image, mask]
-                concatenated = np.concatenate([image_tensor, mask_tensor], axis=1)
-                inputs = {input_names[0]: concatenated}
-                print(f"Trying concatenated input [image, mask]: {concatenated.shape}")
-            except:
-                # Versión 2: [mask, image] 
-                concatenated = np.concatenate([mask_tensor, image_tensor], axis=1)
-                inputs = {input_names[0]: concatenated}
-                print(f"Trying concatenated input [mask, image]: {concatenated.shape}")
-        
-        # Run inference
-        try:
-            outputs = self.session.run(None, inputs)
-            output = outputs[0]
-            print(f"Inference successful - output shape: {output.shape}, range: {output.min():.3f} to {output.max():.3f}")
+        # The tensors are shared by every call on this model: one inference at a time
+        with self._lock:
+            image_tensor, mask_tensor, orig_size, new_size, padding = self.preprocess(image, mask)
             
-            # *** FIX CRÍTICO 7: Validar que el output no sea todo blanco ***
-            if output.mean() > 0.95:  # Si el promedio es muy alto (blanco)
-                print("WARNING: Output seems to be mostly white!")
-                print(f"Output stats - mean: {output.mean():.3f}, std: {output.std():.3f}")
-                
-        except Exception as e:
-            print(f"Inference failed: {e}")
-            raise
-        
-        # Postprocess
-        result = self.postprocess(output, orig_size, new_size, padding)
+            if self._binding is not None:
+                self.session.run_with_iobinding(self._binding)
+                output = self._output_buffer
+            elif self.concatenated_input:
+                output = self.session.run([self.output_name], {self.input_names[0]: self._input_buffer})[0]
+            else:
+                output = self.session.run(
+                    [self.output_name], {self.input_names[0]: image_tensor, self.input_names[1]: mask_tensor}
+                )[0]
+            
+            result = self.postprocess(output, orig_size, new_size, padding)
         
-        # *** FIX CRÍTICO 8: Validación final ***
-        print(f"Final result - shape: {result.shape}, range: {result.min()} to {result.max()}")
+        if self.diagnostics:
+            logger.debug(f"LaMa result {result.shape}, range {result.min()} to {result.max()}, mean {result.mean():.1f}")
         
         return result
 
 
+class RemoteLaMaModel:
+    """Stand-in for LaMaLiteModel served by the inference sidecar"""
+
+    def __init__(self, client, model: str = LAMA_MODEL):
+        self.client = client
+        self.model = model
+        self.session = None
+        self.model_loaded = True
+
+    def inpaint(self, image: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        outputs, _ = self.client.call(self.model, {"image": image, "mask": mask})
+        return outputs["image"]
+
+
+class LaMaModelCache:
+    """LaMa models kept loaded for the life of the worker, one per concurrent job and model path.
+
+    Each CPUObjectRemover takes an idle model (loading one only when all are in
+    use) and gives it back on cleanup, so the session, its layout and its bound
+    tensors are built once instead of per job.
+    """
+
+    def __init__(self):
+        self._idle: Dict[Optional[str], List[LaMaLiteModel]] = {}
+        self._loaded: Dict[Optional[str], int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, model_path: Optional[str] = None) -> Optional[LaMaLiteModel]:
+        """An idle loaded model for the path (None: the downloaded FP32 model), or None if it fails to load."""
+        with self._lock:
+            idle = self._idle.get(model_path)
+            if idle:
+                return idle.pop()
+        model = LaMaLiteModel(model_path)
+        if not model.load_model():
+            return None
+        with self._lock:
+            self._loaded[model_path] = self._loaded.get(model_path, 0) + 1
+        return model
+
+    def release(self, model: LaMaLiteModel, model_path: Optional[str] = None) -> None:
+        with self._lock:
+            self._idle.setdefault(model_path, []).append(model)
+
+    def has_idle(self, model_path: Optional[str] = None) -> bool:
+        with self._lock:
+            return bool(self._idle.get(model_path))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._idle.clear()
+            self._loaded.clear()
+        gc.collect()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                str(path or LAMA_MODEL): {"loaded": self._loaded.get(path, 0), "idle": len(self._idle.get(path, []))}
+                for path in self._loaded
+            }
+
+
+lama_models = LaMaModelCache()
+
+
+def _lama_handler(model: LaMaLiteModel) -> ModelHandler:
+    def run(arrays, params, cancelled):
+        return {"image": model.inpaint(arrays["image"], arrays["mask"])}, {}
+    return ModelHandler(run)
+
+
 class CPUObjectRemover:
     """LaMa-inspired CPU Object Remover with enhanced large object handling"""
 
-    def __init__(self, use_lama: bool = True, model_path: str = None):
+    def __init__(self, use_lama: bool = True, model_path: str = None, variant: Optional[ModelVariant] = None):
         """Initialize with LaMa model option
         
         Args:
             use_lama: Whether to use LaMa model (requires onnxruntime)
             model_path: Path to custom LaMa ONNX model
+            variant: Quantized LaMa variant to run instead of the FP32 model
         """
         self.use_lama = use_lama
         self.lama_model = None
+        self.model_version = model_version(LAMA_MODEL, variant)
+        self._model_path = model_path or (variant.path if variant is not None else None)
         
-        if use_lama:
+        inference_client = get_inference_client() if use_lama and not model_path else None
+        if inference_client is not None:
+            self.lama_model = RemoteLaMaModel(inference_client, self.model_version)
+        elif use_lama:
             try:
-                self.lama_model = LaMaLiteModel(model_path)
-                success = self.lama_model.load_model()
-                if not success:
+                # A model kept loaded by earlier jobs of this worker, returned on cleanup
+                self.lama_model = lama_models.acquire(self._model_path)
+                if self.lama_model is None:
                     logger.warning("Failed to load LaMa model, using OpenCV fallback")
                     self.use_lama = False
-                    self.lama_model = None
             except Exception as e:
                 logger.warning(f"LaMa initialization failed: {e}, using OpenCV fallback")
                 self.use_lama = False
@@ -776,7 +862,8 @@ class CPUObjectRemover:
     def process(self, 
                input_image: np.ndarray, 
                coordinates: List[Dict[str, Union[int, float]]],
-               config: Dict[str, Any] = None) -> np.ndarray:
+               config: Dict[str, Any] = None,
+               preview: Optional[JobPreview] = None) -> np.ndarray:
         """Enhanced main processing function with large object handling"""
         if config is None:
             config = {}
@@ -802,6 +889,9 @@ class CPUObjectRemover:
             # Process mask according to strategy
             mask = self._process_mask_for_strategy(mask, strategy)
             
+            if preview is not None and preview.wanted:
+                self._publish_preview(input_image, mask, preview)
+            
             # Choose appropriate inpainting method
             if self.use_lama and self.lama_model and config.get('use_lama', True):
                 if strategy in ["large_object", "extreme_large", "complex_scene"]:
@@ -854,6 +944,17 @@ class CPUObjectRemover:
             except:
                 return input_image
 
+    def _publish_preview(self, image: np.ndarray, mask: np.ndarray, preview: JobPreview) -> None:
+        """Quick OpenCV TELEA inpaint at preview size, sent while the full inpainting runs"""
+        try:
+            h, w = image.shape[:2]
+            size = preview.fit(w, h)
+            small_image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+            small_mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+            preview.publish(cv2.inpaint(small_image, small_mask, 5, cv2.INPAINT_TELEA), "opencv_telea")
+        except Exception as e:
+            logger.warning(f"Preview inpainting failed: {e}")
+
     def _match_histogram(self, source: np.ndarray, reference: np.ndarray, mask: np.ndarray) -> np.ndarray:
         """Match histogram of inpainted regions to reference image"""
         result = source.copy()
@@ -945,9 +1046,9 @@ class CPUObjectRemover:
 
     def cleanup(self):
         """Clean up resources"""
-        if self.lama_model:
-            self.lama_model.session = None
-            self.lama_model = None
+        if isinstance(self.lama_model, LaMaLiteModel):
+            lama_models.release(self.lama_model, self._model_path)
+        self.lama_model = None
         gc.collect()
         logger.info("CPU processor cleanup completed")
         
@@ -955,10 +1056,96 @@ class CPUObjectRemover:
 
  # Add this function to the end of your processing.py file
 
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """Estimate job cost in input megapixels.
+
+    LaMa runs at a fixed 512x512, but mask processing, blending, bilateral
+    filtering and PNG encoding all run at full resolution.
+    """
+    return probe.megapixels
+
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """Estimate the peak memory of a removal job in bytes.
+
+    A LaMa session (MODEL_MEMORY_MB) is only added when the job would load a
+    new one: the inference sidecar or an idle model kept by this worker cost
+    nothing extra. LaMa runs at a fixed 512x512, while blending and
+    enhancement keep several float32 copies of the full-resolution image.
+    """
+    if probe.megapixels is None:
+        return None
+    model_path = config.get('lama_model_path')
+    if not model_path:
+        variant = model_registry.resolve(LAMA_MODEL, get_job_tier(config))
+        model_path = variant.path if variant is not None else None
+    uses_local_lama = config.get('use_lama', True) and get_inference_client() is None
+    model_mb = MODEL_MEMORY_MB if uses_local_lama and not lama_models.has_idle(model_path) else 0
+    return int(probe.megapixels * 1_000_000 * IMAGE_BYTES_PER_PIXEL + model_mb * 1024 * 1024)
+
+
+def preload_models():
+    """Download and verify the LaMa model before the supervisor forks its workers.
+
+    ONNX Runtime sessions are not fork-safe once their thread pools exist, so
+    the session itself is still created in each worker.
+    """
+    if get_inference_client() is not None:
+        return
+    model_path = LaMaLiteModel()._download_model()
+    if model_path is None:
+        logger.warning("LaMa model preload failed, workers will retry the download per job")
+
+
+def preload_lama() -> None:
+    """Load the FP32 LaMa model into the worker's cache so the first job doesn't build the session.
+
+    Runs in each worker after the fork (ONNX Runtime sessions are not fork-safe).
+    """
+    if get_inference_client() is not None:
+        return
+    model = lama_models.acquire()
+    if model is not None:
+        lama_models.release(model)
+
+
+def inference_handlers() -> Dict[str, ModelHandler]:
+    """Models served by the inference sidecar (python -m app.inference), plus the enabled INT8 variant."""
+    model = LaMaLiteModel()
+    if not model.load_model():
+        raise ImageProcessingError("Failed to load the LaMa model")
+    handlers = {LAMA_MODEL: _lama_handler(model)}
+    variant = model_registry.enabled_variant(LAMA_MODEL)
+    if variant is not None:
+        quantized = LaMaLiteModel(variant.path)
+        if quantized.load_model():
+            handlers[model_version(LAMA_MODEL, variant)] = _lama_handler(quantized)
+    return handlers
+
+
+def quantization_specs() -> Dict[str, QuantizationSpec]:
+    """Models that python -m app.quantization can quantize."""
+    model = LaMaLiteModel()
+
+    def prepare(image: np.ndarray) -> List[np.ndarray]:
+        # Corpus images carry no masks: cover a seeded random box of about 10-25% of the image
+        h, w = image.shape[:2]
+        rng = np.random.default_rng(h * 7919 + w)
+        box_h, box_w = int(h * rng.uniform(0.3, 0.5)), int(w * rng.uniform(0.3, 0.5))
+        top, left = int(rng.integers(0, h - box_h + 1)), int(rng.integers(0, w - box_w + 1))
+        mask = np.zeros((h, w), dtype=np.uint8)
+        mask[top:top + box_h, left:left + box_w] = 255
+        image_tensor, mask_tensor, _, _, _ = model.preprocess(cv2.cvtColor(image, cv2.COLOR_RGB2BGR), mask)
+        return [image_tensor, mask_tensor]
+
+    return {LAMA_MODEL: QuantizationSpec(LAMA_MODEL, model._download_model, prepare, "psnr_db", 30.0, max_side=model.input_size)}
+
+
 async def perform_object_removal(
     job_id: str,
     image_url: str,
-    config: Dict[str, Any]
+    config: Dict[str, Any],
+    preview: Optional[JobPreview] = None
 ) -> Tuple[str, Dict[str, Any]]:
     """LaMa-inspired object removal for CPU"""
     
@@ -967,15 +1154,15 @@ async def perform_object_removal(
     try:
         from app.cloudinary_service import CloudinaryService
         
+        cancellation_registry.check(job_id, "download")
+
         # Download image
         logger.info(f"Downloading image for job {job_id}")
         image_bytes = CloudinaryService.download_image_from_url(image_url)
         
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        input_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        input_image = decode_bgr(image_bytes)
         
-        if input_image is None:
-            raise ValueError("Failed to decode image")
+        cancellation_registry.check(job_id, "inpainting")
         
         coordinates = config.get('coordinates', [])
         if not coordinates:
@@ -985,7 +1172,9 @@ async def perform_object_removal(
         use_lama = config.get('use_lama', True)
         model_path = config.get('lama_model_path', None)
         
-        processor = CPUObjectRemover(use_lama=use_lama, model_path=model_path)
+        # Tiers in QUANTIZED_TIERS run the enabled INT8 LaMa variant, if any
+        variant = model_registry.resolve(LAMA_MODEL, get_job_tier(config)) if use_lama and not model_path else None
+        processor = CPUObjectRemover(use_lama=use_lama, model_path=model_path, variant=variant)
         
         # *** MEJORA: Configuración más conservadora por defecto ***
         enhanced_config = {
@@ -996,7 +1185,8 @@ async def perform_object_removal(
         }
         
         # Process
-        output_image = processor.process(input_image, coordinates, enhanced_config)
+        output_image = processor.process(input_image, coordinates, enhanced_config, preview)
+        cancellation_registry.check(job_id, "encoding")
         
         # Determine method used
         if processor.use_lama and processor.lama_model:
@@ -1006,42 +1196,22 @@ async def perform_object_removal(
             processing_method = "opencv_enhanced_cpu"
             model_used = "opencv_telea_ns_combined"
         
-        # Encode result
-        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
-        is_success, buffer = cv2.imencode('.png', output_image, encode_params)
-        
-        if not is_success:
-            raise RuntimeError("Failed to encode output image")
+        # Encode result with the tier's preset
+        encoded = encode_bgr(output_image, "PNG", select_preset(config))
+        output_bytes = encoded.data
         
-        output_bytes = buffer.tobytes()
+        cancellation_registry.check(job_id, "upload")
         
-        # Create thumbnail
-        h, w = output_image.shape[:2]
-        thumb_scale = min(300 / w, 300 / h, 1.0)
-        
-        if thumb_scale < 1.0:
-            new_w = int(w * thumb_scale)
-            new_h = int(h * thumb_scale)
-            thumbnail = cv2.resize(output_image, (new_w, new_h), interpolation=cv2.INTER_AREA)
-        else:
-            thumbnail = output_image.copy()
-        
-        is_success, thumb_buffer = cv2.imencode('.png', thumbnail)
-        thumbnail_bytes = thumb_buffer.tobytes()
-        
-        # Upload to Cloudinary
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            output_bytes, job_id, "object_removal"
-        )
-        
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
-        )
+        # Upload the result with its thumbnail, downscaled from the array in memory (or derived by Cloudinary)
+        published = publish_result(job_id, output_bytes, "object_removal", output_image)
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
         
         # Processing info
         processing_info = {
             "processing_type": "object_removal",
             "model": model_used,
+            "model_version": processor.model_version if model_used == "lama_lite_onnx" else model_used,
             "method": processing_method,
             "ai_enhanced": processor.use_lama and processor.lama_model is not None,
             "objects_removed": len(coordinates),
@@ -1053,7 +1223,9 @@ async def perform_object_removal(
             "thumbnail_url": thumbnail_url,
             "device_used": "cpu",
             "processing_method": processing_method,
-            "config_used": enhanced_config
+            "config_used": enhanced_config,
+            **encoded.to_params(),
+            **published.to_params()
         }
         
         logger.info(f"Job {job_id} completed - Method: {processing_method}")
@@ -1066,4 +1238,67 @@ async def perform_object_removal(
     finally:
         if processor:
             processor.cleanup()
-        gc.collect()
\ No newline at end of file
+        gc.collect()
+
+def benchmark_lama(runs: int = 10, size: int = 1024, model_path: Optional[str] = None) -> Dict[str, Any]:
+    """Per-call latency and Python-side allocations of LaMa inpainting.
+
+    Compares a session built per call (what every job used to pay) with a
+    persistent model running session.run on its reusable tensors, and with
+    the same model through IOBinding.
+    """
+    import time
+    import tracemalloc
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 255, (size, size, 3), dtype=np.uint8)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    cv2.circle(mask, (size // 2, size // 2), size // 6, 255, -1)
+
+    def fresh_model() -> LaMaLiteModel:
+        model = LaMaLiteModel(model_path)
+        if not model.load_model():
+            raise ImageProcessingError("Failed to load the LaMa model")
+        return model
+
+    def measure(call) -> Dict[str, float]:
+        call()  # Warm-up
+        latencies, peaks = [], []
+        for _ in range(runs):
+            tracemalloc.start()
+            started = time.perf_counter()
+            call()
+            latencies.append(time.perf_counter() - started)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        latencies.sort()
+        return {
+            "p50_ms": round(1000 * latencies[len(latencies) // 2], 1),
+            "mean_ms": round(1000 * sum(latencies) / len(latencies), 1),
+            "peak_python_mb": round(max(peaks) / 1e6, 2),
+        }
+
+    persistent = fresh_model()
+    binding = persistent._binding
+    results: Dict[str, Any] = {"runs": runs, "image_size": size}
+    results["per_job_session"] = measure(lambda: fresh_model().inpaint(image, mask))
+    persistent._binding = None
+    results["persistent_run"] = measure(lambda: persistent.inpaint(image, mask))
+    persistent._binding = binding
+    if binding is not None:
+        results["persistent_iobinding"] = measure(lambda: persistent.inpaint(image, mask))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="LaMa per-call latency and allocations: per-job session vs persistent")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--model-path", default=None)
+    args = parser.parse_args()
+
+    thread_budget.configure_libraries()
+    print(json.dumps(benchmark_lama(args.runs, args.size, args.model_path), indent=2))
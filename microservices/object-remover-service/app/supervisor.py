@@ -0,0 +1,391 @@
+"""
+Pre-fork supervisor module.
+Loads the models once in a parent process, then forks consumer workers that
+share the weight pages copy-on-write, each with its own AMQP connection and
+channel. Workers are recycled after a number of jobs or when their private
+memory grows past a threshold, and the parent reports aggregate throughput
+and memory.
+
+Run with `python -m app.supervisor` instead of uvicorn.
+"""
+
+import asyncio
+import gc
+import json
+import logging
+import os
+import re
+import signal
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing.sharedctypes import RawValue
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.config import (
+    SERVICE_HOST,
+    SERVICE_PORT,
+    SUPERVISOR_WORKERS,
+    WORKER_MAX_JOBS,
+    WORKER_MAX_RSS_MB,
+    SUPERVISOR_STATS_INTERVAL,
+    DRAIN_GRACE_SECONDS
+)
+from app.cancellation import broadcast_cancellation
+from app.memory import read_process_memory, MB
+from app.threads import thread_budget
+
+logger = logging.getLogger(__name__)
+
+# Minimum time between restarts of the same worker slot (crash loops)
+RESTART_BACKOFF_SECONDS = 5.0
+
+# Window used for the jobs-per-minute figure
+THROUGHPUT_WINDOW_SECONDS = 300
+
+# Admin cancellation, forwarded to the workers through the cancellation exchange
+CANCEL_PATH = re.compile(r"^/admin/jobs/([^/]+)/cancel$")
+
+
+class WorkerContext:
+    """What a forked worker needs to know about its slot."""
+
+    def __init__(self, index: int, max_jobs: int, jobs_counter):
+        self.index = index
+        self.max_jobs = max_jobs
+        self._jobs_counter = jobs_counter
+
+    def publish(self, completed_jobs: int) -> None:
+        """Share the worker's completed job count with the supervisor."""
+        self._jobs_counter.value = completed_jobs
+
+    def should_recycle(self, completed_jobs: int) -> bool:
+        return self.max_jobs > 0 and completed_jobs >= self.max_jobs
+
+
+@dataclass
+class WorkerSlot:
+    index: int
+    jobs_counter: Any = field(default_factory=lambda: RawValue("q", 0))
+    pid: Optional[int] = None
+    started_at: float = 0.0
+    restarts: int = 0
+    jobs_before_restart: int = 0
+    recycle_requested: bool = False
+    last_memory: Dict[str, Optional[int]] = field(default_factory=dict)
+
+    @property
+    def total_jobs(self) -> int:
+        return self.jobs_before_restart + self.jobs_counter.value
+
+
+class Supervisor:
+    """
+    Parent process of the pre-fork worker mode.
+
+    `preload` runs once before any fork so the models it caches at module
+    level are inherited by every worker; `gc.freeze()` keeps the collector
+    from touching (and so copying) those objects afterwards. `run_worker` is
+    the coroutine each worker runs; it must return when asked to stop
+    (SIGTERM) or when `WorkerContext.should_recycle` says so.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        preload: Callable[[], None],
+        run_worker: Callable[[WorkerContext], Any],
+        max_jobs: int = 0,
+        max_private_mb: int = 0,
+        stats_interval: float = 60.0,
+        stop_timeout: float = 600.0,
+    ):
+        self.num_workers = max(1, num_workers)
+        self.preload = preload
+        self.run_worker = run_worker
+        self.max_jobs = max_jobs
+        self.max_private_bytes = max_private_mb * MB
+        self.stats_interval = stats_interval
+        self.stop_timeout = stop_timeout
+        self.slots = [WorkerSlot(index) for index in range(self.num_workers)]
+        self.started_at = time.time()
+        self.stopping = False
+        self.exits: Dict[str, int] = {}
+        self._throughput_samples: Deque[Tuple[float, int]] = deque()
+        self._server: Optional[HTTPServer] = None
+
+    # ---- worker side -------------------------------------------------
+
+    def _run_child(self, slot: WorkerSlot) -> None:
+        """Body of a forked worker; never returns."""
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the parent, which stops us
+            if self._server is not None:
+                self._server.socket.close()
+            # Workers split the CPUs between them instead of each sizing its pools for the whole machine
+            thread_budget.assign_worker(slot.index, self.num_workers)
+            logger.info(f"Worker {slot.index} started (pid {os.getpid()})")
+            context = WorkerContext(slot.index, self.max_jobs, slot.jobs_counter)
+            asyncio.run(self.run_worker(context))
+        except Exception:
+            logger.exception(f"Worker {slot.index} crashed")
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def _spawn(self, slot: WorkerSlot) -> None:
+        slot.jobs_before_restart += slot.jobs_counter.value
+        slot.jobs_counter.value = 0
+        slot.recycle_requested = False
+        slot.last_memory = {}
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(slot)
+        slot.pid = pid
+        slot.started_at = time.time()
+        logger.info(f"Spawned worker {slot.index} (pid {pid})")
+
+    # ---- supervisor side ---------------------------------------------
+
+    def _handle_stop(self, signum, frame) -> None:
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.warning(f"Supervisor received signal {signum}, draining workers")
+        self._signal_workers(signal.SIGTERM)
+
+    def _signal_workers(self, signum: int) -> None:
+        for slot in self.slots:
+            if slot.pid is not None:
+                try:
+                    os.kill(slot.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def _reap(self) -> List[WorkerSlot]:
+        """Collect exited workers and return their slots."""
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            slot = next((s for s in self.slots if s.pid == pid), None)
+            if slot is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            reason = "recycled" if slot.recycle_requested or code == 0 else "crashed"
+            self.exits[reason] = self.exits.get(reason, 0) + 1
+            log = logger.info if reason == "recycled" else logger.error
+            log(f"Worker {slot.index} (pid {pid}) exited with code {code} after {slot.jobs_counter.value} jobs ({reason})")
+            slot.pid = None
+            exited.append(slot)
+        return exited
+
+    def _check_memory(self) -> None:
+        for slot in self.slots:
+            if slot.pid is None:
+                continue
+            slot.last_memory = read_process_memory(slot.pid)
+            private = slot.last_memory.get("private")
+            if self.max_private_bytes and private and private > self.max_private_bytes and not slot.recycle_requested:
+                logger.warning(
+                    f"Worker {slot.index} private memory {private / MB:.0f}MB over "
+                    f"{self.max_private_bytes / MB:.0f}MB, recycling it"
+                )
+                slot.recycle_requested = True
+                os.kill(slot.pid, signal.SIGTERM)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Aggregate throughput and memory of the supervisor and its workers."""
+        now = time.time()
+        total_jobs = sum(slot.total_jobs for slot in self.slots)
+        self._throughput_samples.append((now, total_jobs))
+        while self._throughput_samples and now - self._throughput_samples[0][0] > THROUGHPUT_WINDOW_SECONDS:
+            self._throughput_samples.popleft()
+        first_time, first_jobs = self._throughput_samples[0]
+        jobs_per_minute = (total_jobs - first_jobs) * 60 / (now - first_time) if now > first_time else None
+
+        parent_memory = read_process_memory(os.getpid())
+        workers = []
+        for slot in self.slots:
+            memory = slot.last_memory or {}
+            workers.append({
+                "index": slot.index,
+                "pid": slot.pid,
+                "alive": slot.pid is not None,
+                "uptime_seconds": round(now - slot.started_at, 1) if slot.pid is not None else None,
+                "jobs": slot.jobs_counter.value,
+                "total_jobs": slot.total_jobs,
+                "restarts": slot.restarts,
+                "rss_mb": round(memory["rss"] / MB) if memory.get("rss") else None,
+                "pss_mb": round(memory["pss"] / MB) if memory.get("pss") else None,
+                "private_mb": round(memory["private"] / MB) if memory.get("private") else None,
+            })
+
+        def total(key: str) -> Optional[int]:
+            values = [(slot.last_memory or {}).get(key) for slot in self.slots if slot.pid is not None]
+            values.append(parent_memory.get(key))
+            return round(sum(v for v in values if v) / MB) if any(values) else None
+
+        return {
+            "workers": workers,
+            "num_workers": self.num_workers,
+            "stopping": self.stopping,
+            "total_jobs": total_jobs,
+            "jobs_per_minute": round(jobs_per_minute, 2) if jobs_per_minute is not None else None,
+            "uptime_seconds": round(now - self.started_at, 1),
+            "exits": dict(self.exits),
+            "max_jobs_per_worker": self.max_jobs,
+            "max_private_mb": round(self.max_private_bytes / MB),
+            "parent_rss_mb": round(parent_memory["rss"] / MB) if parent_memory.get("rss") else None,
+            # RSS counts the shared weights once per process, PSS splits them
+            "total_rss_mb": total("rss"),
+            "total_pss_mb": total("pss"),
+            "timestamp": now,
+        }
+
+    def _start_stats_server(self, host: str, port: int) -> None:
+        supervisor = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def _reply(self, status: int, body: Dict[str, Any]) -> None:
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                if self.path == "/health":
+                    alive = sum(1 for slot in supervisor.slots if slot.pid is not None)
+                    healthy = alive > 0 and not supervisor.stopping
+                    self._reply(200 if healthy else 503, {
+                        "status": "draining" if supervisor.stopping else ("healthy" if healthy else "degraded"),
+                        "workers_alive": alive,
+                    })
+                elif self.path == "/metrics/workers":
+                    self._reply(200, supervisor.snapshot())
+                else:
+                    self._reply(404, {"detail": "Not Found"})
+
+            def do_POST(self):
+                cancel = CANCEL_PATH.match(self.path)
+                if self.path == "/admin/drain":
+                    supervisor._handle_stop(signal.SIGTERM, None)
+                    self._reply(202, supervisor.snapshot())
+                elif cancel:
+                    job_id = cancel.group(1)
+                    try:
+                        broadcast_cancellation(job_id, "admin endpoint")
+                    except Exception as e:
+                        logger.error(f"Could not forward cancellation of job {job_id} to the workers: {e}")
+                        self._reply(503, {"jobId": job_id, "cancelled": False, "detail": str(e)})
+                        return
+                    self._reply(200, {"jobId": job_id, "cancelled": True})
+                else:
+                    self._reply(404, {"detail": "Not Found"})
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        try:
+            self._server = HTTPServer((host, port), StatsHandler)
+            self._server.timeout = 1.0
+            logger.info(f"Supervisor stats on http://{host}:{port}/metrics/workers")
+        except OSError as e:
+            logger.warning(f"Supervisor stats server unavailable: {e}")
+            self._server = None
+
+    def _wait(self, seconds: float) -> None:
+        """Sleep while serving stats requests (single-threaded, so forking stays safe)."""
+        if self._server is not None:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                self._server.handle_request()
+        else:
+            time.sleep(seconds)
+
+    def run(self, host: str = "0.0.0.0", port: int = 0) -> None:
+        logger.info(f"Preloading models before forking {self.num_workers} workers")
+        started = time.perf_counter()
+        self.preload()
+        gc.collect()
+        gc.freeze()
+        logger.info(f"Preload finished in {time.perf_counter() - started:.1f}s, parent RSS "
+                    f"{(read_process_memory(os.getpid()).get('rss') or 0) / MB:.0f}MB")
+
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        if port:
+            self._start_stats_server(host, port)
+
+        for slot in self.slots:
+            self._spawn(slot)
+
+        last_stats = time.monotonic()
+        stop_deadline: Optional[float] = None
+        while True:
+            self._wait(1.0)
+            for slot in self._reap():
+                if self.stopping:
+                    continue
+                backoff = RESTART_BACKOFF_SECONDS - (time.time() - slot.started_at)
+                if backoff > 0:
+                    self._wait(backoff)
+                    if self.stopping:
+                        continue
+                slot.restarts += 1
+                self._spawn(slot)
+
+            if self.stopping:
+                if stop_deadline is None:
+                    stop_deadline = time.monotonic() + self.stop_timeout
+                if all(slot.pid is None for slot in self.slots):
+                    break
+                if time.monotonic() > stop_deadline:
+                    logger.error("Workers did not drain in time, killing them")
+                    self._signal_workers(signal.SIGKILL)
+                    stop_deadline = float("inf")
+                continue
+
+            self._check_memory()
+            if time.monotonic() - last_stats >= self.stats_interval:
+                last_stats = time.monotonic()
+                stats = self.snapshot()
+                logger.info(
+                    f"Supervisor: {stats['total_jobs']} jobs, {stats['jobs_per_minute']} jobs/min, "
+                    f"RSS {stats['total_rss_mb']}MB, PSS {stats['total_pss_mb']}MB"
+                )
+
+        if self._server is not None:
+            self._server.server_close()
+        logger.info("Supervisor stopped")
+
+
+def main() -> None:
+    # Imported here so the config/logging setup of the service runs first
+    from app.main import run_worker
+    from app.processing import preload_models
+
+    supervisor = Supervisor(
+        SUPERVISOR_WORKERS,
+        preload_models,
+        run_worker,
+        max_jobs=WORKER_MAX_JOBS,
+        max_private_mb=WORKER_MAX_RSS_MB,
+        stats_interval=SUPERVISOR_STATS_INTERVAL,
+        stop_timeout=DRAIN_GRACE_SECONDS + 60,
+    )
+    supervisor.run(SERVICE_HOST, SERVICE_PORT)
+
+
+if __name__ == "__main__":
+    main()
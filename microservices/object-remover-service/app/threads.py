@@ -0,0 +1,278 @@
+"""
+CPU thread budget module.
+Divides the CPUs available to the container (cgroup quota and affinity
+aware) among the concurrent job slots and configures torch, ONNX Runtime,
+OpenCV and the BLAS/OpenMP/numexpr pools consistently, so several jobs in
+flight don't oversubscribe the cores. Optionally pins each slot to its own
+core set.
+
+Importing this module exports the thread environment variables, so it must
+be imported before numpy, torch or cv2 are loaded. `python -m app.threads`
+benchmarks throughput across slot counts.
+"""
+
+import itertools
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from app.config import CPU_JOB_SLOTS, CPU_THREADS_PER_SLOT, CPU_PINNING
+
+logger = logging.getLogger(__name__)
+
+# Read by OpenMP (torch), MKL, OpenBLAS, Accelerate and numexpr when they load;
+# rembg also sizes its ONNX Runtime sessions from OMP_NUM_THREADS
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+def _read_cgroup_cpu_quota() -> Optional[float]:
+    """CPUs granted by the cgroup CFS quota (v2, then v1), or None without a quota."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpu_ids() -> List[int]:
+    """CPUs this process may run on (its affinity mask)."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def available_cpus() -> int:
+    """Usable CPUs: the affinity mask, capped by the cgroup CPU quota."""
+    cpus = len(available_cpu_ids())
+    quota = _read_cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+    return max(1, cpus)
+
+
+class ThreadBudget:
+    """
+    Threads per job slot for every library that runs its own thread pool.
+
+    torch's and OpenCV's pools are process-wide, so they're sized for one
+    slot and every concurrent job uses a pool of that size; ONNX Runtime
+    sessions get their own options. With `pin`, the thread running a job
+    slot is bound to a disjoint core set (see `slot_initializer`).
+    """
+
+    def __init__(self, cpu_ids: List[int], cpus: int, slots: int, threads_per_slot: int = 0, pin: bool = False):
+        self.cpu_ids = cpu_ids
+        self.cpus = max(1, cpus)
+        self.slots = max(1, slots)
+        self._explicit_threads = threads_per_slot > 0
+        self.threads_per_slot = threads_per_slot if self._explicit_threads else max(1, self.cpus // self.slots)
+        self.pin = pin
+        self._next_slot = itertools.count()
+        self._exported: List[str] = []
+        self._configured: Dict[str, Any] = {}
+
+    @classmethod
+    def from_environment(cls, slots: int, threads_per_slot: int = 0, pin: bool = False) -> "ThreadBudget":
+        return cls(available_cpu_ids(), available_cpus(), slots, threads_per_slot, pin)
+
+    def assign_worker(self, index: int, workers: int) -> None:
+        """
+        Narrow the budget to one of `workers` forked processes sharing the CPUs
+        (its own core set with pinning). Call in the child before any lane
+        thread starts and before `configure_libraries`.
+        """
+        workers = max(1, workers)
+        if self.pin:
+            self.cpu_ids = self.core_sets(workers)[index % workers]
+            self.pin_current(self.cpu_ids)
+        self.cpus = max(1, self.cpus // workers)
+        if not self._explicit_threads:
+            self.threads_per_slot = max(1, self.cpus // self.slots)
+        self.export_environment()
+
+    def core_sets(self, parts: Optional[int] = None) -> List[List[int]]:
+        """Split the usable CPU ids into `parts` (default: one per slot) contiguous sets."""
+        parts = parts or self.slots
+        cpu_ids = self.cpu_ids[:self.cpus]
+        size = max(1, len(cpu_ids) // parts)
+        # With more parts than CPUs the sets wrap around and share cores
+        return [cpu_ids[(i * size) % len(cpu_ids):][:size] for i in range(parts)]
+
+    def export_environment(self) -> None:
+        """Set the thread env vars (explicit values from the deployment win)."""
+        for name in THREAD_ENV_VARS:
+            if name not in os.environ or name in self._exported:
+                os.environ[name] = str(self.threads_per_slot)
+                if name not in self._exported:
+                    self._exported.append(name)
+
+    def configure_libraries(self) -> Dict[str, Any]:
+        """Size the pools of the libraries already loaded in this process."""
+        configured: Dict[str, Any] = {}
+        torch = sys.modules.get("torch")
+        if torch is not None:
+            torch.set_num_threads(self.threads_per_slot)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass  # Only settable before the first inter-op parallel work
+            configured["torch"] = torch.get_num_threads()
+        cv2 = sys.modules.get("cv2")
+        if cv2 is not None:
+            cv2.setNumThreads(self.threads_per_slot)
+            configured["cv2"] = cv2.getNumThreads()
+        numexpr = sys.modules.get("numexpr")
+        if numexpr is not None:
+            numexpr.set_num_threads(self.threads_per_slot)
+            configured["numexpr"] = self.threads_per_slot
+        self._configured = configured
+        logger.info(
+            f"🧵 Thread budget: {self.cpus} CPUs / {self.slots} slots = {self.threads_per_slot} threads per slot "
+            f"(pinning {'on' if self.pin else 'off'}), configured {configured}"
+        )
+        return configured
+
+    def ort_session_options(self, ort: Any) -> Any:
+        """ONNX Runtime SessionOptions for one slot (sequential graph execution, no inter-op pool)."""
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads_per_slot
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        return options
+
+    def pin_current(self, cpu_ids: List[int]) -> None:
+        """Bind the calling thread (or process, from its main thread) to `cpu_ids`."""
+        if not hasattr(os, "sched_setaffinity") or not cpu_ids:
+            return
+        try:
+            os.sched_setaffinity(0, cpu_ids)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not pin to CPUs {cpu_ids}: {e}")
+
+    def slot_initializer(self):
+        """ThreadPoolExecutor initializer pinning each new slot thread to the next core set."""
+        if not self.pin:
+            return None
+
+        def initializer() -> None:
+            # Resolved when the thread starts, after a supervisor worker has narrowed the budget
+            core_sets = self.core_sets()
+            cpu_ids = core_sets[next(self._next_slot) % len(core_sets)]
+            self.pin_current(cpu_ids)
+            logger.info(f"📌 {threading.current_thread().name} pinned to CPUs {cpu_ids}")
+
+        return initializer
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "cpus": self.cpus,
+            "cpu_ids": self.cpu_ids,
+            "cgroup_cpu_quota": _read_cgroup_cpu_quota(),
+            "slots": self.slots,
+            "threads_per_slot": self.threads_per_slot,
+            "pinning": self.pin,
+            "core_sets": self.core_sets() if self.pin else None,
+            "env": {name: os.environ.get(name) for name in THREAD_ENV_VARS},
+            "configured": dict(self._configured),
+        }
+
+
+thread_budget = ThreadBudget.from_environment(CPU_JOB_SLOTS, CPU_THREADS_PER_SLOT, CPU_PINNING)
+thread_budget.export_environment()
+
+
+def _benchmark_job(size: int) -> None:
+    import numpy as np
+    import cv2
+
+    image = np.random.default_rng(0).integers(0, 255, (size, size, 3), dtype=np.uint8)
+    blurred = cv2.GaussianBlur(image, (0, 0), 3)
+    cv2.resize(blurred, (size * 2, size * 2), interpolation=cv2.INTER_CUBIC)
+    matrix = np.random.default_rng(1).random((size // 2, size // 2), dtype=np.float32)
+    matrix @ matrix
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        with torch.no_grad():
+            tensor = torch.rand(1, 32, size // 4, size // 4)
+            torch.nn.functional.conv2d(tensor, torch.rand(32, 32, 3, 3), padding=1)
+
+
+def benchmark(slot_counts: List[int], jobs_per_slot: int = 8, size: int = 1024) -> List[Dict[str, Any]]:
+    """
+    Run the same synthetic CPU job (OpenCV filters, a BLAS matmul and a torch
+    conv when torch is installed) on 1..N concurrent slots, once with the
+    libraries' default thread counts and once with the budget applied.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    try:
+        import torch  # noqa: F401  (only to include it in the workload)
+    except ImportError:
+        pass
+
+    results = []
+    for slots in slot_counts:
+        for mode in ("default", "budgeted"):
+            budget = ThreadBudget.from_environment(slots, pin=CPU_PINNING)
+            if mode == "budgeted":
+                budget.configure_libraries()
+            else:
+                ThreadBudget(budget.cpu_ids, budget.cpus, 1, threads_per_slot=budget.cpus).configure_libraries()
+            initializer = budget.slot_initializer() if mode == "budgeted" else None
+            latencies: List[float] = []
+
+            def job() -> None:
+                started = time.perf_counter()
+                _benchmark_job(size)
+                latencies.append(time.perf_counter() - started)
+
+            _benchmark_job(size // 4)  # Warm up the pools
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=slots, initializer=initializer) as pool:
+                list(pool.map(lambda _: job(), range(slots * jobs_per_slot)))
+            elapsed = time.perf_counter() - started
+            latencies.sort()
+            results.append({
+                "slots": slots,
+                "mode": mode,
+                "threads_per_slot": budget.threads_per_slot if mode == "budgeted" else budget.cpus,
+                "jobs_per_second": round(len(latencies) / elapsed, 2),
+                "p50_seconds": round(latencies[len(latencies) // 2], 3),
+                "p95_seconds": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+            })
+            print(results[-1], flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark CPU throughput across job slot counts")
+    parser.add_argument("--slots", default="1,2,4", help="Comma-separated slot counts")
+    parser.add_argument("--jobs-per-slot", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024, help="Side of the synthetic image in pixels")
+    args = parser.parse_args()
+    benchmark([int(value) for value in args.slots.split(",")], args.jobs_per_slot, args.size)
@@ -0,0 +1,169 @@
+"""
+Service lifecycle module: graceful drain and callback outbox.
+Lets a consumer stop taking jobs, finish the ones in flight and deliver
+every pending status callback before its connections are closed.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Poll interval while waiting for in-flight jobs to finish
+DRAIN_POLL_SECONDS = 0.5
+
+
+class DrainCoordinator:
+    """
+    Tracks in-flight messages and the drain state of a consumer.
+
+    Once draining, new deliveries (e.g. messages already prefetched when the
+    consumer was cancelled) should be requeued instead of processed, and
+    `wait_idle` tells when the last in-flight job has finished. Everything
+    runs on the event loop, so no lock is needed.
+    """
+
+    def __init__(self):
+        self.draining = False
+        self._in_flight: Dict[str, float] = {}
+        self._drain_started_at: Optional[float] = None
+        self._drained_at: Optional[float] = None
+        self._requeued_count = 0
+        self._abandoned_count = 0
+        self.completed = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def start(self) -> bool:
+        """Enter drain mode; returns False if it was already draining."""
+        if self.draining:
+            return False
+        self.draining = True
+        self._drain_started_at = time.time()
+        logger.warning(f"Draining: no new jobs will be taken, {self.in_flight} in flight")
+        return True
+
+    @contextmanager
+    def track(self, message_id: str) -> Iterator[None]:
+        self._in_flight[message_id] = time.monotonic()
+        try:
+            yield
+        finally:
+            self._in_flight.pop(message_id, None)
+            self.completed += 1
+
+    def record_requeued(self) -> None:
+        self._requeued_count += 1
+
+    async def wait_idle(self, timeout_seconds: float) -> bool:
+        """Wait until no message is in flight; returns False if the grace period ran out first."""
+        deadline = time.monotonic() + timeout_seconds
+        while self._in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(DRAIN_POLL_SECONDS)
+        if self._in_flight:
+            self._abandoned_count = len(self._in_flight)
+            logger.warning(f"Drain grace period ({timeout_seconds:.0f}s) over with {self.in_flight} jobs in flight, they will be redelivered")
+            return False
+        self._drained_at = time.time()
+        logger.info("Drain complete: no jobs in flight")
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "completed_jobs": self.completed,
+            "in_flight_seconds": {message_id: round(now - started, 1) for message_id, started in self._in_flight.items()},
+            "drain_started_at": self._drain_started_at,
+            "drained_at": self._drained_at,
+            "requeued_on_drain": self._requeued_count,
+            "abandoned_on_drain": self._abandoned_count,
+            "timestamp": time.time(),
+        }
+
+
+class CallbackOutbox:
+    """
+    Status callbacks that could not be delivered, kept for retry.
+
+    Only the latest undelivered update per job is kept: a newer status makes
+    an older pending one obsolete, and a successful delivery for the job
+    clears it. Entries are dropped after `max_attempts` failed retries.
+    """
+
+    def __init__(self, max_size: int = 1000, max_attempts: int = 10):
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self._pending: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._delivered_count = 0
+        self._dropped_count = 0
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def put(self, job_id: str, status_update: Any) -> None:
+        self._pending[job_id] = (status_update, 0)
+        self._pending.move_to_end(job_id)
+        while len(self._pending) > self.max_size:
+            dropped_job_id, _ = self._pending.popitem(last=False)
+            self._dropped_count += 1
+            logger.error(f"Callback outbox full, dropping pending update for job {dropped_job_id}")
+
+    def discard(self, job_id: str) -> None:
+        self._pending.pop(job_id, None)
+
+    async def flush(
+        self,
+        send: Callable[[str, Any], Awaitable[bool]],
+        timeout_seconds: float,
+    ) -> int:
+        """
+        Retry pending callbacks in order until all are sent or time runs out.
+
+        Args:
+            send: Coroutine delivering one update, returning True on success
+            timeout_seconds: Time budget for this flush
+
+        Returns:
+            Number of callbacks still pending
+        """
+        deadline = time.monotonic() + timeout_seconds
+        for job_id, (status_update, attempts) in list(self._pending.items()):
+            if time.monotonic() >= deadline:
+                break
+            delivered = await send(job_id, status_update)
+            current = self._pending.get(job_id)
+            if current is None or current[0] is not status_update:
+                continue  # Superseded (or delivered) while we were sending
+            if delivered:
+                self._pending.pop(job_id)
+                self._delivered_count += 1
+            elif attempts + 1 >= self.max_attempts:
+                self._pending.pop(job_id)
+                self._dropped_count += 1
+                logger.error(f"Giving up on callback for job {job_id} after {attempts + 1} retries")
+            else:
+                self._pending[job_id] = (status_update, attempts + 1)
+
+        if self._pending:
+            logger.warning(f"{len(self._pending)} callbacks still pending after flush")
+        return len(self._pending)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "pending": {job_id: attempts for job_id, (_, attempts) in self._pending.items()},
+            "pending_count": len(self._pending),
+            "delivered_on_retry": self._delivered_count,
+            "dropped": self._dropped_count,
+            "max_size": self.max_size,
+            "max_attempts": self.max_attempts,
+            "timestamp": time.time(),
+        }
@@ -7,14 +7,12 @@ import logging
 import time
 import traceback
 from typing import Dict, Tuple, Any, Optional, Set
-import io
 import threading
 import os
 from PIL import Image, ImageFilter, ImageEnhance
 import torch
 import numpy as np
 from diffusers import (
-    StableDiffusionPipeline,
     StableDiffusionImg2ImgPipeline,
     DiffusionPipeline
 )
@@ -26,8 +24,17 @@ from diffusers.schedulers import (
 import gc
 
 from app.cloudinary_service import CloudinaryService
-from app.config import DEVICE, MODELS_DIR, AVAILABLE_STYLES
+from app.threads import thread_budget
+from app.config import DEVICE, MODELS_DIR, AVAILABLE_STYLES, MODEL_MEMORY_MB
 from app.dto import StyleTransferConfigDTO, StyleQuality
+from app.scheduling import ImageProbe
+from app.memory import read_available_memory
+from app.cancellation import cancellation_registry, diffusers_cancel_kwargs, JobCancelledError
+from app.decoding import read_header, decode_image
+from app.encoding import encode_image, select_preset
+from app.thumbnails import publish_result
+from app.inference import ModelHandler, RemotePipeline, get_inference_client
+from app.diffusion import IMG2IMG, get_diffusion_runtime, timed_handler
 
 logger = logging.getLogger(__name__)
 
@@ -72,46 +79,43 @@ def aggressive_cpu_memory_cleanup():
     for _ in range(3):
         gc.collect()
 
-def check_cpu_memory():
-    """Verificar memoria RAM disponible."""
-    try:
-        import psutil
-        memory = psutil.virtual_memory()
-        available_gb = memory.available / 1024**3
-        total_gb = memory.total / 1024**3
-        used_gb = memory.used / 1024**3
-        
-        logger.info(f"🖥️ RAM Memory - Total: {total_gb:.1f}GB, Used: {used_gb:.1f}GB, Available: {available_gb:.1f}GB")
-        return available_gb > 3.0  # Necesitamos al menos 3GB libres para CPU
-    except ImportError:
-        logger.warning("psutil not available, assuming sufficient memory")
+def check_cpu_memory(required_bytes: Optional[int] = None) -> bool:
+    """Verificar memoria RAM disponible (psutil o límite del cgroup) contra lo requerido."""
+    available = read_available_memory()["available"]
+    if available is None:
+        logger.warning("Available memory unknown, assuming sufficient memory")
         return True
 
-def load_ultra_lightweight_cpu_pipeline():
-    logger.info("🚀 Loading ultra-lightweight CPU pipeline...")
-    try:
-        pipeline = StableDiffusionPipeline.from_pretrained(
-            "runwayml/stable-diffusion-lite",
-            revision="fp16",
-            torch_dtype=torch.float16,
-            low_cpu_mem_usage=True,
-            cache_dir=MODELS_DIR,
-        )
-        pipeline.to("cpu")
-        return pipeline
-    except Exception as e:
-        logger.error(f"Failed to load ultra-lightweight CPU pipeline: {e}")
-        raise
+    required = required_bytes if required_bytes is not None else MODEL_MEMORY_MB * 1024**2
+    logger.info(f"🖥️ RAM Memory - Available: {available / 1024**3:.1f}GB, Required: {required / 1024**3:.1f}GB")
+    return available >= required
 
 def get_pipeline() -> StableDiffusionImg2ImgPipeline:
-    """Get or create the ultra-lightweight CPU pipeline."""
+    """Get or create the ultra-lightweight CPU pipeline (a sidecar stand-in when one is configured)."""
     global _pipeline_cache
     
+    inference_client = get_inference_client()
+    if inference_client is not None:
+        return RemotePipeline(inference_client, IMG2IMG)
+    
     with _pipeline_lock:
         if _pipeline_cache is None:
-            _pipeline_cache = load_ultra_lightweight_cpu_pipeline()
+            if not check_cpu_memory():
+                logger.warning("⚠️ Low memory before loading the pipeline, cleaning up first")
+                aggressive_cpu_memory_cleanup()
+            logger.info("🚀 Loading img2img pipeline from the shared diffusion runtime...")
+            _pipeline_cache = get_diffusion_runtime().img2img_pipeline()
         return _pipeline_cache
 
+def preload_models():
+    """Cargar el pipeline antes de que el supervisor haga fork de los workers (pesos compartidos copy-on-write)."""
+    get_pipeline()
+
+def inference_handlers() -> Dict[str, ModelHandler]:
+    """Models served by the inference sidecar (python -m app.inference)."""
+    get_pipeline()
+    return {IMG2IMG: timed_handler(IMG2IMG)}
+
 def create_simple_style_prompt(style: str, custom_prompt: Optional[str] = None) -> Tuple[str, str]:
     """Create ultra-simple prompts for CPU processing."""
     
@@ -147,6 +151,59 @@ def create_simple_style_prompt(style: str, custom_prompt: Optional[str] = None)
     
     return positive_prompt, negative_prompt
 
+# Degraded mode under load: cap the denoising steps
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"max_inference_steps": 4}
+
+# UNet/VAE activation memory at 256x256 and decoded input copies per pixel
+DIFFUSION_ACTIVATION_MB_256 = 600
+IMAGE_BYTES_PER_PIXEL = 8
+
+def get_inference_settings(quality: StyleQuality, max_steps: Optional[int] = None) -> Tuple[int, int]:
+    """Return (max_size, num_inference_steps) for a quality tier on CPU, optionally capping the steps."""
+    max_size, num_inference_steps = (256, 8) if quality == StyleQuality.PREMIUM else (128, 5)
+    if max_steps is not None:
+        num_inference_steps = max(1, min(num_inference_steps, int(max_steps)))
+    return max_size, num_inference_steps
+
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """
+    Estimate the cost of a style transfer job.
+    
+    The input is always downscaled before diffusion, so the cost depends on
+    the tier: denoising steps weighted by the processed area relative to 256px.
+    """
+    try:
+        quality = StyleQuality(str(config.get("quality", StyleQuality.FREE.value)).upper())
+    except ValueError:
+        quality = StyleQuality.FREE
+    
+    max_size, num_inference_steps = get_inference_settings(quality, config.get("max_inference_steps"))
+    return num_inference_steps * (max_size / 256) ** 2
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """
+    Estimate the peak memory of a style transfer job in bytes.
+    
+    The pipeline is cached, so its footprint only counts until the first job
+    loads it. Diffusion runs on the downscaled image; only decoding and
+    preprocessing scale with the input size. With the inference sidecar the
+    pipeline and its activations live in another process.
+    """
+    try:
+        quality = StyleQuality(str(config.get("quality", StyleQuality.FREE.value)).upper())
+    except ValueError:
+        quality = StyleQuality.FREE
+    
+    max_size, _ = get_inference_settings(quality, config.get("max_inference_steps"))
+    if get_inference_client() is not None:
+        estimated_mb = 0
+    else:
+        estimated_mb = DIFFUSION_ACTIVATION_MB_256 * (max_size / 256) ** 2
+        if _pipeline_cache is None:
+            estimated_mb += MODEL_MEMORY_MB
+    input_bytes = (probe.megapixels or 0) * 1_000_000 * IMAGE_BYTES_PER_PIXEL
+    return int(estimated_mb * 1024 * 1024 + input_bytes)
+
 def ultra_lightweight_preprocess(image: Image.Image, max_size: int = 256) -> Image.Image:
    
     
@@ -200,17 +257,20 @@ async def perform_style_transfer(
         except Exception as e:
             raise StyleTransferError(f"Invalid config: {e}")
         
+        cancellation_registry.check(job_id, "download")
+
         # Download image
         logger.info(f"⬇️ Downloading image...")
         input_bytes = CloudinaryService.download_image_from_url(image_url)
+        cancellation_registry.check(job_id, "preprocessing")
         
-        # Load and preprocess
-        source_image = Image.open(io.BytesIO(input_bytes))
-        original_size = source_image.size
+        # Load and preprocess: the pipeline works at max_size, so a JPEG decodes at a reduced scale
+        max_size, num_inference_steps = get_inference_settings(style_config.quality, config.get("max_inference_steps"))
+        header = read_header(input_bytes)
+        source_image = decode_image(input_bytes, max_side=max_size, header=header)
+        original_size = (header.width, header.height)
         logger.info(f"📐 Original: {original_size}")
         
-   
-        max_size = 256 if style_config.quality == StyleQuality.PREMIUM else 128
         processed_image = ultra_lightweight_preprocess(source_image, max_size)
         final_size = processed_image.size
         logger.info(f"📐 Processed: {final_size}")
@@ -227,7 +287,6 @@ async def perform_style_transfer(
         )
         
         # PARÁMETROS ULTRA CONSERVADORES PARA CPU
-        num_inference_steps = 8 if style_config.quality == StyleQuality.PREMIUM else 5
         guidance_scale = 4.0  # Más bajo para CPU
         strength = min(style_config.strength, 0.4)  # Muy conservador para CPU
         
@@ -240,22 +299,22 @@ async def perform_style_transfer(
         start_time = time.perf_counter()
         
         try:
-            # Configurar threads para CPU
-            torch.set_num_threads(max(1, os.cpu_count() // 2))
-            
             with torch.no_grad():
                 # No usar generator en CPU para simplicidad
                 
                 # Parámetros mínimos para CPU
-                result = pipe(
-                    prompt=positive_prompt,
-                    negative_prompt=negative_prompt,
-                    image=processed_image,
-                    strength=strength,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    # No usar generator para CPU
-                )
+                with get_diffusion_runtime().timed(IMG2IMG):
+                    result = pipe(
+                        prompt=positive_prompt,
+                        negative_prompt=negative_prompt,
+                        image=processed_image,
+                        strength=strength,
+                        num_inference_steps=num_inference_steps,
+                        guidance_scale=guidance_scale,
+                        # No usar generator para CPU
+                        # Aborta en el siguiente paso de difusión si se cancela el job
+                        **diffusers_cancel_kwargs(pipe, job_id)
+                    )
                 
                 styled_image = result.images[0]
                 
@@ -263,6 +322,9 @@ async def perform_style_transfer(
                 del result
                 aggressive_cpu_memory_cleanup()
                 
+        except JobCancelledError:
+            aggressive_cpu_memory_cleanup()
+            raise
         except Exception as e:
             logger.error(f"❌ CPU Inference failed: {e}")
             aggressive_cpu_memory_cleanup()
@@ -271,27 +333,17 @@ async def perform_style_transfer(
         processing_time = time.perf_counter() - start_time
         logger.info(f"⏱️ CPU processing completed in {processing_time:.2f}s")
         
-        # Guardar resultado
-        output_buffer = io.BytesIO()
-        styled_image.save(output_buffer, format="PNG", optimize=True, quality=75)
-        output_bytes = output_buffer.getvalue()
+        # Guardar resultado con el preset del tier
+        encoded = encode_image(styled_image, "PNG", select_preset(config))
+        output_bytes = encoded.data
         
-        # Thumbnail pequeño
-        thumbnail = styled_image.copy()
-        thumbnail.thumbnail((150, 100), Image.Resampling.NEAREST)
-        thumbnail_buffer = io.BytesIO()
-        thumbnail.save(thumbnail_buffer, format="PNG", optimize=True, quality=60)
-        thumbnail_bytes = thumbnail_buffer.getvalue()
+        cancellation_registry.check(job_id, "upload")
         
-        # Upload
+        # Upload, with the thumbnail downscaled from the styled image in memory (or derived by Cloudinary)
         logger.info("☁️ Uploading results...")
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            output_bytes, job_id, f"styled_{style_config.style.value.lower()}"
-        )
-        
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
-        )
+        published = publish_result(job_id, output_bytes, f"styled_{style_config.style.value.lower()}", styled_image)
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
         
         # Processing parameters
         processing_params = {
@@ -317,7 +369,9 @@ async def perform_style_transfer(
             "job_id": job_id,
             "timestamp": time.time(),
             "cpu_optimized": True,
-            "ultra_lightweight": True
+            "ultra_lightweight": True,
+            **encoded.to_params(),
+            **published.to_params()
         }
         
         logger.info(f"✅ CPU Job {job_id} completed successfully")
@@ -325,6 +379,10 @@ async def perform_style_transfer(
         
         return processed_url, processing_params
         
+    except JobCancelledError:
+        # Cancellation is not a failure; propagate it unwrapped so it isn't retried
+        raise
+        
     except Exception as e:
         logger.error(f"❌ Error in CPU job {job_id}: {e}")
         raise StyleTransferError(f"CPU Job {job_id} failed: {e}")
@@ -344,6 +402,7 @@ def clear_cache():
             logger.info("🧹 Clearing CPU pipeline cache")
             del _pipeline_cache
             _pipeline_cache = None
+            get_diffusion_runtime().release(IMG2IMG)
     
     aggressive_cpu_memory_cleanup()
 
@@ -401,9 +460,9 @@ def get_active_jobs_count() -> int:
 def setup_cpu_environment():
     """Configurar entorno para CPU."""
     
-    torch.set_num_threads(max(1, os.cpu_count() // 2))
+    # Threads de torch según el presupuesto por slot (app.threads), no por job
+    thread_budget.configure_libraries()
     
-   
     os.environ['CUDA_VISIBLE_DEVICES'] = ''
     
     logger.info(f"🖥️ CPU Environment configured - Threads: {torch.get_num_threads()}")
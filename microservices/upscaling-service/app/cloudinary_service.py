@@ -6,7 +6,7 @@ import logging
 import cloudinary.uploader
 import requests
 from io import BytesIO
-from typing import Tuple, Optional
+from typing import Any, Dict, Tuple, Optional
 
 logger = logging.getLogger(__name__)
 
@@ -60,13 +60,62 @@ class CloudinaryService:
             raise RuntimeError(f"Failed to upload processed image: {e}")
     
     @staticmethod
-    def upload_thumbnail(image_bytes: bytes, job_id: str) -> Tuple[str, str]:
+    def upload_with_thumbnail(
+        image_bytes: bytes,
+        job_id: str,
+        suffix: str,
+        thumbnail_transformation: Dict[str, Any]
+    ) -> Tuple[str, str, str]:
+        """
+        Upload processed image once and have Cloudinary derive its thumbnail
+        as an eager transformation during the same upload.
+        
+        Args:
+            image_bytes: The processed image as bytes
+            job_id: The job ID for naming
+            suffix: Suffix for the filename
+            thumbnail_transformation: Transformation producing the thumbnail
+            
+        Returns:
+            Tuple of (cloudinary_url, public_id, thumbnail_url)
+        """
+        try:
+            public_id = f"pixelperfect/processed/{job_id}_{suffix}"
+            
+            upload_result = cloudinary.uploader.upload(
+                image_bytes,
+                public_id=public_id,
+                overwrite=True,
+                resource_type="image",
+                tags=["processed", f"job_{job_id}", "upscaled"],
+                eager=[thumbnail_transformation]
+            )
+            
+            derived = upload_result.get("eager") or []
+            if not derived:
+                raise RuntimeError("Cloudinary returned no eager thumbnail")
+            
+            cloudinary_url = upload_result.get("secure_url")
+            actual_public_id = upload_result.get("public_id")
+            thumbnail_url = derived[0].get("secure_url")
+            
+            logger.info(f"Uploaded processed image with eager thumbnail to Cloudinary: {cloudinary_url}")
+            
+            return cloudinary_url, actual_public_id, thumbnail_url
+            
+        except Exception as e:
+            logger.error(f"Failed to upload processed image with thumbnail to Cloudinary: {e}")
+            raise RuntimeError(f"Failed to upload processed image: {e}")
+    
+    @staticmethod
+    def upload_thumbnail(image_bytes: bytes, job_id: str, resize: bool = True) -> Tuple[str, str]:
         """
         Upload thumbnail version to Cloudinary.
         
         Args:
             image_bytes: The thumbnail image as bytes
             job_id: The job ID for naming
+            resize: Whether Cloudinary resizes it on upload (not needed for thumbnails already sized and encoded)
             
         Returns:
             Tuple of (cloudinary_url, public_id)
@@ -74,6 +123,14 @@ class CloudinaryService:
         try:
             public_id = f"pixelperfect/thumbnails/{job_id}_upscaled_thumbnail"
             
+            options = {}
+            if resize:
+                # Apply transformations for thumbnail
+                options["transformation"] = [
+                    {"width": 800, "height": 600, "crop": "fit"},
+                    {"quality": "70"}
+                ]
+            
             # Upload thumbnail to Cloudinary
             upload_result = cloudinary.uploader.upload(
                 image_bytes,
@@ -81,11 +138,7 @@ class CloudinaryService:
                 overwrite=True,
                 resource_type="image",
                 tags=["thumbnail", "free", f"job_{job_id}", "upscaled"],
-                # Apply transformations for thumbnail
-                transformation=[
-                    {"width": 800, "height": 600, "crop": "fit"},
-                    {"quality": "70"}
-                ]
+                **options
             )
             
             cloudinary_url = upload_result.get("secure_url")
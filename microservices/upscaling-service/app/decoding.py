@@ -0,0 +1,132 @@
+"""
+Image decode module.
+Every job turns its downloaded bytes into pixels through here, once:
+- the header is checked against MAX_IMAGE_PIXELS before anything is
+  decoded, so a decompression bomb fails fast instead of exhausting memory;
+- consumers that only need a smaller image pass `max_side` and get a
+  reduced decode (JPEG draft mode in PIL, IMREAD_REDUCED_* in OpenCV),
+  which skips most of the IDCT work and memory;
+- EXIF orientation is applied, so pixels are upright whichever library
+  decoded them.
+"""
+
+import io
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+
+from app.config import MAX_IMAGE_PIXELS
+
+logger = logging.getLogger(__name__)
+
+# PIL's own bomb check, for the paths that open images directly (e.g. calibration corpora)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Reduced decode factors OpenCV supports, largest first
+REDUCED_COLOR_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+class ImageTooLargeError(ValueError):
+    """The image has more pixels than MAX_IMAGE_PIXELS."""
+
+
+class ImageDecodeError(ValueError):
+    """The bytes are not an image any decoder here understands."""
+
+
+@dataclass
+class ImageHeader:
+    format: Optional[str]
+    width: int
+    height: int
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+
+def read_header(data: bytes) -> ImageHeader:
+    """Format and stored size from the header only (PIL opens lazily), enforcing the pixel budget."""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            header = ImageHeader(image.format, *image.size)
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except Exception as e:
+        raise ImageDecodeError(f"Unrecognized image data: {e}")
+    if header.pixels > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(
+            f"Image is {header.width}x{header.height} ({header.pixels / 1e6:.1f} MP), "
+            f"above the {MAX_IMAGE_PIXELS / 1e6:.1f} MP limit"
+        )
+    return header
+
+
+def _reduction_factor(header: ImageHeader, max_side: Optional[int]) -> int:
+    """Largest supported factor that still leaves the longer side at least `max_side`."""
+    if not max_side:
+        return 1
+    longest = max(header.width, header.height)
+    for factor, _ in REDUCED_COLOR_FLAGS:
+        if longest // factor >= max_side:
+            return factor
+    return 1
+
+
+def decode_image(data: bytes, max_side: Optional[int] = None, header: Optional[ImageHeader] = None) -> Image.Image:
+    """
+    Decode to a PIL image, upright, keeping its mode (alpha included).
+
+    Args:
+        data: Encoded image bytes
+        max_side: If set, the caller will downscale to this longer side, so a
+            JPEG is decoded at the smallest draft scale that still covers it
+        header: The result of `read_header`, if the caller already needed it
+
+    Returns:
+        The decoded image; `format` keeps the source format
+    """
+    header = header or read_header(data)
+    image = Image.open(io.BytesIO(data))
+    if max_side and header.format == "JPEG":
+        # Draft picks the smallest 1/2, 1/4 or 1/8 scale at least as large as requested
+        image.draft(image.mode, (max_side, max_side))
+    image.load()
+    # In place: without it, exif_transpose copies even upright images
+    ImageOps.exif_transpose(image, in_place=True)
+    return image
+
+
+def decode_bgr(data: bytes, max_side: Optional[int] = None, header: Optional[ImageHeader] = None) -> np.ndarray:
+    """
+    Decode to an upright BGR uint8 array for OpenCV code.
+
+    Args:
+        data: Encoded image bytes
+        max_side: If set, decode at the largest 1/2, 1/4 or 1/8 reduction whose
+            longer side is still at least this long
+        header: The result of `read_header`, if the caller already needed it
+
+    Returns:
+        HxWx3 BGR array, owned by the caller
+    """
+    header = header or read_header(data)
+    flags = cv2.IMREAD_COLOR  # Applies EXIF orientation
+    factor = _reduction_factor(header, max_side)
+    if factor > 1:
+        flags = dict(REDUCED_COLOR_FLAGS)[factor]
+    # frombuffer wraps the downloaded bytes without copying them
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is None:
+        raise ImageDecodeError(f"OpenCV could not decode the {header.format or 'unknown'} image")
+    if factor > 1:
+        logger.info(f"Decoded {header.width}x{header.height} at 1/{factor} resolution")
+    return image
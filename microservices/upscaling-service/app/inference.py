@@ -0,0 +1,446 @@
+"""
+Local inference sidecar module.
+A per-host server process holds the loaded models and consumers call it over
+a Unix domain socket. Image tensors travel through `multiprocessing.shared_memory`
+buffers; only a small JSON header goes over the socket. Consumers then don't
+load any model themselves and can scale independently of model memory.
+
+Run the server with `python -m app.inference` and point consumers at it with
+INFERENCE_SOCKET_PATH.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.threads import thread_budget  # Before numpy: exports the thread env vars
+
+import numpy as np
+
+from app.config import (
+    INFERENCE_SOCKET_PATH,
+    INFERENCE_TIMEOUT_SECONDS,
+    INFERENCE_MAX_BATCH,
+    INFERENCE_BATCH_WINDOW_MS
+)
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4-byte big-endian length followed by a JSON header
+_LENGTH = struct.Struct(">I")
+
+# How often a waiting client checks for job cancellation
+CANCEL_POLL_SECONDS = 0.5
+
+Arrays = Dict[str, np.ndarray]
+
+# Set in the server process so its own model loading stays in-process
+_serving = False
+
+
+class InferenceError(Exception):
+    """Raised when the sidecar fails to run a request."""
+
+
+class InferenceUnavailable(InferenceError):
+    """Raised when the sidecar can't be reached."""
+
+
+class InferenceCancelled(InferenceError):
+    """Raised inside a handler once the requesting client went away."""
+
+
+@dataclass
+class ModelHandler:
+    """
+    A model served by the sidecar.
+
+    `run(arrays, params, cancelled)` handles one request and returns
+    `(arrays, info)`; long-running handlers should check the `cancelled`
+    event and raise InferenceCancelled. When `run_batch` is set, requests
+    for the model arriving within INFERENCE_BATCH_WINDOW_MS of each other
+    (up to `max_batch`) are passed to it together as a list of
+    `(arrays, params)` and it returns one `(arrays, info)` per request.
+    """
+    run: Callable[[Arrays, Dict[str, Any], threading.Event], Tuple[Arrays, Dict[str, Any]]]
+    run_batch: Optional[Callable[[List[Tuple[Arrays, Dict[str, Any]]]], List[Tuple[Arrays, Dict[str, Any]]]]] = None
+    max_batch: int = 1
+
+
+def _untrack(shm: shared_memory.SharedMemory) -> None:
+    # The segment's lifetime is managed by the protocol (the client unlinks
+    # it), not by this process's resource tracker
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def _export(arrays: Arrays) -> Tuple[Dict[str, Any], List[shared_memory.SharedMemory]]:
+    """Copy arrays into new shared memory segments; returns their descriptors and handles."""
+    descriptors: Dict[str, Any] = {}
+    segments: List[shared_memory.SharedMemory] = []
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+            segments.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            descriptors[name] = {"shm": shm.name, "shape": list(array.shape), "dtype": array.dtype.str}
+    except Exception:
+        _release(segments, unlink=True)
+        raise
+    return descriptors, segments
+
+
+def _import(descriptors: Dict[str, Any], owner: bool) -> Tuple[Arrays, List[shared_memory.SharedMemory]]:
+    """
+    Copy arrays out of shared memory segments created by the other side.
+
+    The `owner` side unlinks the segments afterwards; the other one only
+    closes them and must not leave them to its resource tracker.
+    """
+    arrays: Arrays = {}
+    segments: List[shared_memory.SharedMemory] = []
+    for name, descriptor in descriptors.items():
+        shm = shared_memory.SharedMemory(name=descriptor["shm"])
+        if not owner:
+            _untrack(shm)
+        segments.append(shm)
+        view = np.ndarray(tuple(descriptor["shape"]), dtype=np.dtype(descriptor["dtype"]), buffer=shm.buf)
+        arrays[name] = view.copy()
+        del view
+    return arrays, segments
+
+
+def _release(segments: List[shared_memory.SharedMemory], unlink: bool) -> None:
+    for shm in segments:
+        try:
+            shm.close()
+            if unlink:
+                shm.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+
+def _frame(header: Dict[str, Any]) -> bytes:
+    body = json.dumps(header).encode("utf-8")
+    return _LENGTH.pack(len(body)) + body
+
+
+class InferenceClient:
+    """
+    Blocking sidecar client, meant to be called from the processing threads.
+
+    Each call uses its own connection, so concurrent jobs don't need a lock.
+    While waiting, `cancel_check` is called every CANCEL_POLL_SECONDS; if it
+    raises, the connection is closed and the server aborts the request.
+    """
+
+    def __init__(self, socket_path: str, timeout_seconds: float):
+        self.socket_path = socket_path
+        self.timeout_seconds = timeout_seconds
+
+    def _recv_exact(self, sock: socket.socket, size: int, deadline: float, cancel_check: Optional[Callable[[], None]]) -> bytes:
+        chunks = []
+        while size:
+            try:
+                chunk = sock.recv(size)
+            except socket.timeout:
+                if cancel_check is not None:
+                    cancel_check()
+                if time.monotonic() > deadline:
+                    raise InferenceError(f"Inference timed out after {self.timeout_seconds:.0f}s")
+                continue
+            if not chunk:
+                raise InferenceUnavailable("Inference server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def call(
+        self,
+        model: str,
+        arrays: Arrays,
+        params: Optional[Dict[str, Any]] = None,
+        cancel_check: Optional[Callable[[], None]] = None,
+    ) -> Tuple[Arrays, Dict[str, Any]]:
+        """
+        Run `model` on the sidecar.
+
+        Returns:
+            Output arrays (owned by the caller) and the handler's info dict
+
+        Raises:
+            InferenceUnavailable: if the server can't be reached
+            InferenceError: if the server failed or timed out
+        """
+        descriptors, inputs = _export(arrays)
+        outputs: List[shared_memory.SharedMemory] = []
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(CANCEL_POLL_SECONDS)
+            try:
+                sock.connect(self.socket_path)
+            except OSError as e:
+                raise InferenceUnavailable(f"Inference server not reachable at {self.socket_path}: {e}")
+            sock.sendall(_frame({"model": model, "params": params or {}, "arrays": descriptors}))
+
+            deadline = time.monotonic() + self.timeout_seconds
+            (length,) = _LENGTH.unpack(self._recv_exact(sock, _LENGTH.size, deadline, cancel_check))
+            response = json.loads(self._recv_exact(sock, length, deadline, cancel_check))
+            if not response.get("ok"):
+                raise InferenceError(f"Inference for {model} failed: {response.get('error')}")
+            result, outputs = _import(response.get("arrays", {}), owner=True)
+            return result, response.get("info", {})
+        finally:
+            sock.close()
+            _release(outputs, unlink=True)
+            _release(inputs, unlink=True)
+
+
+class RemotePipeline:
+    """
+    Stand-in for a diffusers pipeline served by the sidecar.
+
+    PIL image arguments are sent as arrays, the other JSON-serializable ones
+    as params; the result has the `images` list of a pipeline output.
+    """
+
+    remote = True
+
+    def __init__(self, client: InferenceClient, model: str):
+        self.client = client
+        self.model = model
+
+    def __call__(self, cancel_check: Optional[Callable[[], None]] = None, **kwargs):
+        from PIL import Image
+
+        arrays = {key: np.asarray(value) for key, value in kwargs.items() if isinstance(value, Image.Image)}
+        params = {key: value for key, value in kwargs.items() if key not in arrays and not callable(value)}
+        outputs, _ = self.client.call(self.model, arrays, params, cancel_check)
+        return SimpleNamespace(images=[Image.fromarray(outputs["image"])])
+
+
+def pipeline_handler(pipeline: Any) -> ModelHandler:
+    """Serve a diffusers pipeline to RemotePipeline clients, aborting at the next step on cancel."""
+    import inspect
+    from PIL import Image
+
+    supports_step_end = "callback_on_step_end" in inspect.signature(pipeline.__call__).parameters
+
+    def run(arrays: Arrays, params: Dict[str, Any], cancelled: threading.Event) -> Tuple[Arrays, Dict[str, Any]]:
+        kwargs = dict(params)
+        kwargs.update({key: Image.fromarray(value) for key, value in arrays.items()})
+
+        def check(step):
+            if cancelled.is_set():
+                raise InferenceCancelled(f"Client went away at denoising step {step}")
+
+        if supports_step_end:
+            def on_step_end(pipe, step, timestep, callback_kwargs):
+                check(step)
+                return callback_kwargs
+            kwargs["callback_on_step_end"] = on_step_end
+        else:
+            kwargs["callback"] = lambda step, timestep, latents: check(step)
+            kwargs["callback_steps"] = 1
+
+        result = pipeline(**kwargs)
+        return {"image": np.asarray(result.images[0])}, {}
+
+    return ModelHandler(run)
+
+
+def get_inference_client() -> Optional[InferenceClient]:
+    """The sidecar client when INFERENCE_SOCKET_PATH is set, or None to run models in-process."""
+    if not INFERENCE_SOCKET_PATH or _serving:
+        return None
+    return InferenceClient(INFERENCE_SOCKET_PATH, INFERENCE_TIMEOUT_SECONDS)
+
+
+@dataclass
+class _Request:
+    arrays: Arrays
+    params: Dict[str, Any]
+    cancelled: threading.Event
+    future: asyncio.Future
+
+
+class InferenceServer:
+    """
+    Asyncio Unix socket server running requests against the loaded models.
+
+    Each model has its own queue and runs one call (or one batch) at a time
+    in a worker thread, so handlers don't need to be thread-safe while
+    different models still run in parallel.
+    """
+
+    def __init__(self, socket_path: str, handlers: Dict[str, ModelHandler], batch_window_ms: float = 10.0):
+        self.socket_path = socket_path
+        self.handlers = handlers
+        self.batch_window_seconds = batch_window_ms / 1000
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    async def _run_model(self, model: str) -> None:
+        handler = self.handlers[model]
+        queue = self._queues[model]
+        loop = asyncio.get_running_loop()
+        stats = self._stats[model]
+        while True:
+            batch = [await queue.get()]
+            if handler.run_batch is not None and handler.max_batch > 1:
+                deadline = loop.time() + self.batch_window_seconds
+                while len(batch) < handler.max_batch:
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), max(0.0, deadline - loop.time())))
+                    except asyncio.TimeoutError:
+                        break
+            batch = [request for request in batch if not request.cancelled.is_set()]
+            if not batch:
+                continue
+
+            started = time.perf_counter()
+            try:
+                if handler.run_batch is not None and len(batch) > 1:
+                    results = await loop.run_in_executor(
+                        None, handler.run_batch, [(request.arrays, request.params) for request in batch]
+                    )
+                else:
+                    request = batch[0]
+                    results = [await loop.run_in_executor(None, handler.run, request.arrays, request.params, request.cancelled)]
+                for request, result in zip(batch, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            stats["requests"] += len(batch)
+            stats["batches"] += 1
+            stats["seconds"] += time.perf_counter() - started
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        outputs: List[shared_memory.SharedMemory] = []
+        delivered = False
+        try:
+            (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+            header = json.loads(await reader.readexactly(length))
+            model = header.get("model")
+            if model not in self.handlers:
+                writer.write(_frame({"ok": False, "error": f"Unknown model {model!r}"}))
+                await writer.drain()
+                return
+
+            arrays, inputs = _import(header.get("arrays", {}), owner=False)
+            _release(inputs, unlink=False)
+            request = _Request(arrays, header.get("params", {}), threading.Event(), asyncio.get_running_loop().create_future())
+            await self._queues[model].put(request)
+
+            # A client that closes its end (cancelled job, timeout) aborts the request
+            disconnected = asyncio.ensure_future(reader.read(1))
+            done, _ = await asyncio.wait({request.future, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if request.future not in done:
+                request.cancelled.set()
+                logger.info(f"Client cancelled its {model} request")
+                try:
+                    await request.future
+                except Exception:
+                    pass
+                return
+            disconnected.cancel()
+
+            try:
+                result_arrays, info = request.future.result()
+            except Exception as e:
+                logger.error(f"Inference for {model} failed: {e}")
+                writer.write(_frame({"ok": False, "error": str(e)}))
+                await writer.drain()
+                return
+
+            descriptors, outputs = _export(result_arrays)
+            writer.write(_frame({"ok": True, "arrays": descriptors, "info": info}))
+            await writer.drain()
+            # The client unlinks the outputs once it has copied them
+            for shm in outputs:
+                _untrack(shm)
+            delivered = True
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Inference request failed: {e}")
+        finally:
+            # Outputs belong to the client once delivered
+            _release(outputs, unlink=not delivered)
+            writer.close()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "queued": self._queues[model].qsize(),
+                "requests": int(stats["requests"]),
+                "batches": int(stats["batches"]),
+                "busy_seconds": round(stats["seconds"], 1),
+            }
+            for model, stats in self._stats.items()
+        }
+
+    async def serve(self, stop: asyncio.Event) -> None:
+        for model in self.handlers:
+            self._queues[model] = asyncio.Queue()
+            self._stats[model] = {"requests": 0, "batches": 0, "seconds": 0.0}
+        runners = [asyncio.create_task(self._run_model(model)) for model in self.handlers]
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle_connection, path=self.socket_path)
+        logger.info(f"Inference server listening on {self.socket_path} with models: {', '.join(self.handlers)}")
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            for runner in runners:
+                runner.cancel()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            logger.info(f"Inference server stopped: {self.snapshot()}")
+
+
+def main() -> None:
+    global _serving
+    if not INFERENCE_SOCKET_PATH:
+        raise SystemExit("INFERENCE_SOCKET_PATH is not set")
+    _serving = True
+
+    # Imported here so the config/logging setup of the service runs first
+    from app.processing import inference_handlers
+
+    handlers = inference_handlers()
+    for handler in handlers.values():
+        handler.max_batch = min(handler.max_batch, INFERENCE_MAX_BATCH) if handler.run_batch else 1
+    thread_budget.configure_libraries()
+
+    async def run() -> None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await InferenceServer(INFERENCE_SOCKET_PATH, handlers, INFERENCE_BATCH_WINDOW_MS).serve(stop)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
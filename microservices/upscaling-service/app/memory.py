@@ -0,0 +1,323 @@
+"""
+Memory admission module.
+Reads available memory from psutil and the container's cgroup limits and
+holds jobs back until their estimated peak memory fits, so two large jobs
+arriving together can't OOM the container.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc and cgroup files are the fallback
+    psutil = None
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# cgroup v2 reports "max" and v1 a huge number when no limit is set
+CGROUP_V1_UNLIMITED = 1 << 60
+
+ADMITTED = "admitted"
+DELAYED = "delayed"
+REROUTED = "rerouted"
+FORCED = "forced"
+REQUEUED = "requeued"
+
+
+def _read_int_file(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if not value or value == "max":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _read_key_values(path: str) -> Dict[str, int]:
+    values: Dict[str, int] = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.replace(":", " ").split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    values[parts[0]] = int(parts[1])
+    except OSError:
+        pass
+    return values
+
+
+def read_cgroup_memory() -> Optional[Dict[str, int]]:
+    """
+    Memory limit and usage of the container's cgroup (v2, then v1).
+
+    Reclaimable page cache (inactive_file) is not counted as used, matching
+    what the kernel would free before invoking the OOM killer.
+
+    Returns:
+        {"limit": bytes, "usage": bytes}, or None without a memory limit
+    """
+    candidates = (
+        ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory.stat", "inactive_file"),
+        (
+            "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+            "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+            "/sys/fs/cgroup/memory/memory.stat",
+            "total_inactive_file",
+        ),
+    )
+    for limit_path, usage_path, stat_path, inactive_key in candidates:
+        limit = _read_int_file(limit_path)
+        usage = _read_int_file(usage_path)
+        if limit is None or usage is None or limit >= CGROUP_V1_UNLIMITED:
+            continue
+        inactive = _read_key_values(stat_path).get(inactive_key, 0)
+        return {"limit": limit, "usage": max(0, usage - inactive)}
+    return None
+
+
+def read_host_available_memory() -> Optional[int]:
+    """MemAvailable of the host/VM in bytes."""
+    if psutil is not None:
+        return int(psutil.virtual_memory().available)
+    meminfo = _read_key_values("/proc/meminfo")
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"] * 1024  # /proc/meminfo is in kB
+    return None
+
+
+def read_process_rss() -> Optional[int]:
+    """Resident set size of this process in bytes."""
+    if psutil is not None:
+        return int(psutil.Process().memory_info().rss)
+    status = _read_key_values("/proc/self/status")
+    if "VmRSS" in status:
+        return status["VmRSS"] * 1024
+    return None
+
+
+def read_process_memory(pid: int) -> Dict[str, Optional[int]]:
+    """
+    RSS, PSS and private memory of a process in bytes.
+
+    PSS splits shared pages between the processes mapping them, so summing
+    it over forked workers counts copy-on-write model weights only once.
+    """
+    rollup = _read_key_values(f"/proc/{pid}/smaps_rollup")  # values in kB
+    if "Rss" in rollup:
+        private = rollup.get("Private_Clean", 0) + rollup.get("Private_Dirty", 0)
+        return {"rss": rollup["Rss"] * 1024, "pss": rollup.get("Pss", 0) * 1024, "private": private * 1024}
+    status = _read_key_values(f"/proc/{pid}/status")
+    rss = status["VmRSS"] * 1024 if "VmRSS" in status else None
+    return {"rss": rss, "pss": None, "private": rss}
+
+
+def read_available_memory() -> Dict[str, Optional[int]]:
+    """
+    Memory that new work can use right now: the smaller of host available
+    memory and what is left under the cgroup limit.
+    """
+    host_available = read_host_available_memory()
+    cgroup = read_cgroup_memory()
+    cgroup_available = max(0, cgroup["limit"] - cgroup["usage"]) if cgroup else None
+
+    candidates = [value for value in (host_available, cgroup_available) if value is not None]
+    return {
+        "available": min(candidates) if candidates else None,
+        "host_available": host_available,
+        "cgroup_limit": cgroup["limit"] if cgroup else None,
+        "cgroup_available": cgroup_available,
+        "process_rss": read_process_rss(),
+    }
+
+
+class MemoryAdmissionRejected(Exception):
+    """Raised when a job's memory never fitted; the consumer requeues it for another instance."""
+
+    def __init__(self, job_id: str, estimated_bytes: int, available_bytes: Optional[int]):
+        self.job_id = job_id
+        self.estimated_bytes = estimated_bytes
+        self.available_bytes = available_bytes
+        available = f"{available_bytes / MB:.0f}MB" if available_bytes is not None else "unknown"
+        super().__init__(f"Job {job_id} needs ~{estimated_bytes / MB:.0f}MB, only {available} available")
+
+
+@dataclass
+class MemoryAdmission:
+    """Outcome of a memory admission request."""
+    decision: str
+    estimated_bytes: Optional[int]
+    reserved_bytes: int = 0
+    waited_seconds: float = 0.0
+    available_bytes: Optional[int] = None
+
+    @property
+    def rerouted(self) -> bool:
+        return self.decision == REROUTED
+
+    def to_params(self) -> Dict[str, Any]:
+        """processingParams entries describing the admission."""
+        return {
+            "memoryAdmission": self.decision,
+            "estimatedPeakMemoryMb": round(self.estimated_bytes / MB) if self.estimated_bytes is not None else None,
+            "memoryAdmissionWaitSeconds": round(self.waited_seconds, 2),
+        }
+
+
+class MemoryAdmissionController:
+    """
+    Reserves estimated peak memory for running jobs.
+
+    A job is admitted when its estimate fits in the available memory minus
+    `headroom_bytes` and minus the part of other jobs' reservations that
+    hasn't shown up in RSS yet (RSS growth over the idle baseline is taken
+    as memory those jobs already use). Otherwise it waits up to
+    `max_wait_seconds`; after that it runs with a cheaper `alternative`
+    estimate if one fits, runs anyway if nothing else is in flight, or is
+    rejected so the consumer can requeue it for another instance.
+    """
+
+    def __init__(self, headroom_bytes: int, max_wait_seconds: float, poll_interval_seconds: float = 1.0, enabled: bool = True):
+        self.headroom_bytes = headroom_bytes
+        self.max_wait_seconds = max_wait_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.enabled = enabled
+        self._reservations: Dict[str, int] = {}
+        self._idle_rss: Optional[int] = read_process_rss()
+        self._decisions: Dict[str, int] = {}
+        self._waiting = 0
+        self._total_wait_seconds = 0.0
+        self._peak_reserved = 0
+        self._last_status: Dict[str, Optional[int]] = {}
+        self._lock = threading.Lock()
+
+    def _outstanding_reserved(self, process_rss: Optional[int]) -> int:
+        reserved = sum(self._reservations.values())
+        if process_rss is None or self._idle_rss is None:
+            return reserved
+        return max(0, reserved - max(0, process_rss - self._idle_rss))
+
+    def _try_reserve(self, job_id: str, estimated_bytes: int, force: bool = False) -> bool:
+        """Reserve the estimate if it fits now (or, with `force`, if nothing else is in flight)."""
+        status = read_available_memory()
+        with self._lock:
+            self._last_status = status
+            available = status["available"]
+            in_flight = bool(self._reservations)
+            if available is not None:
+                free = available - self.headroom_bytes - self._outstanding_reserved(status["process_rss"])
+                fits = estimated_bytes <= free
+            else:
+                fits = True  # Nothing to measure against, don't block the job
+            if not (fits or (force and not in_flight)):
+                return False
+            if not in_flight and status["process_rss"] is not None:
+                self._idle_rss = status["process_rss"]
+            self._reservations[job_id] = estimated_bytes
+            self._peak_reserved = max(self._peak_reserved, sum(self._reservations.values()))
+            return True
+
+    def _admission(self, decision: str, estimated_bytes: Optional[int], reserved_bytes: int, waited_seconds: float) -> MemoryAdmission:
+        admission = MemoryAdmission(decision, estimated_bytes, reserved_bytes, waited_seconds, self._last_status.get("available"))
+        with self._lock:
+            self._decisions[decision] = self._decisions.get(decision, 0) + 1
+            self._total_wait_seconds += waited_seconds
+
+        estimate = f"{estimated_bytes / MB:.0f}MB" if estimated_bytes is not None else "unknown"
+        log = logger.info if decision == ADMITTED else logger.warning
+        log(
+            f"Memory admission {decision}: estimated peak {estimate}, "
+            f"reserved {reserved_bytes / MB:.0f}MB after {waited_seconds:.1f}s"
+        )
+        return admission
+
+    async def acquire(
+        self,
+        job_id: str,
+        estimated_bytes: Optional[int],
+        alternative_bytes: Optional[int] = None,
+    ) -> MemoryAdmission:
+        """
+        Wait until the job's estimated peak memory fits and reserve it.
+
+        Always pair with `release(job_id)` once the job finishes.
+
+        Raises:
+            MemoryAdmissionRejected: if it never fitted while other jobs held memory
+        """
+        if not self.enabled or estimated_bytes is None:
+            return self._admission(ADMITTED, estimated_bytes, 0, 0.0)
+
+        started = time.monotonic()
+        with self._lock:
+            self._waiting += 1
+        try:
+            while True:
+                waited = time.monotonic() - started
+                if self._try_reserve(job_id, estimated_bytes):
+                    decision = ADMITTED if waited < self.poll_interval_seconds else DELAYED
+                    return self._admission(decision, estimated_bytes, estimated_bytes, waited)
+                if waited >= self.max_wait_seconds or not self.in_flight_jobs:
+                    break
+                await asyncio.sleep(self.poll_interval_seconds)
+
+            if alternative_bytes is not None and alternative_bytes < estimated_bytes:
+                if self._try_reserve(job_id, alternative_bytes):
+                    return self._admission(REROUTED, estimated_bytes, alternative_bytes, waited)
+
+            # With nothing else in flight, waiting longer won't free any memory
+            fallback_bytes = min(estimated_bytes, alternative_bytes or estimated_bytes)
+            if self._try_reserve(job_id, fallback_bytes, force=True):
+                return self._admission(FORCED, estimated_bytes, fallback_bytes, waited)
+
+            self._admission(REQUEUED, estimated_bytes, 0, waited)
+            raise MemoryAdmissionRejected(job_id, estimated_bytes, self._last_status.get("available"))
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    @property
+    def in_flight_jobs(self) -> int:
+        with self._lock:
+            return len(self._reservations)
+
+    def release(self, job_id: str) -> None:
+        with self._lock:
+            self._reservations.pop(job_id, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Live memory readings, reservations and admission counters."""
+        status = read_available_memory()
+        with self._lock:
+            self._last_status = status
+            return {
+                "enabled": self.enabled,
+                "psutil_available": psutil is not None,
+                "available_mb": round(status["available"] / MB) if status["available"] is not None else None,
+                "host_available_mb": round(status["host_available"] / MB) if status["host_available"] is not None else None,
+                "cgroup_limit_mb": round(status["cgroup_limit"] / MB) if status["cgroup_limit"] is not None else None,
+                "cgroup_available_mb": round(status["cgroup_available"] / MB) if status["cgroup_available"] is not None else None,
+                "process_rss_mb": round(status["process_rss"] / MB) if status["process_rss"] is not None else None,
+                "idle_rss_mb": round(self._idle_rss / MB) if self._idle_rss is not None else None,
+                "headroom_mb": round(self.headroom_bytes / MB),
+                "reservations_mb": {job_id: round(size / MB) for job_id, size in self._reservations.items()},
+                "reserved_mb": round(sum(self._reservations.values()) / MB),
+                "outstanding_reserved_mb": round(self._outstanding_reserved(status["process_rss"]) / MB),
+                "peak_reserved_mb": round(self._peak_reserved / MB),
+                "waiting_jobs": self._waiting,
+                "decisions": dict(self._decisions),
+                "total_wait_seconds": round(self._total_wait_seconds, 1),
+                "max_wait_seconds": self.max_wait_seconds,
+                "timestamp": time.time(),
+            }
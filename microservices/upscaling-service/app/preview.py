@@ -0,0 +1,186 @@
+"""
+Preview delivery module.
+Slow jobs publish a cheap preview of their result (a bicubic upscale, an
+OpenCV TELEA inpaint...) as soon as they can, through an intermediate
+PROCESSING status update carrying its URL; the final result follows with the
+COMPLETED update. The backend has no preview status, so the preview travels
+in processingParams (phase "preview", previewUrl).
+
+Previews are encoded and uploaded off the job thread, so they never delay
+the final result, and a failed preview never fails the job. Once the final
+status is out the preview is deleted from Cloudinary: it is only shown until
+then, and nothing else would ever remove it.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from app.cloudinary_service import CloudinaryService
+from app.dto import JobStatus, JobStatusUpdateRequestDTO
+
+logger = logging.getLogger(__name__)
+
+# Upload threads shared by every job, so a slow upload never holds up a lane thread
+PREVIEW_UPLOAD_WORKERS = 2
+
+SendUpdate = Callable[[str, JobStatusUpdateRequestDTO], Awaitable[bool]]
+
+
+class JobPreview:
+    """
+    The preview phase of one job.
+
+    Created on the event loop when the job starts, so the preview and final
+    timings count from there; the processing code calls `publish` from the
+    lane thread once it has a preview image.
+    """
+
+    def __init__(self, publisher: "PreviewPublisher", job_id: str, send_update: SendUpdate):
+        self.publisher = publisher
+        self.job_id = job_id
+        self.send_update = send_update
+        self.loop = asyncio.get_running_loop()
+        self.started_at = time.perf_counter()
+        self.method: Optional[str] = None
+        self.ready_seconds: Optional[float] = None
+        self.delivered_seconds: Optional[float] = None
+        self.future: Optional[Future] = None
+        self.public_id: Optional[str] = None
+        self.abandoned = False
+
+    @property
+    def wanted(self) -> bool:
+        """True until a preview has been handed over; only the first one is sent."""
+        return self.future is None
+
+    def fit(self, width: int, height: int) -> Tuple[int, int]:
+        """Size of a preview for a `width`x`height` result, within the preview's max side."""
+        scale = min(1.0, self.publisher.max_side / max(width, height, 1))
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def publish(self, image: np.ndarray, method: str) -> None:
+        """Hand over a BGR preview image; it is uploaded and announced in the background."""
+        if not self.wanted:
+            return
+        self.method = method
+        self.ready_seconds = time.perf_counter() - self.started_at
+        self.future = self.publisher.submit(self._deliver, image)
+
+    def _deliver(self, image: np.ndarray) -> None:
+        try:
+            height, width = image.shape[:2]
+            if max(height, width) > self.publisher.max_side:
+                image = cv2.resize(image, self.fit(width, height), interpolation=cv2.INTER_AREA)
+            is_success, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.publisher.jpeg_quality])
+            if not is_success:
+                raise RuntimeError("Failed to encode preview")
+            preview_url, preview_public_id = CloudinaryService.upload_processed_image(
+                buffer.tobytes(), self.job_id, "preview"
+            )
+            self.public_id = preview_public_id
+            self.delivered_seconds = time.perf_counter() - self.started_at
+            update = JobStatusUpdateRequestDTO(
+                status=JobStatus.PROCESSING,
+                processingParams={
+                    "phase": "preview",
+                    "previewUrl": preview_url,
+                    "previewPublicId": preview_public_id,
+                    "previewMethod": self.method,
+                    "previewSeconds": round(self.delivered_seconds, 3),
+                }
+            )
+            if self.abandoned:
+                raise RuntimeError("final result already sent")
+            asyncio.run_coroutine_threadsafe(self.send_update(self.job_id, update), self.loop).result()
+            self.publisher.record(True)
+            logger.info(f"🖼️ Preview for job {self.job_id} delivered in {self.delivered_seconds:.2f}s ({self.method})")
+        except Exception as e:
+            self.publisher.record(False)
+            logger.warning(f"⚠️ Preview for job {self.job_id} failed: {e}")
+
+    def delete(self) -> None:
+        """Remove the uploaded preview, if there is one."""
+        if self.public_id is not None:
+            CloudinaryService.delete_image(self.public_id)
+            self.public_id = None
+
+    def to_params(self) -> Dict[str, Any]:
+        """Timing of both phases for the final status update."""
+        return {
+            "previewMethod": self.method,
+            "previewReadySeconds": round(self.ready_seconds, 3) if self.ready_seconds is not None else None,
+            "previewSeconds": round(self.delivered_seconds, 3) if self.delivered_seconds is not None else None,
+            "finalSeconds": round(time.perf_counter() - self.started_at, 3),
+        }
+
+
+class PreviewPublisher:
+    """Starts the preview phase of slow jobs and uploads their previews on a small pool."""
+
+    def __init__(self, enabled: bool, min_cost: float, max_side: int, jpeg_quality: int, settle_timeout: float = 15.0):
+        self.enabled = enabled
+        self.min_cost = min_cost
+        self.max_side = max_side
+        self.jpeg_quality = jpeg_quality
+        self.settle_timeout = settle_timeout
+        self._executor = ThreadPoolExecutor(max_workers=PREVIEW_UPLOAD_WORKERS, thread_name_prefix="preview-upload")
+        self._lock = threading.Lock()
+        self.started = 0
+        self.delivered = 0
+        self.failed = 0
+
+    def start(self, job_id: str, estimated_cost: Optional[float], send_update: SendUpdate) -> Optional[JobPreview]:
+        """The job's preview phase, or None for jobs cheap enough to skip it (unknown cost counts as slow)."""
+        if not self.enabled or (estimated_cost is not None and estimated_cost < self.min_cost):
+            return None
+        with self._lock:
+            self.started += 1
+        return JobPreview(self, job_id, send_update)
+
+    def submit(self, fn: Callable[..., None], *args) -> Future:
+        return self._executor.submit(fn, *args)
+
+    def record(self, delivered: bool) -> None:
+        with self._lock:
+            if delivered:
+                self.delivered += 1
+            else:
+                self.failed += 1
+
+    async def settle(self, preview: Optional[JobPreview]) -> None:
+        """Wait for the job's preview update to go out, so it can't land after the final one."""
+        if preview is None or preview.future is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(preview.future), self.settle_timeout)
+        except Exception as e:
+            # Too late to be useful: drop it rather than announce it after the final result
+            preview.abandoned = True
+            logger.warning(f"⚠️ Preview for job {preview.job_id} still pending, dropping it: {e!r}")
+
+    def discard(self, preview: Optional[JobPreview]) -> None:
+        """Delete the job's preview once its upload is done; call after the final status update."""
+        if preview is None or preview.future is None:
+            return
+        preview.future.add_done_callback(lambda _: self.submit(preview.delete))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "min_cost": self.min_cost,
+                "max_side": self.max_side,
+                "started": self.started,
+                "delivered": self.delivered,
+                "failed": self.failed,
+            }
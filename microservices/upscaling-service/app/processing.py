@@ -4,19 +4,112 @@ Image processing module for upscaling with Real-ESRGAN integration.
 
 import logging
 import os
+import threading
+from contextlib import nullcontext
 import cv2
 import numpy as np
-from typing import Dict, Tuple, Any
+from typing import Dict, Tuple, Any, Optional
 import urllib.request
 from pathlib import Path
+from PIL import Image
 from realesrgan import RealESRGANer
 from basicsr.archs.rrdbnet_arch import RRDBNet
 import torch
 from app.cloudinary_service import CloudinaryService
-from app.config import MODELS_DIR
+from app.config import MODELS_DIR, MODEL_MEMORY_MB, QUANTIZED_MODELS_DIR
+from app.scheduling import ImageProbe
+from app.cancellation import cancellation_registry, JobCancelledError
+from app.inference import ModelHandler, get_inference_client
+from app.quantization import QuantizationSpec, ModelVariant, model_registry, model_version, create_session
+from app.preview import JobPreview
+from app.chaining import ChainStepFn
+from app.decoding import decode_bgr
+from app.encoding import encode_bgr, select_preset
+from app.thumbnails import publish_result
 
 logger = logging.getLogger(__name__)
 
+# Degraded mode under load: use the x2 model for every tier
+DEGRADED_MODE_OVERRIDES: Dict[str, Any] = {"max_scale": 2}
+
+# Untiled RRDBNet working memory: float32 features per input pixel in the trunk
+# and per output pixel in the upsampling layers
+TRUNK_BYTES_PER_PIXEL = 1536
+UPSAMPLE_BYTES_PER_PIXEL = 768
+
+# Processor loaded once by the supervisor before forking; workers share its
+# weights copy-on-write instead of loading both models per job
+_shared_processor: Optional["UpscalingProcessor"] = None
+_shared_processor_lock = threading.Lock()
+
+# Output scale of the model behind each quality level
+MODEL_SCALES: Dict[str, int] = {"free": 2, "premium": 4}
+
+# INT8 variant sessions, one per model file
+_quantized_upsamplers: Dict[str, "QuantizedUpsampler"] = {}
+_quantized_upsamplers_lock = threading.Lock()
+
+
+def _model_name(model_key: str) -> str:
+    """Model name on the inference sidecar and in the quantized model registry."""
+    return f"realesrgan-{model_key}"
+
+
+class RemoteUpsampler:
+    """Stand-in for a RealESRGANer served by the inference sidecar."""
+
+    def __init__(self, client, model_key: str, variant: Optional[ModelVariant] = None):
+        self.client = client
+        self.model = model_version(_model_name(model_key), variant)
+
+    def enhance(self, image: np.ndarray, outscale=None):
+        outputs, info = self.client.call(self.model, {"image": image}, {"outscale": outscale})
+        return outputs["image"], info.get("img_mode")
+
+
+def _upsampler_handler(upsampler) -> ModelHandler:
+    def run(arrays, params, cancelled):
+        output, img_mode = upsampler.enhance(arrays["image"], outscale=params.get("outscale"))
+        return {"image": output}, {"img_mode": img_mode}
+    return ModelHandler(run)
+
+
+def _to_model_input(image: np.ndarray, scale: int) -> np.ndarray:
+    """BGR uint8 image to the RRDBNet input RealESRGANer builds: RGB, [0, 1], NCHW."""
+    image = image.astype(np.float32) / 255.0
+    height, width = image.shape[:2]
+    # The x2 RRDBNet pixel-unshuffles its input, so both sides must be even
+    if scale == 2 and (height % 2 or width % 2):
+        image = np.pad(image, ((0, height % 2), (0, width % 2), (0, 0)), mode="reflect")
+    return np.ascontiguousarray(image[:, :, ::-1].transpose(2, 0, 1)[np.newaxis])
+
+
+def _from_model_output(output: np.ndarray, height: int, width: int, scale: int) -> np.ndarray:
+    output = np.clip(output[0, :, :height * scale, :width * scale], 0.0, 1.0)
+    return (output.transpose(1, 2, 0)[:, :, ::-1] * 255.0).round().astype(np.uint8)
+
+
+class QuantizedUpsampler:
+    """RealESRGANer-compatible `enhance` running an INT8 RRDBNet variant on ONNX Runtime."""
+
+    def __init__(self, variant: ModelVariant, scale: int):
+        self.session = create_session(variant.path)
+        self.input_name = self.session.get_inputs()[0].name
+        self.scale = scale
+
+    def enhance(self, image: np.ndarray, outscale=None):
+        height, width = image.shape[:2]
+        output = self.session.run(None, {self.input_name: _to_model_input(image, self.scale)})[0]
+        return _from_model_output(output, height, width, self.scale), "RGB"
+
+
+def get_quantized_upsampler(variant: ModelVariant, scale: int) -> QuantizedUpsampler:
+    # ONNX Runtime sessions are safe to run concurrently, so unlike RealESRGANer these are shared without a lock
+    with _quantized_upsamplers_lock:
+        if variant.path not in _quantized_upsamplers:
+            logger.info(f"Loading quantized model {model_version(variant.model, variant)}")
+            _quantized_upsamplers[variant.path] = QuantizedUpsampler(variant, scale)
+        return _quantized_upsamplers[variant.path]
 
 
 #Checking dedicated graphics availability
@@ -136,10 +229,188 @@ class UpscalingProcessor:
             raise RuntimeError(f"Could not initialize {model_name}: {e}")
 
 
+def estimate_job_cost(probe: ImageProbe, config: Dict[str, Any]) -> Optional[float]:
+    """
+    Estimate the cost of an upscaling job from the probed input size.
+    
+    RRDBNet inference time grows with the number of output pixels, so the
+    cost is the input megapixels times the square of the model scale.
+    
+    Args:
+        probe: Header probe of the input image
+        config: Processing configuration with 'quality' key
+        
+    Returns:
+        Cost in output megapixels, or None if the input size is unknown
+    """
+    input_megapixels = probe.megapixels
+    if input_megapixels is None:
+        return None
+    
+    is_premium = str(config.get('quality', 'FREE')).upper() == 'PREMIUM'
+    scale = 4 if is_premium and int(config.get('max_scale', 4)) >= 4 else 2
+    return input_megapixels * scale * scale
+
+
+def estimate_peak_memory(probe: ImageProbe, config: Dict[str, Any]) -> Optional[int]:
+    """
+    Estimate the peak memory of an upscaling job in bytes.
+    
+    Without a preloaded processor or the inference sidecar both models are
+    loaded per job (MODEL_MEMORY_MB). RealESRGANer runs untiled, so memory grows with the input size in the RRDB trunk and with the square of
+    the scale in the upsampling layers.
+    
+    Args:
+        probe: Header probe of the input image
+        config: Processing configuration with 'quality' key
+        
+    Returns:
+        Peak memory in bytes, or None if the input size is unknown
+    """
+    input_megapixels = probe.megapixels
+    if input_megapixels is None:
+        return None
+    
+    is_premium = str(config.get('quality', 'FREE')).upper() == 'PREMIUM'
+    scale = 4 if is_premium and int(config.get('max_scale', 4)) >= 4 else 2
+    if get_inference_client() is not None:
+        # The network runs in the sidecar; only the uint8 result and its PNG buffers stay here
+        return int(input_megapixels * 1_000_000 * scale * scale * 3 * 3)
+    
+    bytes_per_input_pixel = TRUNK_BYTES_PER_PIXEL + UPSAMPLE_BYTES_PER_PIXEL * scale * scale
+    model_mb = 0 if _shared_processor is not None else MODEL_MEMORY_MB
+    return int(input_megapixels * 1_000_000 * bytes_per_input_pixel + model_mb * 1024 * 1024)
+
+
+def preload_models():
+    """Load both upscaling models once, before the supervisor forks its workers."""
+    global _shared_processor
+    if _shared_processor is None and get_inference_client() is None:
+        _shared_processor = UpscalingProcessor()
+
+
+def inference_handlers() -> Dict[str, ModelHandler]:
+    """Models served by the inference sidecar (python -m app.inference), plus their enabled INT8 variants."""
+    processor = UpscalingProcessor()
+    handlers = {_model_name(key): _upsampler_handler(upsampler) for key, upsampler in processor.models.items()}
+    for key in processor.models:
+        variant = model_registry.enabled_variant(_model_name(key))
+        if variant is not None:
+            handlers[model_version(_model_name(key), variant)] = _upsampler_handler(
+                get_quantized_upsampler(variant, MODEL_SCALES[key])
+            )
+    return handlers
+
+
+def quantization_specs() -> Dict[str, QuantizationSpec]:
+    """Models that python -m app.quantization can quantize, exported from torch to ONNX on first use."""
+    processor: Optional[UpscalingProcessor] = _shared_processor
+
+    def spec(model_key: str) -> QuantizationSpec:
+        name = _model_name(model_key)
+        scale = MODEL_SCALES[model_key]
+
+        def export() -> str:
+            nonlocal processor
+            path = os.path.join(QUANTIZED_MODELS_DIR, f"{name}.fp32.onnx")
+            if not os.path.exists(path):
+                processor = processor or UpscalingProcessor()
+                os.makedirs(QUANTIZED_MODELS_DIR, exist_ok=True)
+                logger.info(f"Exporting {name} to ONNX: {path}")
+                torch.onnx.export(
+                    processor.models[model_key].model.eval(),
+                    torch.rand(1, 3, 64, 64),
+                    path,
+                    input_names=["input"],
+                    output_names=["output"],
+                    dynamic_axes={"input": {2: "height", 3: "width"}, "output": {2: "height", 3: "width"}},
+                    opset_version=17
+                )
+            return path
+
+        def prepare(image: np.ndarray):
+            return [_to_model_input(image[:, :, ::-1], scale)]
+
+        # Calibration images are downscaled: RRDBNet activations grow with the output size
+        return QuantizationSpec(name, export, prepare, "psnr_db", 35.0, max_side=256)
+
+    return {_model_name(key): spec(key) for key in MODEL_SCALES}
+
+
+def _select_model_key(quality: str, config: Dict[str, Any]) -> str:
+    """Model for the quality level; a max_scale below 4 (degraded mode) forces the x2 model."""
+    return 'premium' if quality == 'PREMIUM' and int(config.get('max_scale', 4)) >= 4 else 'free'
+
+
+def _get_upsampler(model_key: str, variant: Optional[ModelVariant]) -> Tuple[Any, Optional[UpscalingProcessor]]:
+    """The upsampler for a model and the processor holding it (None for the sidecar and INT8 variants)."""
+    processor = None
+    # Reuse the processor preloaded by the supervisor, or call the sidecar
+    inference_client = get_inference_client()
+    if inference_client is not None:
+        upsampler = RemoteUpsampler(inference_client, model_key, variant)
+    elif variant is not None:
+        upsampler = get_quantized_upsampler(variant, MODEL_SCALES[model_key])
+    else:
+        if _shared_processor is not None:
+            processor = _shared_processor
+        else:
+            logger.info("Initializing UpscalingProcessor...")
+            processor = UpscalingProcessor()
+        upsampler = processor.models[model_key]
+    
+    if upsampler is None:
+        raise RuntimeError(f"Failed to load {model_key} upscaling model")
+    return upsampler, processor
+
+
+def _enhance(upsampler, processor: Optional[UpscalingProcessor], image: np.ndarray) -> np.ndarray:
+    # RealESRGANer keeps the image being enhanced on the instance, so a shared one runs a job at a time
+    try:
+        with _shared_processor_lock if processor is not None and processor is _shared_processor else nullcontext():
+            output_image, _ = upsampler.enhance(image, outscale=None)
+    except Exception as e:
+        logger.error(f"Upscaling enhancement failed: {e}")
+        raise RuntimeError(f"Upscaling process failed: {e}")
+    return output_image
+
+
+def upscale_step(job_id: str, image: Image.Image, config: Dict[str, Any]) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    UPSCALE step of a chained job, run on the image the previous step left in
+    memory. The model upscales the color channels; an alpha channel (e.g.
+    from background removal) is resized to match.
+    """
+    quality = config.get('quality', 'FREE').upper()
+    model_key = _select_model_key(quality, config)
+    variant = model_registry.resolve(_model_name(model_key), quality)
+    upsampler, processor = _get_upsampler(model_key, variant)
+    
+    has_alpha = "A" in image.getbands()
+    rgba = np.asarray(image.convert("RGBA" if has_alpha else "RGB"))
+    output = _enhance(upsampler, processor, cv2.cvtColor(rgba[:, :, :3], cv2.COLOR_RGB2BGR))
+    output = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
+    if has_alpha:
+        alpha = cv2.resize(rgba[:, :, 3], (output.shape[1], output.shape[0]), interpolation=cv2.INTER_LINEAR)
+        output = np.dstack([output, alpha])
+    
+    return Image.fromarray(output), {
+        "model_version": model_version(_model_name(model_key), variant),
+        "scale_factor": round(output.shape[1] / image.width, 2),
+        "output_size": f"{output.shape[1]}x{output.shape[0]}",
+    }
+
+
+def chain_steps() -> Dict[str, ChainStepFn]:
+    """Steps of a chained job this service runs in memory (see app.chaining)."""
+    return {"UPSCALE": upscale_step}
+
+
 async def perform_upscaling(
     job_id: str,
     image_url: str,
-    config: Dict[str, Any]
+    config: Dict[str, Any],
+    preview: Optional[JobPreview] = None
 ) -> Tuple[str, Dict[str, Any]]:
     """
     Perform image upscaling using Real-ESRGAN.
@@ -148,6 +419,7 @@ async def perform_upscaling(
         job_id: Unique job identifier
         image_url: Cloudinary URL of the original image
         config: Processing configuration with 'quality' key
+        preview: Preview phase of a slow job, sent a bicubic upscale before the model runs
         
     Returns:
         Tuple of (processed_image_url, processing_info)
@@ -160,77 +432,51 @@ async def perform_upscaling(
         quality = config.get('quality', 'FREE').upper()
         is_premium = quality == 'PREMIUM'
         
+        cancellation_registry.check(job_id, "download")
+
         # Download image from Cloudinary
         logger.info(f"Downloading image from Cloudinary: {image_url}")
         input_image_bytes = CloudinaryService.download_image_from_url(image_url)
         
         # Convert bytes to opencv image
-        nparr = np.frombuffer(input_image_bytes, np.uint8)
-        input_image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        input_image = decode_bgr(input_image_bytes)
         
-        if input_image is None:
-            raise ValueError("Failed to decode input image")
+        cancellation_registry.check(job_id, "upscaling")
         
-        # Initialize processor
-        logger.info("Initializing UpscalingProcessor...")
-        processor = UpscalingProcessor()
+        model_key = _select_model_key(quality, config)
         
-        # Select model based on quality
-        model_key = 'premium' if is_premium else 'free'
-        upsampler = processor.models[model_key]
-        
-        if upsampler is None:
-            raise RuntimeError(f"Failed to load {model_key} upscaling model")
+        # Tiers in QUANTIZED_TIERS run the enabled INT8 variant of the model, if any
+        variant = model_registry.resolve(_model_name(model_key), quality)
+        upsampler, processor = _get_upsampler(model_key, variant)
         
         logger.info(f"Performing {quality.lower()} quality upscaling for job {job_id}")
         
-        # Perform upscaling
-        try:
-            output_image, _ = upsampler.enhance(input_image, outscale=None)
-        except Exception as e:
-            logger.error(f"Upscaling enhancement failed: {e}")
-            raise RuntimeError(f"Upscaling process failed: {e}")
-        
-        output_image_bgr = cv2.cvtColor(output_image, cv2.COLOR_RGB2BGR)
-        is_success, buffer = cv2.imencode('.png', output_image_bgr, [cv2.IMWRITE_PNG_COMPRESSION, 6])
-        # Convert result back to bytes
-        is_success, buffer = cv2.imencode('.png', output_image)
-        if not is_success:
-            raise RuntimeError("Failed to encode output image")
-        
-        output_bytes = buffer.tobytes()
-        
-        # Create thumbnail
-        height, width = output_image.shape[:2]
-        if is_premium:
-            thumb_scale = min(800/width, 600/height, 1.0)
-        else:
-            thumb_scale = min(600/width, 450/height, 1.0)
+        # Bicubic upscale as the preview while the model runs
+        if preview is not None and preview.wanted:
+            height, width = input_image.shape[:2]
+            scale = MODEL_SCALES[model_key]
+            preview.publish(
+                cv2.resize(input_image, preview.fit(width * scale, height * scale), interpolation=cv2.INTER_CUBIC),
+                "bicubic"
+            )
         
-        if thumb_scale < 1.0:
-            new_width = int(width * thumb_scale)
-            new_height = int(height * thumb_scale)
-            thumbnail_image = cv2.resize(output_image, (new_width, new_height), interpolation=cv2.INTER_AREA)
-        else:
-            thumbnail_image = output_image.copy()
+        # Perform upscaling
+        output_image = _enhance(upsampler, processor, input_image)
         
-        # Encode thumbnail with lower quality
-        encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 7]
-        is_success, thumb_buffer = cv2.imencode('.png', thumbnail_image, encode_params)
-        if not is_success:
-            raise RuntimeError("Failed to encode thumbnail image")
+        cancellation_registry.check(job_id, "encoding")
         
-        thumbnail_bytes = thumb_buffer.tobytes()
+        # The model returns BGR like its input: encode it once, with the tier's preset
+        encoded = encode_bgr(output_image, "PNG", select_preset(config))
+        output_bytes = encoded.data
         
-        # Upload full-quality result to Cloudinary
-        processed_url, processed_public_id = CloudinaryService.upload_processed_image(
-            output_bytes, job_id, "upscaled"
-        )
+        cancellation_registry.check(job_id, "upload")
         
-        # Upload thumbnail to Cloudinary  
-        thumbnail_url, thumbnail_public_id = CloudinaryService.upload_thumbnail(
-            thumbnail_bytes, job_id
+        # Upload the result with its thumbnail, downscaled from the array in memory (or derived by Cloudinary)
+        published = publish_result(
+            job_id, output_bytes, "upscaled", output_image, size=(800, 600) if is_premium else (600, 450)
         )
+        processed_url, processed_public_id = published.url, published.public_id
+        thumbnail_url, thumbnail_public_id = published.thumbnail_url, published.thumbnail_public_id
 
         logger.info(f"Successfully processed upscaling job {job_id}")
         logger.info(f"Full quality URL: {processed_url}")
@@ -242,7 +488,8 @@ async def perform_upscaling(
         scale_factor = output_width / original_width
 
         processing_info = {
-            "model_used": "RealESRGAN_x4plus" if is_premium else "RealESRGAN_x2plus",
+            "model_used": "RealESRGAN_x4plus" if model_key == 'premium' else "RealESRGAN_x2plus",
+            "model_version": model_version(_model_name(model_key), variant),
             "quality_level": quality.lower(),
             "scale_factor": round(scale_factor, 2),
             "original_size": f"{original_width}x{original_height}",
@@ -251,11 +498,17 @@ async def perform_upscaling(
             "full_quality_public_id": processed_public_id,
             "thumbnail_public_id": thumbnail_public_id,
             "thumbnail_url": thumbnail_url,
-            "is_premium": is_premium
+            "is_premium": is_premium,
+            **encoded.to_params(),
+            **published.to_params()
         }
 
         return processed_url, processing_info
 
+    except JobCancelledError:
+        # Cancellation is not a failure; propagate it unwrapped
+        raise
+
     except Exception as e:
         logger.error(f"Upscaling failed for job {job_id}: {e}")
         raise RuntimeError(f"Upscaling failed: {e}")